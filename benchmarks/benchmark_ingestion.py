@@ -0,0 +1,402 @@
+""" Benchmarks the ingestion Lambda against a throwaway local PostgreSQL
+filled with synthetic totesys data.
+
+For each scale factor the 11 totesys tables are created and filled, then
+'lambda_handler' is run once per export engine in a fresh process that
+uploads to a local moto S3 server. Each run reports the time spent in
+every stage of the handler along with rows/s, bytes/s and the peak
+resident memory of the process, which is what the Lambda is sized by.
+
+Stage times are summed across worker threads. The 'copy' engine
+encodes and uploads while its query runs, so its query time includes
+its encode and upload time.
+
+The script is intended to be run locally, not on AWS Lambda:
+
+    PYTHONPATH=$(pwd) python benchmarks/benchmark_ingestion.py \\
+        --scales 10000 1000000 --engines select copy
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import resource
+import threading
+import time
+from collections import defaultdict
+from contextlib import ExitStack
+from unittest.mock import patch
+
+import boto3
+import requests
+import testing.postgresql
+from moto.server import ThreadedMotoServer
+from pg8000.native import Connection
+
+BUCKET_NAME = "benchmark-ingestion-bucket"
+S3_PORT = 5055
+S3_ENDPOINT = f"http://127.0.0.1:{S3_PORT}"
+STAGES = ["headers", "change_detection", "query", "encode", "upload"]
+
+SCHEMA = [
+    """CREATE TABLE currency (
+        currency_id SERIAL PRIMARY KEY,
+        currency_code VARCHAR(3) NOT NULL,
+        created_at TIMESTAMP NOT NULL,
+        last_updated TIMESTAMP NOT NULL);""",
+    """CREATE TABLE department (
+        department_id SERIAL PRIMARY KEY,
+        department_name VARCHAR NOT NULL,
+        location VARCHAR,
+        manager VARCHAR,
+        created_at TIMESTAMP NOT NULL,
+        last_updated TIMESTAMP NOT NULL);""",
+    """CREATE TABLE staff (
+        staff_id SERIAL PRIMARY KEY,
+        first_name VARCHAR NOT NULL,
+        last_name VARCHAR NOT NULL,
+        department_id INT NOT NULL,
+        email_address VARCHAR NOT NULL,
+        created_at TIMESTAMP NOT NULL,
+        last_updated TIMESTAMP NOT NULL);""",
+    """CREATE TABLE address (
+        address_id SERIAL PRIMARY KEY,
+        address_line_1 VARCHAR NOT NULL,
+        address_line_2 VARCHAR,
+        district VARCHAR,
+        city VARCHAR NOT NULL,
+        postal_code VARCHAR NOT NULL,
+        country VARCHAR NOT NULL,
+        phone VARCHAR NOT NULL,
+        created_at TIMESTAMP NOT NULL,
+        last_updated TIMESTAMP NOT NULL);""",
+    """CREATE TABLE design (
+        design_id SERIAL PRIMARY KEY,
+        created_at TIMESTAMP NOT NULL,
+        design_name VARCHAR NOT NULL,
+        file_location VARCHAR NOT NULL,
+        file_name VARCHAR NOT NULL,
+        last_updated TIMESTAMP NOT NULL);""",
+    """CREATE TABLE counterparty (
+        counterparty_id SERIAL PRIMARY KEY,
+        counterparty_legal_name VARCHAR NOT NULL,
+        legal_address_id INT NOT NULL,
+        commercial_contact VARCHAR,
+        delivery_contact VARCHAR,
+        created_at TIMESTAMP NOT NULL,
+        last_updated TIMESTAMP NOT NULL);""",
+    """CREATE TABLE payment_type (
+        payment_type_id SERIAL PRIMARY KEY,
+        payment_type_name VARCHAR NOT NULL,
+        created_at TIMESTAMP NOT NULL,
+        last_updated TIMESTAMP NOT NULL);""",
+    """CREATE TABLE sales_order (
+        sales_order_id SERIAL PRIMARY KEY,
+        created_at TIMESTAMP NOT NULL,
+        last_updated TIMESTAMP NOT NULL,
+        design_id INT NOT NULL,
+        staff_id INT NOT NULL,
+        counterparty_id INT NOT NULL,
+        units_sold INT NOT NULL,
+        unit_price NUMERIC(10, 2) NOT NULL,
+        currency_id INT NOT NULL,
+        agreed_delivery_date VARCHAR NOT NULL,
+        agreed_payment_date VARCHAR NOT NULL,
+        agreed_delivery_location_id INT NOT NULL);""",
+    """CREATE TABLE purchase_order (
+        purchase_order_id SERIAL PRIMARY KEY,
+        created_at TIMESTAMP NOT NULL,
+        last_updated TIMESTAMP NOT NULL,
+        staff_id INT NOT NULL,
+        counterparty_id INT NOT NULL,
+        item_code VARCHAR NOT NULL,
+        item_quantity INT NOT NULL,
+        item_unit_price NUMERIC NOT NULL,
+        currency_id INT NOT NULL,
+        agreed_delivery_date VARCHAR NOT NULL,
+        agreed_payment_date VARCHAR NOT NULL,
+        agreed_delivery_location_id INT NOT NULL);""",
+    """CREATE TABLE transaction (
+        transaction_id SERIAL PRIMARY KEY,
+        transaction_type VARCHAR NOT NULL,
+        sales_order_id INT,
+        purchase_order_id INT,
+        created_at TIMESTAMP NOT NULL,
+        last_updated TIMESTAMP NOT NULL);""",
+    """CREATE TABLE payment (
+        payment_id SERIAL PRIMARY KEY,
+        created_at TIMESTAMP NOT NULL,
+        last_updated TIMESTAMP NOT NULL,
+        transaction_id INT NOT NULL,
+        counterparty_id INT NOT NULL,
+        payment_amount NUMERIC NOT NULL,
+        currency_id INT NOT NULL,
+        payment_type_id INT NOT NULL,
+        paid BOOLEAN NOT NULL,
+        payment_date VARCHAR NOT NULL,
+        company_ac_number INT NOT NULL,
+        counterparty_ac_number INT NOT NULL);""",
+]
+
+STAMP = "TIMESTAMP '2022-11-03 14:20:49.962' + n * INTERVAL '1 second'"
+
+SEED = [
+    "INSERT INTO currency (currency_code, created_at, last_updated) "
+    f"SELECT (ARRAY['GBP', 'USD', 'EUR'])[n], {STAMP}, {STAMP} "
+    "FROM generate_series(1, 3) AS n;",
+    "INSERT INTO department (department_name, location, manager, "
+    "created_at, last_updated) SELECT 'Department ' || n, 'Location ' || n, "
+    f"'Manager ' || n, {STAMP}, {STAMP} FROM generate_series(1, 8) AS n;",
+    "INSERT INTO staff (first_name, last_name, department_id, "
+    "email_address, created_at, last_updated) SELECT 'First' || n, "
+    "'Last' || n, n % 8 + 1, 'staff' || n || '@terrifictotes.com', "
+    f"{STAMP}, {STAMP} FROM generate_series(1, 20) AS n;",
+    "INSERT INTO address (address_line_1, address_line_2, district, city, "
+    "postal_code, country, phone, created_at, last_updated) "
+    "SELECT n || ' High Street', NULL, 'District ' || n, 'City ' || n, "
+    "'AB' || n || ' 1CD', 'Country ' || n, '0' || (1800000000 + n), "
+    f"{STAMP}, {STAMP} FROM generate_series(1, 30) AS n;",
+    "INSERT INTO design (created_at, design_name, file_location, "
+    f"file_name, last_updated) SELECT {STAMP}, 'Design ' || n, "
+    "'/usr/designs', 'design-' || md5(n::text) || '.json', "
+    f"{STAMP} FROM generate_series(1, 100) AS n;",
+    "INSERT INTO counterparty (counterparty_legal_name, legal_address_id, "
+    "commercial_contact, delivery_contact, created_at, last_updated) "
+    "SELECT 'Counterparty ' || n, n % 30 + 1, 'Commercial ' || n, "
+    f"'Delivery ' || n, {STAMP}, {STAMP} FROM generate_series(1, 20) AS n;",
+    "INSERT INTO payment_type (payment_type_name, created_at, "
+    "last_updated) SELECT (ARRAY['SALES_RECEIPT', 'SALES_REFUND', "
+    f"'PURCHASE_PAYMENT', 'PURCHASE_REFUND'])[n], {STAMP}, {STAMP} "
+    "FROM generate_series(1, 4) AS n;",
+    "INSERT INTO sales_order (created_at, last_updated, design_id, "
+    "staff_id, counterparty_id, units_sold, unit_price, currency_id, "
+    "agreed_delivery_date, agreed_payment_date, "
+    f"agreed_delivery_location_id) SELECT {STAMP}, {STAMP}, n % 100 + 1, "
+    "n % 20 + 1, n % 20 + 1, n % 100000 + 1000, "
+    "round((n % 400 + 200) / 100.0, 2), n % 3 + 1, "
+    "to_char(DATE '2022-11-07' + n % 365, 'YYYY-MM-DD'), "
+    "to_char(DATE '2022-11-08' + n % 365, 'YYYY-MM-DD'), n % 30 + 1 "
+    "FROM generate_series(1, :orders) AS n;",
+    "INSERT INTO purchase_order (created_at, last_updated, staff_id, "
+    "counterparty_id, item_code, item_quantity, item_unit_price, "
+    "currency_id, agreed_delivery_date, agreed_payment_date, "
+    f"agreed_delivery_location_id) SELECT {STAMP}, {STAMP}, n % 20 + 1, "
+    "n % 20 + 1, upper(substr(md5(n::text), 1, 7)), n % 1000 + 1, "
+    "round((n % 90000 + 1000) / 100.0, 2), n % 3 + 1, "
+    "to_char(DATE '2022-11-09' + n % 365, 'YYYY-MM-DD'), "
+    "to_char(DATE '2022-11-10' + n % 365, 'YYYY-MM-DD'), n % 30 + 1 "
+    "FROM generate_series(1, :purchases) AS n;",
+    "INSERT INTO transaction (transaction_type, sales_order_id, "
+    "purchase_order_id, created_at, last_updated) "
+    "SELECT 'SALE', sales_order_id, NULL, created_at, last_updated "
+    "FROM sales_order UNION ALL "
+    "SELECT 'PURCHASE', NULL, purchase_order_id, created_at, last_updated "
+    "FROM purchase_order;",
+    "INSERT INTO payment (created_at, last_updated, transaction_id, "
+    "counterparty_id, payment_amount, currency_id, payment_type_id, paid, "
+    "payment_date, company_ac_number, counterparty_ac_number) "
+    "SELECT created_at, last_updated, transaction_id, "
+    "transaction_id % 20 + 1, round((transaction_id % 99999) / 10.0, 2), "
+    "transaction_id % 3 + 1, transaction_id % 4 + 1, "
+    "transaction_id % 2 = 0, "
+    "to_char(DATE '2022-11-03' + transaction_id % 365, 'YYYY-MM-DD'), "
+    "10000000 + transaction_id % 89999999, "
+    "20000000 + transaction_id % 79999999 FROM transaction;",
+]
+
+
+class StageTimings:
+    """ Sums the time spent in each stage of a run, across threads. """
+
+    def __init__(self):
+        self.seconds = defaultdict(float)
+        self._lock = threading.Lock()
+
+    def add(self, stage, start):
+        with self._lock:
+            self.seconds[stage] += time.perf_counter() - start
+
+    def wrap(self, stage, function):
+        """ Returns 'function' timed under 'stage'. """
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.add(stage, start)
+        return timed
+
+    def wrap_generator(self, stage, function):
+        """ Returns generator 'function' with each step timed under
+        'stage', leaving out the time its consumer spends. """
+        def timed(*args, **kwargs):
+            iterator = function(*args, **kwargs)
+            while True:
+                start = time.perf_counter()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    self.add(stage, start)
+                    return
+                self.add(stage, start)
+                yield item
+        return timed
+
+
+def seed_database(credentials, scale):
+    """ Creates the totesys tables and fills them with synthetic data.
+
+    Args:
+        credentials: Connection parameters for the local database.
+        scale: The number of sales orders. Half as many purchase orders
+        are made, with a transaction and a payment for every order.
+
+    Returns:
+        The total number of rows across all tables.
+    """
+    conn = Connection(credentials["user"], password=credentials["password"],
+                      database=credentials["database"],
+                      host=credentials["host"], port=credentials["port"])
+    try:
+        conn.run("DROP SCHEMA public CASCADE;")
+        conn.run("CREATE SCHEMA public;")
+        for statement in SCHEMA:
+            conn.run(statement)
+        for statement in SEED:
+            params = {key: value for key, value in
+                      {"orders": scale, "purchases": scale // 2}.items()
+                      if f":{key}" in statement}
+            conn.run(statement, **params)
+        conn.run("ANALYZE;")
+        return conn.run(
+            "SELECT sum(n_live_tup)::bigint FROM pg_stat_user_tables;")[0][0]
+    finally:
+        conn.close()
+
+
+def run_benchmark(credentials, scale, rows, engine, file_format, workers):
+    """ Runs the ingestion handler once and measures it.
+
+    Meant to be run in a fresh process so imports, caches and peak
+    memory belong to this run alone.
+
+    Args:
+        credentials: Connection parameters for the local database.
+        scale: The scale factor the database was seeded with.
+        rows: The total number of rows in the database.
+        engine: The 'TF_INGESTION_ENGINE' to run with.
+        file_format: The 'TF_INGESTION_FORMAT' to run with.
+        workers: The 'TF_INGESTION_WORKERS' to run with.
+
+    Returns:
+        A dictionary report of the run.
+    """
+    os.environ.update({
+        "AWS_ACCESS_KEY_ID": "testing", "AWS_SECRET_ACCESS_KEY": "testing",
+        "AWS_DEFAULT_REGION": "us-east-1", "TF_ING_BUCKET": BUCKET_NAME,
+        "TF_INGESTION_ENGINE": engine, "TF_INGESTION_FORMAT": file_format,
+        "TF_INGESTION_WORKERS": str(workers), "TF_METRICS_NAMESPACE": ""})
+    import src.ingestion
+
+    s3 = boto3.client("s3", endpoint_url=S3_ENDPOINT)
+    s3.create_bucket(Bucket=BUCKET_NAME)
+    timings = StageTimings()
+    ingestion = src.ingestion
+    with ExitStack() as stack:
+        stack.enter_context(patch.object(ingestion, "_s3_client", s3))
+        stack.enter_context(patch.object(
+            ingestion, "get_secret_value", return_value=credentials))
+        for name, stage in [("get_schema_catalog", "headers"),
+                            ("sql_probe_tables", "change_detection"),
+                            ("sql_select_query", "query"),
+                            ("encode_csv_rows", "encode"),
+                            ("encode_parquet_batch", "encode")]:
+            stack.enter_context(patch.object(
+                ingestion, name, timings.wrap(
+                    stage, getattr(ingestion, name))))
+        for name in ["sql_stream_query", "sql_keyset_pages"]:
+            stack.enter_context(patch.object(
+                ingestion, name, timings.wrap_generator(
+                    "query", getattr(ingestion, name))))
+        for name in ["put_object", "upload_part",
+                     "complete_multipart_upload"]:
+            stack.enter_context(patch.object(
+                s3, name, timings.wrap("upload", getattr(s3, name))))
+
+        start = time.perf_counter()
+        results = ingestion.lambda_handler({}, None)
+        seconds = time.perf_counter() - start
+
+    byte_count = sum(
+        item["Size"]
+        for page in s3.get_paginator("list_objects_v2").paginate(
+            Bucket=BUCKET_NAME)
+        for item in page.get("Contents", [])
+        if not item["Key"].startswith(ingestion.STATE_PREFIX))
+    return {"scale": scale, "engine": engine, "format": file_format,
+            "workers": workers, "seconds": round(seconds, 3),
+            "stages": {stage: round(timings.seconds[stage], 3)
+                       for stage in STAGES},
+            "rows": rows, "bytes": byte_count,
+            "rows_per_second": round(rows / seconds),
+            "bytes_per_second": round(byte_count / seconds),
+            "peak_rss_mb": round(resource.getrusage(
+                resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+            "failed": [table for table, result in results.items()
+                       if result == "failed"]}
+
+
+def format_report(report):
+    """ Formats a run's report as one line of text. """
+    stages = " ".join(f"{stage}={report['stages'][stage]:.2f}s"
+                      for stage in STAGES)
+    return (f"{report['scale']:>10} {report['engine']:>6} "
+            f"{report['format']:>7} {report['seconds']:>8.2f}s "
+            f"{report['rows_per_second']:>10} rows/s "
+            f"{report['bytes_per_second'] / 1024 ** 2:>8.2f} MB/s "
+            f"{report['peak_rss_mb']:>8.1f} MB peak  {stages}"
+            + (f"  FAILED: {report['failed']}" if report["failed"] else ""))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--scales", type=int, nargs="+",
+                        default=[10000, 100000, 1000000],
+                        help="numbers of sales orders to benchmark with")
+    parser.add_argument("--engines", nargs="+",
+                        default=["select", "stream", "copy"])
+    parser.add_argument("--format", default="csv",
+                        choices=["csv", "parquet"])
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--output",
+                        help="write the reports to this file as JSON")
+    args = parser.parse_args()
+
+    reports = []
+    context = multiprocessing.get_context("spawn")
+    server = ThreadedMotoServer(port=S3_PORT, verbose=False)
+    server.start()
+    try:
+        with testing.postgresql.Postgresql() as postgresql:
+            credentials = dict(postgresql.dsn(), password="")
+            for scale in args.scales:
+                rows = seed_database(credentials, scale)
+                for engine in args.engines:
+                    with context.Pool(1) as pool:
+                        report = pool.apply(run_benchmark, (
+                            credentials, scale, rows, engine, args.format,
+                            args.workers))
+                    requests.post(f"{S3_ENDPOINT}/moto-api/reset")
+                    print(format_report(report), flush=True)
+                    reports.append(report)
+    finally:
+        server.stop()
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(reports, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -8,34 +8,122 @@ The script is intended to run on AWS Lambda.
 """
 
 import logging
-from pg8000.native import Connection
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager, nullcontext
+from pg8000.native import Connection, literal
 import pg8000.exceptions as pge
 import boto3
 import botocore.exceptions
 import botocore.errorfactory
-import pandas as pd
 from io import StringIO
+from datetime import datetime, timezone
+import csv
+import hashlib
 import json
+import math
 import os
+import re
+import uuid
 
 
 logger = logging.getLogger("ingestion")
 logger.setLevel(logging.INFO)
 
-s3_resource = boto3.resource("s3")
-s3_client = boto3.client("s3")
-secrets = boto3.client("secretsmanager")
+# Kept at module level so warm invocations of the same Lambda container
+# reuse the connection instead of repeating the handshake. The AWS
+# clients are created on first use to keep them out of the cold start.
+_s3_client = None
+_secrets_client = None
+_connection_pool = None
+_replica_pools = {}
+_schema_catalog = None
+_secret_cache = {}
+
+STATE_PREFIX = "_state/"
+WATERMARKS_KEY = f"{STATE_PREFIX}watermarks.json"
+SCHEMA_CATALOG_KEY = f"{STATE_PREFIX}schema_catalog.json"
+CONTENT_HASHES_KEY = f"{STATE_PREFIX}content_hashes.json"
+MANIFEST_PREFIX = "_manifests/"
+LATEST_MANIFEST_KEY = f"{MANIFEST_PREFIX}latest.json"
+CDC_STATE_KEY = f"{STATE_PREFIX}cdc.json"
+POLL_SCHEDULE_KEY = f"{STATE_PREFIX}poll_schedule.json"
+TABLE_STATS_KEY = f"{STATE_PREFIX}table_stats.json"
+KEY_HASHES_KEY = f"{STATE_PREFIX}key_hashes.json"
+WORK_PLAN_KEY = f"{STATE_PREFIX}work_plan.json"
+# Weight of the latest run's duration in a table's cost estimate.
+COST_SMOOTHING = 0.5
+KEY_HASH_FANOUT = 16
+INTEGER_TYPES = ("smallint", "integer", "bigint")
+CHANGE_COLUMNS = ["change_type", "commit_lsn"]
+
+# 'test_decoding' prints each change as "table schema.name: TYPE: ..."
+# followed by name[type]:value for each column, quoting string values.
+DECODED_CHANGE = re.compile(
+    r"table (.+?): (INSERT|UPDATE|DELETE|TRUNCATE):\s?(.*)", re.S)
+DECODED_COLUMN = re.compile(
+    r"(old-key:|new-tuple:)|"
+    r"(\"(?:[^\"]|\"\")+\"|[^\s\[]+)\[(.+?)\]:('(?:[^']|'')*'|\S+)",
+    re.S)
+
+_metrics_context = threading.local()
+
+# The columns of each table the transformation Lambda reads, including
+# the primary key and the 'created_at' and 'last_updated' dates it
+# parses. Keep in step with the 'format_' functions in transformation.py.
+COLUMN_PROJECTION = {
+    "staff": ["staff_id", "first_name", "last_name", "department_id",
+              "email_address", "created_at", "last_updated"],
+    "department": ["department_id", "department_name", "location",
+                   "created_at", "last_updated"],
+    "address": ["address_id", "address_line_1", "address_line_2",
+                "district", "city", "postal_code", "country", "phone",
+                "created_at", "last_updated"],
+    "design": ["design_id", "design_name", "file_location", "file_name",
+               "created_at", "last_updated"],
+    "counterparty": ["counterparty_id", "counterparty_legal_name",
+                     "legal_address_id", "created_at", "last_updated"],
+    "transaction": ["transaction_id", "transaction_type", "sales_order_id",
+                    "purchase_order_id", "created_at", "last_updated"],
+    "payment_type": ["payment_type_id", "payment_type_name", "created_at",
+                     "last_updated"],
+    "currency": ["currency_id", "currency_code", "created_at",
+                 "last_updated"],
+    "sales_order": ["sales_order_id", "created_at", "last_updated",
+                    "design_id", "staff_id", "counterparty_id", "units_sold",
+                    "unit_price", "currency_id", "agreed_delivery_date",
+                    "agreed_payment_date", "agreed_delivery_location_id"],
+    "purchase_order": ["purchase_order_id", "created_at", "last_updated",
+                       "staff_id", "counterparty_id", "item_code",
+                       "item_quantity", "item_unit_price", "currency_id",
+                       "agreed_delivery_date", "agreed_payment_date",
+                       "agreed_delivery_location_id"],
+    "payment": ["payment_id", "created_at", "last_updated",
+                "transaction_id", "counterparty_id", "payment_amount",
+                "currency_id", "payment_type_id", "paid", "payment_date"]
+}
+
+# S3 rejects multipart parts smaller than 5 MiB, other than the last.
+MULTIPART_PART_SIZE = 8 * 1024 * 1024
 
 
 def lambda_handler(event, context):
     """ Handles functions to pull data from a database to upload as a
     csv file to S3.
-    Checks if the data exists on s3 and if the table has been updated
-    since the last interval before uploading.
+    Checks which tables have changed since the last run and exports only
+    those, or with 'TF_CDC_SLOT' set writes the changes recorded by that
+    replication slot, see 'ingest_changes'. How tables are exported is
+    set by the 'TF_*' environment variables, see 'get_ingestion_settings'
+    and the variables table under 'Ingestion.py' in the README.
 
     Args:
         event: An AWS event object.
         context: A valid AWS lambda Python context object.
+
+    Returns:
+        Dictionary with keys of table names whose values are 'updated',
+        'unchanged', 'failed' or 'deferred'.
     """
     credentials = get_secret_value('database_credentials')
     TABLES_LIST = ['staff', 'transaction', 'design', 'address',
@@ -43,33 +131,526 @@ def lambda_handler(event, context):
                    'payment_type', 'currency', 'department',
                    'purchase_order']
     BUCKET = os.environ.get('TF_ING_BUCKET')
-    INTERVAL = '3 minutes'
-    has_updated = False
-    columns = collect_column_headers(credentials, TABLES_LIST)
-    bucket_keys = get_keys_from_table_names(TABLES_LIST)
-    is_data_on_s3 = check_key_exists(BUCKET, bucket_keys[0])
+    settings = get_ingestion_settings()
+    pool = get_connection_pool(
+        credentials, settings["workers"] + settings["consistent_snapshot"],
+        refresh_credentials=lambda: get_secret_value(
+            'database_credentials', force_refresh=True))
+    run_at = datetime.now(timezone.utc)
+    run_id = getattr(context, "aws_request_id", None) or uuid.uuid4().hex
+    deadline = get_deadline(context, settings["deadline_margin"])
+    work_plan = load_state_from_s3(
+        BUCKET, WORK_PLAN_KEY, {"costs": {}, "deferred": []}) \
+        if deadline is not None else {"costs": {}, "deferred": []}
+    if settings["cdc_slot"]:
+        results = ingest_changes(
+            pool, TABLES_LIST, BUCKET, settings, run_at, run_id,
+            deadline=deadline, work_plan=work_plan)
+        if deadline is not None:
+            save_state_to_s3(BUCKET, WORK_PLAN_KEY, work_plan)
+        if "updated" in results.values():
+            logger.info("SUCCESSFUL INGESTION")
+        else:
+            logger.info("NO FILES TO UPDATE")
+        return results
+    if settings["layout"] == "delta":
+        bucket_keys = [get_delta_key(table, run_at, run_id,
+                                     settings["format"])
+                       for table in TABLES_LIST]
+        state_keys = [f"{table}/" for table in TABLES_LIST]
+    else:
+        bucket_keys = get_keys_from_table_names(
+            TABLES_LIST, extension=settings["format"])
+        state_keys = bucket_keys
+    key_states = list_key_states(BUCKET, state_keys)
+    watermarks = load_state_from_s3(
+        BUCKET, WATERMARKS_KEY, {}) if settings["incremental"] else {}
+    content_hashes = load_state_from_s3(
+        BUCKET, CONTENT_HASHES_KEY, {}) if settings["skip_unchanged"] else None
+    schedule = load_state_from_s3(
+        BUCKET, POLL_SCHEDULE_KEY, {}) if settings["max_skip_runs"] else None
+    polled = [table for index, table in enumerate(TABLES_LIST)
+              if not key_states[state_keys[index]]["exists"]
+              or is_poll_due(schedule, table)
+              or table in work_plan["deferred"]]
+    use_stats = settings["change_detection"] == "stats"
+    saved_stats = load_state_from_s3(
+        BUCKET, TABLE_STATS_KEY, {}) if use_stats else None
+    extract_pool = pool
+    if settings["replica_hosts"] and use_stats:
+        # The counters are the primary's, so a lagging replica could miss
+        # changes they have already been saved as having seen.
+        logger.info("Stats change detection is on, using the primary")
+    elif settings["replica_hosts"]:
+        extract_pool = choose_replica(get_replica_pools(
+            credentials, settings["replica_hosts"],
+            settings["workers"] + settings["consistent_snapshot"],
+            refresh_credentials=lambda: get_secret_value(
+                'database_credentials', force_refresh=True)),
+            settings["replica_max_lag"]) or pool
+    probe_pool = extract_pool \
+        if settings["probe_target"] == "replica" else pool
+    with probe_pool.connection() as conn:
+        catalog = get_schema_catalog(conn, TABLES_LIST, BUCKET)
+        check_start = time.perf_counter()
+        stats = sql_table_stats(conn, polled) if use_stats and polled \
+            else {}
+        probed = [table for table in polled
+                  if has_stats_changed(stats, saved_stats, table)] \
+            if use_stats else polled
+        probe = sql_probe_tables(
+            conn, probed, settings["interval"]) if probed else {}
+        check_seconds = time.perf_counter() - check_start
+    projection = COLUMN_PROJECTION if settings["project_columns"] else None
+    columns = [get_projected_columns(
+        table, get_catalog_columns(catalog, table), projection)
+        for table in TABLES_LIST]
+
+    results = {}
+    exports = []
     for index, table in enumerate(TABLES_LIST):
-        if sql_check_updated(credentials, table,
-                             INTERVAL) or not is_data_on_s3:
+        if table not in polled:
+            results[table] = "unchanged"
+            continue
+        is_data_on_s3 = key_states[state_keys[index]]["exists"]
+        since = get_watermark(watermarks, table) if is_data_on_s3 else None
+        force = not is_data_on_s3 or (
+            settings["incremental"] and since is None) or \
+            table in work_plan["deferred"]
+        if force and content_hashes is not None:
+            # A forced export must be written even if its content
+            # matches the last upload, which may since have been deleted.
+            content_hashes.pop(table, None)
+        if use_stats:
+            changed = table in probed
+        else:
+            changed = has_table_changed(
+                probe.get(table), since or get_poll_seen(schedule, table))
+        if force or changed:
+            exports.append((index, since))
+        else:
+            results[table] = "unchanged"
+
+    order = order_work([TABLES_LIST[index] for index, _ in exports],
+                       work_plan["costs"], work_plan["deferred"])
+    exports.sort(key=lambda export: order.index(TABLES_LIST[export[0]]))
+    table_metrics = {table: TableMetrics() for table in TABLES_LIST}
+    durations = {}
+
+    def ingest(export):
+        index, since = export
+        table = TABLES_LIST[index]
+        if not fits_deadline(deadline, work_plan["costs"].get(table)):
+            return {"deferred": True}
+        row_count = (probe.get(table) or {}).get("row_count")
+        start = time.monotonic()
+        with collect_metrics(table_metrics[table]):
+            if settings["layout"] == "delta" and \
+                    settings["format"] == "csv" and \
+                    0 < settings["range_rows"] < (row_count or 0):
+                outcome = range_scan_table(
+                    extract_pool, table, columns[index], BUCKET,
+                    bucket_keys[index], settings, since=since,
+                    snapshot=snapshot,
+                    column_types=get_catalog_types(catalog, table),
+                    content_hashes=content_hashes)
+            else:
+                outcome = ingest_table(
+                    extract_pool, table, columns[index], BUCKET,
+                    bucket_keys[index],
+                    settings, since=since,
+                    column_types=get_catalog_types(catalog, table),
+                    content_hashes=content_hashes, snapshot=snapshot)
+        durations[table] = time.monotonic() - start
+        return outcome
+
+    with exported_snapshot(extract_pool) \
+            if settings["consistent_snapshot"] \
+            else nullcontext() as snapshot:
+        outcomes = run_tasks(ingest, exports, settings["workers"])
 
-            data_to_bucket_csv_file(
-                credentials, table, columns[index], BUCKET,
-                bucket_keys[index]
-            )
-            has_updated = True
+    manifest_files = []
+    # What each export read, as a lagging replica may not yet have the
+    # changes the probe saw on the primary.
+    seen = {table: (probe.get(table) or {}).get("last_updated")
+            for table in TABLES_LIST}
+    for export in exports:
+        index, since = export
+        table = TABLES_LIST[index]
+        outcome = outcomes[export]
+        if isinstance(outcome, Exception):
+            logger.error(f"Ingestion of {table} failed: {outcome}")
+            results[table] = "failed"
+        elif outcome.get("deferred"):
+            results[table] = "deferred"
+        elif outcome.get("skipped"):
+            results[table] = "unchanged"
+            set_watermark(watermarks, table, outcome["last_updated"])
+            seen[table] = outcome["last_updated"]
+        else:
+            results[table] = "updated"
+            set_watermark(watermarks, table, outcome["last_updated"])
+            seen[table] = outcome["last_updated"]
+            parts = outcome.get("parts") or [
+                {"key": bucket_keys[index],
+                 "row_count": outcome["row_count"]}]
+            manifest_files.extend({
+                "table": table, "key": part["key"],
+                "row_count": part["row_count"],
+                "watermark_from": since,
+                "watermark_to": outcome["last_updated"]} for part in parts)
+
+    if settings["delete_detection"]:
+        checked = [table for table in polled
+                   if results[table] not in ("failed", "deferred")]
+        tombstones = ingest_tombstones(
+            extract_pool, checked, BUCKET, dict(zip(TABLES_LIST, bucket_keys)),
+            catalog, settings, deadline)
+        unchecked = [table for table in checked
+                     if isinstance(tombstones[table], dict)
+                     and tombstones[table].get("deferred")]
+        if unchecked:
+            logger.warning(f"Out of time, leaving delete detection on "
+                           f"{unchecked} to the next run")
+        for table in checked:
+            if isinstance(tombstones[table], Exception):
+                logger.error(f"Delete detection on {table} failed: "
+                             f"{tombstones[table]}")
+                results[table] = "failed"
+            elif tombstones[table] is not None and table not in unchecked:
+                results[table] = "updated"
+                manifest_files.append({
+                    "table": table, "key": tombstones[table]["key"],
+                    "row_count": tombstones[table]["row_count"],
+                    "tombstones": True})
+    has_updated = "updated" in results.values()
+
+    if settings["layout"] == "delta" and has_updated:
+        write_manifest(BUCKET, run_at, run_id, manifest_files)
+    if settings["incremental"] and has_updated:
+        save_state_to_s3(BUCKET, WATERMARKS_KEY, watermarks)
+    if settings["skip_unchanged"] and has_updated:
+        save_state_to_s3(BUCKET, CONTENT_HASHES_KEY, content_hashes)
+    if use_stats and probed:
+        saved_stats.update({table: stats[table] for table in probed
+                            if table in stats and
+                            results[table] not in ("failed", "deferred")})
+        save_state_to_s3(BUCKET, TABLE_STATS_KEY, saved_stats)
+    if schedule is not None:
+        for table in TABLES_LIST:
+            update_poll_schedule(
+                schedule, table, table in polled, results[table],
+                seen[table], settings["max_skip_runs"])
+        save_state_to_s3(BUCKET, POLL_SCHEDULE_KEY, schedule)
+    update_work_plan(work_plan, results, durations)
+    if deadline is not None:
+        save_state_to_s3(BUCKET, WORK_PLAN_KEY, work_plan)
+
+    if settings["metrics_namespace"]:
+        for export in exports:
+            table = TABLES_LIST[export[0]]
+            if not isinstance(outcomes[export], Exception):
+                table_metrics[table].add_outcome(outcomes[export])
+        emit_table_metrics(settings["metrics_namespace"], results,
+                           table_metrics, check_seconds)
 
     if has_updated:
         logger.info("SUCCESSFUL INGESTION")
     else:
         logger.info("NO FILES TO UPDATE")
+    return results
+
+
+def get_ingestion_settings():
+    """ Reads the optional ingestion settings from the environment.
+
+    'TF_INCREMENTAL' is only honoured in the delta layout, as the
+    transformation Lambda reads a snapshot as the whole table.
+
+    Returns:
+        Dictionary of settings, falling back to defaults for any
+        variable that is not set.
+    """
+    settings = {
+        "interval": '3 minutes',
+        "incremental": os.environ.get('TF_INCREMENTAL', 'false') == 'true',
+        "overlap": os.environ.get('TF_WATERMARK_OVERLAP', '1 minute'),
+        "engine": os.environ.get('TF_INGESTION_ENGINE', 'select'),
+        "batch_size": int(os.environ.get('TF_STREAM_BATCH_SIZE', 5000)),
+        "workers": max(1, int(os.environ.get('TF_INGESTION_WORKERS', 1))),
+        "layout": os.environ.get('TF_INGESTION_LAYOUT', 'snapshot'),
+        "range_rows": int(os.environ.get('TF_RANGE_SCAN_ROWS', 0)),
+        "skip_unchanged":
+            os.environ.get('TF_SKIP_UNCHANGED', 'false') == 'true',
+        "format": os.environ.get('TF_INGESTION_FORMAT', 'csv'),
+        "metrics_namespace": os.environ.get(
+            'TF_METRICS_NAMESPACE', 'TotesysIngestion'),
+        "change_detection": os.environ.get('TF_CHANGE_DETECTION', 'probe'),
+        "max_skip_runs": int(os.environ.get('TF_POLL_MAX_SKIP_RUNS', 0)),
+        "delete_detection":
+            os.environ.get('TF_DELETE_DETECTION', 'false') == 'true',
+        "delete_leaf_keys": int(os.environ.get('TF_DELETE_LEAF_KEYS', 1024)),
+        "project_columns":
+            os.environ.get('TF_COLUMN_PROJECTION', 'false') == 'true',
+        "column_stats": os.environ.get('TF_COLUMN_STATS', 'false') == 'true',
+        "consistent_snapshot":
+            os.environ.get('TF_CONSISTENT_SNAPSHOT', 'false') == 'true',
+        "replica_hosts": [
+            host.strip() for host in
+            os.environ.get('TF_REPLICA_HOSTS', '').split(',') if host.strip()],
+        "replica_max_lag": float(os.environ.get('TF_REPLICA_MAX_LAG', 60)),
+        "probe_target": os.environ.get('TF_PROBE_TARGET', 'primary'),
+        "deadline_margin": float(os.environ.get('TF_DEADLINE_MARGIN', 10)),
+        "cdc_slot": os.environ.get('TF_CDC_SLOT', ''),
+        "cdc_max_changes": int(os.environ.get('TF_CDC_MAX_CHANGES', 100000))
+    }
+    if settings["incremental"] and settings["layout"] != "delta":
+        logger.warning("TF_INCREMENTAL needs TF_INGESTION_LAYOUT=delta, "
+                       "exporting whole tables")
+        settings["incremental"] = False
+    return settings
+
+
+class TableMetrics:
+    """ Adds up the time a table's export spends in each stage, along
+    with its row and byte counts.
+
+    Stages may be recorded from several threads when a table is range
+    scanned. The 'copy' engine uploads while its query runs, so its
+    query time includes its upload time.
+    """
+
+    STAGES = {"connect": "ConnectTime", "query": "QueryTime",
+              "encode": "EncodeTime", "upload": "UploadTime"}
+
+    def __init__(self):
+        self.values = {}
+        self._lock = threading.Lock()
+
+    def add(self, name, value):
+        """ Adds to a stage's time in seconds, or to a count.
+
+        Args:
+            name: The name of the stage or count.
+            value: The amount to add.
+        """
+        with self._lock:
+            self.values[name] = self.values.get(name, 0) + value
+
+    def add_outcome(self, summary):
+        """ Records the counts of a finished export.
+
+        Args:
+            summary: Dictionary returned by 'export_table'.
+        """
+        self.add("rows", summary.get("row_count") or 0)
+        if summary.get("byte_count") is not None:
+            self.add("bytes", summary["byte_count"])
+
+    def to_metrics(self, check_seconds, skipped):
+        """ Converts what was recorded to named metrics with units.
+
+        Args:
+            check_seconds: The time the shared change check took.
+            skipped: Whether nothing was written for the table.
+
+        Returns:
+            A dictionary of (value, unit) tuples keyed by metric name.
+        """
+        metrics = {"CheckTime": (round(check_seconds * 1000, 3),
+                                 "Milliseconds")}
+        for stage, name in self.STAGES.items():
+            metrics[name] = (round(self.values.get(stage, 0) * 1000, 3),
+                             "Milliseconds")
+        metrics["Rows"] = (self.values.get("rows", 0), "Count")
+        metrics["Bytes"] = (self.values.get("bytes", 0), "Bytes")
+        metrics["Skipped"] = (int(skipped), "Count")
+        return metrics
+
+
+@contextmanager
+def collect_metrics(metrics):
+    """ Records stages measured by this thread into 'metrics' for the
+    duration of a 'with' block.
+
+    Args:
+        metrics: A TableMetrics, or None to record nothing.
+
+    Yields:
+        The TableMetrics.
+    """
+    previous = getattr(_metrics_context, "metrics", None)
+    _metrics_context.metrics = metrics
+    try:
+        yield metrics
+    finally:
+        _metrics_context.metrics = previous
+
+
+def get_current_metrics():
+    """ Returns the TableMetrics this thread is recording into, or
+    None. """
+    return getattr(_metrics_context, "metrics", None)
+
+
+@contextmanager
+def measure(stage):
+    """ Times a 'with' block as part of a stage of the current table's
+    export, if one is being recorded.
+
+    Args:
+        stage: One of 'connect', 'query', 'encode' or 'upload'.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics = get_current_metrics()
+        if metrics is not None:
+            metrics.add(stage, time.perf_counter() - start)
+
+
+def emit_metrics(namespace, dimensions, metrics, properties=None):
+    """ Prints a record in CloudWatch Embedded Metric Format. Lambda
+    sends it to CloudWatch Logs, which turns it into metrics.
+
+    Args:
+        namespace: The CloudWatch namespace of the metrics.
+        dimensions: A dictionary of dimension values keyed by name.
+        metrics: A dictionary of (value, unit) tuples keyed by name.
+        (OPTIONAL) properties: Extra values logged with the record but
+        not turned into metrics.
+    """
+    record = {"_aws": {
+        "Timestamp": int(time.time() * 1000),
+        "CloudWatchMetrics": [{
+            "Namespace": namespace,
+            "Dimensions": [list(dimensions)],
+            "Metrics": [{"Name": name, "Unit": unit}
+                        for name, (value, unit) in metrics.items()]}]}}
+    record.update(dimensions)
+    record.update(properties or {})
+    record.update({name: value for name, (value, unit) in metrics.items()})
+    print(json.dumps(record, default=str))
+
+
+def emit_table_metrics(namespace, results, table_metrics, check_seconds):
+    """ Prints a metrics record for each table of a run.
+
+    Args:
+        namespace: The CloudWatch namespace of the metrics.
+        results: Dictionary of each table's result.
+        table_metrics: Dictionary of each table's TableMetrics.
+        check_seconds: The time the shared change check took.
+    """
+    for table in results:
+        emit_metrics(
+            namespace, {"Table": table},
+            table_metrics[table].to_metrics(
+                check_seconds, results[table] == "unchanged"),
+            {"Result": results[table]})
+
+
+def ingest_table(pool, table, column_headers, bucket_name, bucket_key,
+                 settings, since=None, column_types=None,
+                 content_hashes=None, snapshot=None):
+    """ Exports a table to S3 on a connection of its own from the pool.
+
+    Args:
+        pool: The ConnectionPool to take a connection from.
+        table: The name of the table.
+        column_headers: A list of the table's column headers.
+        bucket_name: The name of the bucket in S3.
+        bucket_key: The name of the file and path the data will
+        be stored in.
+        settings: Dictionary returned by 'get_ingestion_settings'.
+        (OPTIONAL) since: The table's watermark datetime, if it has one.
+        (OPTIONAL) column_types: A dictionary of data type names keyed
+        by column.
+        (OPTIONAL) content_hashes: A dictionary of the hash of each
+        table's last upload, updated in place.
+        (OPTIONAL) snapshot: The id of an exported snapshot to read
+        the table as of.
+
+    Returns:
+        Dictionary returned by 'export_table'.
+    """
+    with pool.connection() as conn:
+        return export_table(
+            conn, settings["engine"], table, column_headers, bucket_name,
+            bucket_key, since=since, overlap=settings["overlap"],
+            batch_size=settings["batch_size"], column_types=column_types,
+            content_hashes=content_hashes, file_format=settings["format"],
+            snapshot=snapshot, column_stats=settings["column_stats"])
+
+
+def run_tasks(function, items, workers=1):
+    """ Calls a function for each item, concurrently when more than one
+    worker is allowed, collecting errors instead of raising them.
+
+    Args:
+        function: A callable taking a single item.
+        items: The items to call the function with.
+        (OPTIONAL) workers: The most calls allowed to run at once.
+
+    Returns:
+        Dictionary keyed by item holding each call's return value, or
+        the exception it raised.
+    """
+    outcomes = {}
+    if workers <= 1:
+        for item in items:
+            try:
+                outcomes[item] = function(item)
+            except Exception as e:
+                outcomes[item] = e
+        return outcomes
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(function, item): item for item in items}
+        for future in as_completed(futures):
+            try:
+                outcomes[futures[future]] = future.result()
+            except Exception as e:
+                outcomes[futures[future]] = e
+    return outcomes
+
+
+def get_s3_client():
+    """ Returns the S3 client, creating it on first use.
+
+    Returns:
+        A boto3 S3 client, shared by all threads.
+    """
+    global _s3_client
+    if _s3_client is None:
+        _s3_client = boto3.client("s3")
+    return _s3_client
+
+
+def get_secrets_client():
+    """ Returns the SecretsManager client, creating it on first use.
 
+    Returns:
+        A boto3 SecretsManager client.
+    """
+    global _secrets_client
+    if _secrets_client is None:
+        _secrets_client = boto3.client("secretsmanager")
+    return _secrets_client
 
-def get_secret_value(secret_name):
+
+def get_secret_value(secret_name, force_refresh=False):
     """ Finds data for a specified secret on SecretsManager.
 
+    Secrets are cached for 'TF_SECRET_CACHE_TTL' seconds so warm
+    invocations do not call SecretsManager again.
+
     Args:
         secret_id: The Secret Name that holds the username and password
         for your database.
+        (OPTIONAL) force_refresh: Fetch the secret even if it is cached,
+        for example after the cached credentials were rejected.
 
     Returns:
         Dictionary containing data on secret.
@@ -80,6 +661,12 @@ def get_secret_value(secret_name):
         UnrecognizedClientException
         RuntimeError
     """
+    ttl = float(os.environ.get('TF_SECRET_CACHE_TTL', 300))
+    cached = _secret_cache.get(secret_name)
+    if cached is not None and not force_refresh and \
+            time.monotonic() - cached[0] < ttl:
+        return cached[1]
+    secrets = get_secrets_client()
     try:
         secret_value = secrets.get_secret_value(SecretId=secret_name)
     except secrets.exceptions.ResourceNotFoundException as e:
@@ -97,6 +684,7 @@ def get_secret_value(secret_name):
         raise RuntimeError
     else:
         secrets_dict = json.loads(secret_value["SecretString"])
+        _secret_cache[secret_name] = (time.monotonic(), secrets_dict)
         return secrets_dict
 
 
@@ -132,71 +720,423 @@ def get_connection(credentials):
             raise e
 
 
-def get_keys_from_table_names(tables, file_path=""):
+def is_authentication_error(error):
+    """ Checks whether a database error means the credentials were
+    rejected.
+
+    Args:
+        error: An exception raised while connecting.
+
+    Returns:
+        A boolean for whether the error is an authentication failure.
+    """
+    if not isinstance(error, pge.DatabaseError) or not error.args:
+        return False
+    details = error.args[0]
+    return isinstance(details, dict) and \
+        details.get("C") in ("28000", "28P01")
+
+
+def is_connection_healthy(conn):
+    """ Checks an open connection can still reach the database.
+
+    Args:
+        conn: An open database Connection.
+
+    Returns:
+        A boolean for whether the connection answered a trivial query.
+    """
+    try:
+        conn.run("SELECT 1;")
+    except (pge.InterfaceError, pge.DatabaseError, OSError):
+        return False
+    else:
+        return True
+
+
+def close_connection(conn):
+    """ Closes a connection, ignoring errors from one that is already
+    broken.
+
+    Args:
+        conn: An open database Connection.
+    """
+    try:
+        conn.close()
+    except (pge.InterfaceError, pge.DatabaseError, OSError) as e:
+        logger.warning(f"Connection did not close cleanly: {e}")
+
+
+class ConnectionPool:
+    """ Holds open database connections so they can be reused between
+    queries and across warm invocations of the same Lambda container.
+
+    Connections are health-checked when taken from the pool and
+    replaced if they have gone stale.
+
+    Args:
+        credentials: The credentials required to access the database
+        stored in secretsmanager as a dictionary.
+        max_size: The number of idle connections kept open.
+        refresh_credentials: A callable returning fresh credentials,
+        tried once if the database rejects the current ones.
+        max_open: The most connections open at once, lent or idle.
+        Taking another waits until one is returned. Unlimited if None.
+    """
+
+    def __init__(self, credentials, max_size=1, refresh_credentials=None,
+                 max_open=None):
+        self.credentials = credentials
+        self.max_size = max_size
+        self.refresh_credentials = refresh_credentials
+        self.max_open = max_open
+        self._idle = []
+        self._open = 0
+        self._lock = threading.Lock()
+        self._available = threading.Condition(self._lock)
+
+    def acquire(self):
+        """ Takes a healthy connection from the pool, opening a new one
+        if none are idle and fewer than 'max_open' are open.
+
+        Returns:
+            An instance of the Connection Class.
+        """
+        while True:
+            with self._available:
+                while not self._idle and self.max_open is not None and \
+                        self._open >= self.max_open:
+                    self._available.wait()
+                conn = self._idle.pop() if self._idle else None
+                if conn is None:
+                    self._open += 1
+            if conn is None:
+                try:
+                    return self._connect()
+                except BaseException:
+                    self._discard()
+                    raise
+            if is_connection_healthy(conn):
+                return conn
+            logger.info("Discarding stale database connection")
+            self._discard(conn)
+
+    def _discard(self, conn=None):
+        if conn is not None:
+            close_connection(conn)
+        with self._available:
+            self._open -= 1
+            self._available.notify()
+
+    def _connect(self):
+        try:
+            return get_connection(self.credentials)
+        except pge.DatabaseError as e:
+            if self.refresh_credentials is None or \
+                    not is_authentication_error(e):
+                raise e
+            logger.info("Database rejected credentials, refreshing secret")
+            self.credentials = self.refresh_credentials()
+            return get_connection(self.credentials)
+
+    def release(self, conn):
+        """ Returns a connection to the pool, closing it if the pool is
+        already full.
+
+        Args:
+            conn: A connection previously taken with 'acquire'.
+        """
+        with self._available:
+            if len(self._idle) < self.max_size:
+                self._idle.append(conn)
+                self._available.notify()
+                return
+        self._discard(conn)
+
+    @contextmanager
+    def connection(self):
+        """ Lends a pooled connection for the duration of a 'with' block.
+
+        The connection is closed rather than returned to the pool if the
+        block raises, as it may be left mid-transaction.
+
+        Yields:
+            An instance of the Connection Class.
+        """
+        with measure("connect"):
+            conn = self.acquire()
+        try:
+            yield conn
+        except BaseException:
+            self._discard(conn)
+            raise
+        else:
+            self.release(conn)
+
+    def close(self):
+        """ Closes every idle connection held by the pool. """
+        with self._available:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            self._discard(conn)
+
+
+def get_connection_pool(credentials, max_size=1, refresh_credentials=None):
+    """ Returns the connection pool for this Lambda container, creating
+    it on first use or when the credentials have changed.
+
+    Args:
+        credentials: The credentials required to access the database
+        stored in secretsmanager as a dictionary.
+        max_size: The number of idle connections the pool should keep,
+        which is also the most it opens at once.
+        refresh_credentials: A callable returning fresh credentials,
+        tried once if the database rejects the current ones.
+
+    Returns:
+        An instance of the ConnectionPool Class.
+    """
+    global _connection_pool
+    if _connection_pool is None or \
+            _connection_pool.credentials != credentials:
+        if _connection_pool is not None:
+            _connection_pool.close()
+        _connection_pool = ConnectionPool(credentials, max_size,
+                                          refresh_credentials, max_size)
+    else:
+        _connection_pool.max_size = max(_connection_pool.max_size, max_size)
+        _connection_pool.max_open = _connection_pool.max_size
+        _connection_pool.refresh_credentials = refresh_credentials
+    return _connection_pool
+
+
+def get_replica_credentials(credentials, host):
+    """ Builds the credentials of a read replica, which shares the
+    primary's user, password and database.
+
+    Args:
+        credentials: The credentials of the primary database.
+        host: The replica's host, optionally followed by ':port'.
+
+    Returns:
+        A copy of the credentials pointing at the replica.
+    """
+    host, _, port = host.partition(":")
+    return dict(credentials, host=host,
+                port=int(port) if port else credentials["port"])
+
+
+def get_replica_pools(credentials, hosts, max_size=1,
+                      refresh_credentials=None):
+    """ Returns a connection pool for each read replica, keeping the
+    pools of warm invocations while their credentials are unchanged.
+
+    Args:
+        credentials: The credentials of the primary database.
+        hosts: A list of replica hosts, each optionally with ':port'.
+        max_size: The number of idle connections each pool should keep.
+        refresh_credentials: A callable returning fresh credentials of
+        the primary, tried once if a replica rejects the current ones.
+
+    Returns:
+        Dictionary of ConnectionPools keyed by host.
+    """
+    global _replica_pools
+    pools = {}
+    for host in hosts:
+        replica = get_replica_credentials(credentials, host)
+        pool = _replica_pools.pop(host, None)
+        if pool is None or pool.credentials != replica:
+            if pool is not None:
+                pool.close()
+            pool = ConnectionPool(replica, max_size, max_open=max_size)
+        pool.max_size = max(pool.max_size, max_size)
+        pool.max_open = pool.max_size
+        if refresh_credentials is not None:
+            pool.refresh_credentials = lambda host=host: \
+                get_replica_credentials(refresh_credentials(), host)
+        pools[host] = pool
+    for pool in _replica_pools.values():
+        pool.close()
+    _replica_pools = pools
+    return pools
+
+
+def sql_replica_lag(conn):
+    """ Queries a server for how far it is behind the primary.
+
+    Args:
+        conn: An open database Connection.
+
+    Returns:
+        The seconds since the last replayed transaction committed on the
+        primary, 0.0 if nothing has been replayed yet, or None if the
+        server is not a replica.
+    """
+    lag = conn.run(
+        "SELECT CASE WHEN pg_is_in_recovery() THEN COALESCE(extract("
+        "epoch FROM now() - pg_last_xact_replay_timestamp()), 0) END;")[0][0]
+    return None if lag is None else float(lag)
+
+
+def choose_replica(pools, max_lag):
+    """ Picks the read replica least behind the primary.
+
+    The lag is the time since the last transaction the replica replayed,
+    so a replica of an idle primary looks as far behind as the primary
+    has been idle.
+
+    Args:
+        pools: Dictionary of ConnectionPools keyed by host.
+        max_lag: The most seconds a replica may be behind to be used.
+
+    Returns:
+        The ConnectionPool of the chosen replica, or None if none can
+        be reached within 'max_lag'.
+    """
+    lags = {}
+    for host, pool in pools.items():
+        try:
+            with pool.connection() as conn:
+                lag = sql_replica_lag(conn)
+        except (pge.InterfaceError, pge.DatabaseError, OSError) as e:
+            logger.warning(f"Replica {host} is unavailable: {e}")
+            continue
+        if lag is None:
+            logger.warning(f"{host} is not a replica, ignoring it")
+        elif lag <= max_lag:
+            lags[host] = lag
+    if not lags:
+        logger.info("No replica is within the lag limit, using the primary")
+        return None
+    host = min(lags, key=lags.get)
+    logger.info(f"Reading from replica {host}, {lags[host]:.1f}s behind")
+    return pools[host]
+
+
+def get_keys_from_table_names(tables, file_path="", extension="csv"):
     """ Appends '.csv' to items in list.
 
     Args:
         tables: A list of table names.
         (OPTIONAL) file_path : Add a file path for a folder-like
         structure in S3.
+        (OPTIONAL) extension: The file extension to append instead of
+        'csv'.
 
     Returns:
         A list of table names with appended file extension.
     """
-    return [f"{file_path}{table_name}.csv" for table_name in tables]
+    return [f"{file_path}{table_name}.{extension}" for table_name in tables]
 
 
-def sql_select_column_headers(credentials, table):
-    """ Queries database find column headers for a table.
+def get_delta_key(table, run_at, run_id, extension="csv"):
+    """ Builds a time-partitioned key for one run's export of a table.
 
     Args:
-        credentials: The credentials required to access the database
-        stored in secretsmanager as a dictionary.
         table: The name of a table.
+        run_at: The datetime the run started.
+        run_id: A string identifying the run.
+        (OPTIONAL) extension: The file extension of the export.
 
     Returns:
-        A list of column headers for that table.
+        A key of the form 'table/date=YYYY-MM-DD/HHMMSS-run_id.csv'.
+    """
+    return (f"{table}/date={run_at:%Y-%m-%d}/"
+            f"{run_at:%H%M%S}-{run_id}.{extension}")
 
-    Raises:
-        Database Error
+
+def write_manifest(bucket_name, run_at, run_id, files):
+    """ Writes a manifest listing the objects a run added, both under a
+    key of its own and as the latest manifest.
+
+    Args:
+        bucket_name: The name of the bucket in S3.
+        run_at: The datetime the run started.
+        run_id: A string identifying the run.
+        files: A list of dictionaries describing each object, with its
+        'table', 'key', 'row_count' and watermark range.
+
+    Returns:
+        The key the manifest was written to.
     """
-    conn = get_connection(credentials)
-    try:
-        conn.run(f"SELECT * FROM {table} LIMIT 0;")
-    except pge.DatabaseError as e:
-        logger.error(f"DatabaseError: {table} does not exist in database")
-        raise e
-    else:
-        return [column['name'] for column in conn.columns]
+    manifest = {"run_id": run_id, "run_at": run_at.isoformat(),
+                "files": files}
+    manifest_key = (f"{MANIFEST_PREFIX}date={run_at:%Y-%m-%d}/"
+                    f"{run_at:%H%M%S}-{run_id}.json")
+    save_state_to_s3(bucket_name, manifest_key, manifest)
+    save_state_to_s3(bucket_name, LATEST_MANIFEST_KEY, manifest)
+    return manifest_key
 
 
-def collect_column_headers(credentials, tables):
-    """ Collects column headers from sql query into a list.
+def build_select_list(columns=None):
+    """ Builds the select list for a list of columns.
 
     Args:
-        credentials: The credentials required to access the database.
-        stored in secretsmanager as a dictionary.
-        table: A list of table names.
+        (OPTIONAL) columns: A list of column names.
+
+    Returns:
+        The columns separated by commas, or '*' if there are none.
+    """
+    return ", ".join(columns) if columns else "*"
+
+
+def get_projected_columns(table, column_headers, projection):
+    """ Narrows a table's columns to those read downstream, always
+    keeping the 'last_updated' watermark column.
+
+    Args:
+        table: The name of a table.
+        column_headers: A list of the table's column headers, in order.
+        projection: A dictionary of the columns to keep keyed by table,
+        or None to keep every column. Tables it does not list keep
+        every column.
 
     Returns:
-        A collection of nested lists containing all table headers.
+        A list of the kept column headers, in table order.
     """
-    table_headers_list = []
-    for table in tables:
-        column_header = sql_select_column_headers(credentials, table)
-        logging.info(column_header)
-        table_headers_list.append(column_header)
+    if projection is None or table not in projection:
+        return column_headers
+    kept = set(projection[table]) | {"last_updated"}
+    return [column for column in column_headers if column in kept]
+
+
+def build_select_query(table, since=None, overlap=None, select_list="*"):
+    """ Builds the query used to export a table.
+
+    Args:
+        table: The name of the table to get data from.
+        (OPTIONAL) since: A watermark datetime; only rows with a later
+        'last_updated' are selected.
+        (OPTIONAL) overlap: An interval subtracted from 'since'.
+        (OPTIONAL) select_list: The columns or expressions to select.
 
-    return table_headers_list
+    Returns:
+        A tuple of the query string and a dictionary of its parameters.
+    """
+    if since is None:
+        return f"SELECT {select_list} FROM {table};", {}
+    return (
+        f"SELECT {select_list} FROM {table} WHERE last_updated > "
+        "CAST(:since AS timestamp) - CAST(:overlap AS interval);",
+        {"since": since, "overlap": overlap or "0 seconds"}
+    )
 
 
-def sql_select_query(credentials, table):
+def sql_select_query(conn, table, since=None, overlap=None, snapshot=None,
+                     columns=None):
     """ Queries database to select all data from a table.
 
     Args:
-        credentials: The credentials required to access the database
-        stored in secretsmanager as a dictionary.
+        conn: An open database Connection.
         table: The name of the table to get data from.
+        (OPTIONAL) since: A watermark datetime; only rows with a later
+        'last_updated' are selected.
+        (OPTIONAL) overlap: An interval subtracted from 'since' to pick
+        up rows written late because of clock skew.
+        (OPTIONAL) snapshot: The id of an exported snapshot to read
+        the table as of.
+        (OPTIONAL) columns: The columns to select, all if not given.
 
     Returns:
         A collection of nested lists of row data
@@ -204,104 +1144,2232 @@ def sql_select_query(credentials, table):
     Raises:
         DatabaseError
     """
-    conn = get_connection(credentials)
+    query, params = build_select_query(table, since, overlap,
+                                       build_select_list(columns))
     try:
-        return conn.run(f"SELECT * FROM {table};")
+        if snapshot is None:
+            return conn.run(query, **params)
+        sql_start_read_transaction(conn, snapshot)
+        rows = conn.run(query, **params)
+        conn.run("COMMIT;")
+        return rows
     except pge.DatabaseError as e:
         logger.error(f"DatabaseError: {table} does not exist in database")
         raise e
 
 
-def sql_check_updated(credentials, table, interval):
-    """ Queries database to check a table has been updated since the
-    last interval.
+def sql_probe_tables(conn, tables, interval):
+    """ Queries database once for the latest 'last_updated' value and
+    estimated row count of every table.
+
+    The row count is the planner's 'pg_class.reltuples' estimate, kept
+    up to date by autovacuum, so no table is counted row by row.
 
     Args:
-        credentials: The credentials required to access the database
-        stored in secretsmanager as a dictionary.
-        table: The name of the table to get data from.
+        conn: An open database Connection.
+        tables: A list of table names.
         interval: A length of time going backwards from 'now' to check
         against the 'last_updated' column.
 
     Returns:
-        A boolean for whether the table has been updated.
+        Dictionary keyed by table name of dictionaries holding the
+        'last_updated' datetime, the estimated 'row_count' (None if the
+        table has never been analysed) and whether the table
+        'is_recent'ly updated within the interval.
 
     Raises:
         DatabaseError
     """
-    conn = get_connection(credentials)
+    query = " UNION ALL ".join(
+        f"SELECT {literal(table)}, max(last_updated), (SELECT CAST("
+        "reltuples AS bigint) FROM pg_class WHERE oid = CAST("
+        f"{literal(table)} AS regclass)), "
+        "max(last_updated) > now() - CAST(:interval AS interval) "
+        f"FROM {table}" for table in tables)
     try:
-        updated = conn.run(
-            f"SELECT last_updated FROM {table} WHERE "
-            f"last_updated > now() - INTERVAL '{interval}' LIMIT 1;"
-        )
+        rows = conn.run(f"{query};", interval=interval)
     except pge.DatabaseError as e:
-        logger.error(f"DatabaseError: {table} does not exist in database")
+        logger.error(f"DatabaseError: unable to probe tables {tables}")
         raise e
-    else:
-        return True if len(updated) != 0 else False
+    return {table: {"last_updated": last_updated,
+                    "row_count": row_count if row_count is None or
+                    row_count >= 0 else None,
+                    "is_recent": bool(is_recent)}
+            for table, last_updated, row_count, is_recent in rows}
 
 
-def check_key_exists(bucket_name, bucket_key):
-    """ Checks if key exists in s3.
+def has_table_changed(probe, since=None):
+    """ Decides from a probe result whether a table needs exporting.
 
     Args:
-        bucket_name: The name of the bucket containing the file.
-        bucket_key: The filepath and name of the file in s3.
+        probe: The table's entry from 'sql_probe_tables', or None if it
+        was not probed.
+        (OPTIONAL) since: The table's watermark datetime, if it has one.
 
     Returns:
-        A boolean for whether the key exists.
+        A boolean for whether the table has changed.
     """
-    try:
-        s3_client.head_object(Bucket=bucket_name, Key=bucket_key)
-    except botocore.exceptions.ClientError as e:
-        if e.response["Error"]["Code"] == "404":
-            return False
-    else:
+    if probe is None:
         return True
+    if since is None:
+        return probe["is_recent"]
+    return probe["last_updated"] is not None and \
+        probe["last_updated"] > since
 
 
-def data_to_bucket_csv_file(
-    credentials, table_name, column_headers, bucket_name, bucket_key
-):
-    """ Takes data collected from 'sql_get_all_data' function
-        and uploads it to S3 as a csv file.
+def sql_table_stats(conn, tables):
+    """ Queries database once for the insert, update and delete counters
+    PostgreSQL keeps for every table.
+
+    Reading the counters costs the same whatever the size of the table.
+    They are kept per server, so they must be read from the primary.
 
     Args:
-        table_name: The name of the table to get data from.
-        column_headers: A collection of nested lists containing
-        table headers.
-        bucket_name: The name of the bucket in S3.
-        bucket_key: The name of the file and path the data will
-        be stored in.
+        conn: An open database Connection.
+        tables: A list of table names.
 
     Returns:
-        Formated data as a list of dictionaries.
+        Dictionary keyed by table name of lists of the 'n_tup_ins',
+        'n_tup_upd' and 'n_tup_del' counters.
 
     Raises:
-        NoSuchBucket
-        ParamValidationError
+        DatabaseError
     """
-    data_from_table = sql_select_query(credentials, table_name)
-    rows_list = []
-    for row in data_from_table:
-        row_data_dict = {}
-        for index, column in enumerate(column_headers):
-            row_data_dict[column] = row[index]
-        rows_list.append(row_data_dict)
-    df = pd.DataFrame(data=rows_list, columns=column_headers)
-    csv_buffer = StringIO()
-    df.to_csv(csv_buffer, index=False)
-
     try:
-        s3_resource.Object(bucket_name, bucket_key).put(
-            Body=csv_buffer.getvalue())
-    except botocore.errorfactory.ClientError as e:
-        if e.response["Error"]["Code"] == "NoSuchBucket":
-            logger.error(f"{bucket_name} does not exist in your S3")
-            raise e
-    except botocore.exceptions.ParamValidationError as e:
-        logger.error("The request has invalid params")
+        rows = conn.run(
+            "SELECT relname, n_tup_ins, n_tup_upd, n_tup_del "
+            "FROM pg_stat_user_tables WHERE schemaname = current_schema() "
+            "AND relname = ANY(:tables);", tables=tables)
+    except pge.DatabaseError as e:
+        logger.error(f"DatabaseError: unable to read statistics of {tables}")
         raise e
-    else:
-        return rows_list
+    return {table: [inserted, updated, deleted]
+            for table, inserted, updated, deleted in rows}
+
+
+def has_stats_changed(stats, saved_stats, table):
+    """ Decides from its counters whether a table has changed since they
+    were saved.
+
+    Any difference counts as a change, as the counters go back to zero
+    when statistics are reset.
+
+    Args:
+        stats: Dictionary returned by 'sql_table_stats'.
+        saved_stats: The counters saved by an earlier run, keyed by table.
+        table: The name of a table.
+
+    Returns:
+        A boolean for whether the table has changed, True if it has no
+        counters.
+    """
+    current = stats.get(table)
+    return current is None or current != saved_stats.get(table)
+
+
+def is_poll_due(schedule, table):
+    """ Decides whether a table should be polled for changes this run.
+
+    Args:
+        schedule: Dictionary kept by 'update_poll_schedule', or None if
+        every table is polled every run.
+        table: The name of a table.
+
+    Returns:
+        A boolean for whether the table is polled.
+    """
+    return schedule is None or schedule.get(table, {}).get("skip", 0) <= 0
+
+
+def get_poll_seen(schedule, table):
+    """ Looks up the latest 'last_updated' value seen when a table was
+    last polled, so changes made during skipped runs are still noticed.
+
+    Args:
+        schedule: Dictionary kept by 'update_poll_schedule', or None.
+        table: The name of a table.
+
+    Returns:
+        The value as a datetime, or None if there is none.
+    """
+    seen = (schedule or {}).get(table, {}).get("last_updated")
+    return datetime.fromisoformat(seen) if seen else None
+
+
+def update_poll_schedule(schedule, table, polled, result, last_updated,
+                         max_skip_runs):
+    """ Records the outcome of a run for a table and works out how many
+    runs to skip before polling it again.
+
+    Each poll that finds a table unchanged doubles its back-off, so it
+    skips 1, 3, 7... runs up to 'max_skip_runs'. A change, or a failed
+    or deferred export, puts it back to being polled every run.
+
+    Args:
+        schedule: Dictionary of each table's 'quiet' polls in a row,
+        runs left to 'skip' and the 'last_updated' value seen, updated
+        in place.
+        table: The name of a table.
+        polled: Whether the table was polled this run.
+        result: The table's result, 'updated', 'unchanged', 'failed' or
+        'deferred'.
+        last_updated: The latest 'last_updated' datetime the poll saw.
+        max_skip_runs: The most runs skipped between polls.
+    """
+    entry = schedule.setdefault(table, {"quiet": 0, "skip": 0})
+    if not polled:
+        entry["skip"] = max(entry["skip"] - 1, 0)
+        return
+    if result in ("failed", "deferred"):
+        entry["skip"] = 0
+        return
+    entry["quiet"] = entry["quiet"] + 1 if result == "unchanged" else 0
+    entry["skip"] = min(2 ** entry["quiet"] - 1, max_skip_runs)
+    if last_updated is not None:
+        entry["last_updated"] = last_updated.isoformat()
+
+
+def get_deadline(context, margin):
+    """ Works out when a run should stop starting new work.
+
+    Args:
+        context: The Lambda context object.
+        margin: Seconds to keep back before the timeout for saving state.
+
+    Returns:
+        The deadline as a 'time.monotonic' value, or None if the context
+        does not report the time remaining, as outside of Lambda.
+    """
+    remaining = getattr(context, "get_remaining_time_in_millis", None)
+    if remaining is None:
+        return None
+    return time.monotonic() + remaining() / 1000 - margin
+
+
+def order_work(items, costs, deferred=()):
+    """ Orders work so the items a previous run ran out of time for go
+    first, then the rest from the longest estimate down, leaving the
+    quickest to fill whatever time remains.
+
+    Args:
+        items: The names of the items to order.
+        costs: Dictionary of each item's estimated seconds.
+        (OPTIONAL) deferred: The items left over by the previous run.
+
+    Returns:
+        A new list of the items. Items with equal estimates, or none,
+        keep their order.
+    """
+    return sorted(items, key=lambda item: (
+        item not in deferred, -costs.get(item, 0)))
+
+
+def fits_deadline(deadline, estimate=None):
+    """ Checks whether there is time left to start an item of work.
+
+    Args:
+        deadline: The 'time.monotonic' deadline, or None for no limit.
+        (OPTIONAL) estimate: The item's estimated seconds, if known.
+
+    Returns:
+        A boolean for whether the item is expected to finish in time.
+    """
+    return deadline is None or time.monotonic() + (estimate or 0) < deadline
+
+
+def update_cost_estimate(costs, item, seconds):
+    """ Folds the time an item took into its cost estimate, weighting
+    recent runs by 'COST_SMOOTHING'.
+
+    Args:
+        costs: Dictionary of each item's estimated seconds, updated in
+        place.
+        item: The name of the item.
+        seconds: The time the item took this run.
+    """
+    previous = costs.get(item)
+    costs[item] = round(seconds if previous is None else COST_SMOOTHING *
+                        seconds + (1 - COST_SMOOTHING) * previous, 3)
+
+
+def update_work_plan(work_plan, results, durations):
+    """ Records the tables a run deferred and the time the others took.
+
+    Args:
+        work_plan: Dictionary of each table's estimated seconds under
+        'costs' and the deferred tables under 'deferred', updated in
+        place.
+        results: Dictionary of each table's result.
+        durations: Dictionary of the seconds each exported table took.
+    """
+    work_plan["deferred"] = [table for table in results
+                             if results[table] == "deferred"]
+    if work_plan["deferred"]:
+        logger.warning(f"Out of time, deferring {work_plan['deferred']} "
+                       "to the next run")
+    for table, seconds in durations.items():
+        update_cost_estimate(work_plan["costs"], table, seconds)
+
+
+def list_key_states(bucket_name, bucket_keys):
+    """ Looks up the state of many top-level keys with a single listing
+    of the bucket root, rather than one HEAD request per key.
+
+    Args:
+        bucket_name: The name of the bucket containing the files.
+        bucket_keys: A list of keys in the bucket root. A key ending in
+        '/' is treated as a folder, which exists if any key is under it.
+
+    Returns:
+        A dictionary keyed by bucket key of dictionaries holding
+        'exists', 'size', 'etag' and 'last_modified' (None for folders
+        and missing keys).
+    """
+    objects = {}
+    folders = set()
+    paginator = get_s3_client().get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=bucket_name, Delimiter="/"):
+        for item in page.get("Contents", []):
+            objects[item["Key"]] = item
+        for prefix in page.get("CommonPrefixes", []):
+            folders.add(prefix["Prefix"])
+
+    states = {}
+    for key in bucket_keys:
+        item = objects.get(key, {})
+        states[key] = {"exists": bool(item) or key in folders,
+                       "size": item.get("Size"),
+                       "etag": item.get("ETag"),
+                       "last_modified": item.get("LastModified")}
+    return states
+
+
+def data_to_bucket_csv_file(
+    conn, table_name, column_headers, bucket_name, bucket_key,
+    since=None, overlap=None, content_hashes=None, snapshot=None,
+    column_stats=False
+):
+    """ Takes data collected from 'sql_get_all_data' function
+        and uploads it to S3 as a csv file.
+
+    Args:
+        conn: An open database Connection.
+        table_name: The name of the table to get data from.
+        column_headers: A collection of nested lists containing
+        table headers.
+        bucket_name: The name of the bucket in S3.
+        bucket_key: The name of the file and path the data will
+        be stored in.
+        (OPTIONAL) since: A watermark datetime; only rows updated after
+        it are exported.
+        (OPTIONAL) overlap: An interval subtracted from 'since'.
+        (OPTIONAL) content_hashes: A dictionary of the hash of each
+        table's last upload; the upload is skipped if it is unchanged.
+        (OPTIONAL) snapshot: The id of an exported snapshot to read
+        the table as of.
+        (OPTIONAL) column_stats: Whether to write statistics of each
+        column to a JSON sidecar next to the file.
+
+    Returns:
+        A dictionary of the 'row_count', 'byte_count' (None, as the
+        bytes are recorded directly) and latest 'last_updated' value
+        exported.
+
+    Raises:
+        NoSuchBucket
+        ParamValidationError
+    """
+    with measure("query"):
+        data_from_table = sql_select_query(conn, table_name, since, overlap,
+                                           snapshot, column_headers)
+    updated_index = column_headers.index("last_updated") \
+        if "last_updated" in column_headers else None
+    summary = {"row_count": len(data_from_table), "byte_count": None,
+               "last_updated": None}
+
+    stats = ColumnStats(column_headers) if column_stats else None
+
+    def track_rows(rows):
+        for row in rows:
+            value = row[updated_index] if updated_index is not None \
+                else None
+            if value is not None and (summary["last_updated"] is None or
+                                      value > summary["last_updated"]):
+                summary["last_updated"] = value
+            if stats is not None:
+                stats.add(row)
+            yield row
+
+    with measure("encode"):
+        body = encode_csv_rows(track_rows(data_from_table), column_headers)
+
+    content_hash = None
+    if content_hashes is not None:
+        content_hash = hashlib.sha256(body).hexdigest()
+        if content_hashes.get(table_name) == content_hash:
+            logger.info(f"{bucket_key} is unchanged, skipping upload")
+            return summary
+
+    try:
+        with measure("upload"):
+            get_s3_client().put_object(Bucket=bucket_name, Key=bucket_key,
+                                       Body=body)
+        metrics = get_current_metrics()
+        if metrics is not None:
+            metrics.add("bytes", len(body))
+    except botocore.errorfactory.ClientError as e:
+        if e.response["Error"]["Code"] == "NoSuchBucket":
+            logger.error(f"{bucket_name} does not exist in your S3")
+        raise e
+    except botocore.exceptions.ParamValidationError as e:
+        logger.error("The request has invalid params")
+        raise e
+    if content_hash is not None:
+        content_hashes[table_name] = content_hash
+    if stats is not None:
+        save_state_to_s3(bucket_name, get_stats_key(bucket_key),
+                         stats.to_dict())
+    return summary
+
+
+def load_state_from_s3(bucket_name, state_key, default=None):
+    """ Reads a small JSON state object from S3.
+
+    Args:
+        bucket_name: The name of the bucket holding the state.
+        state_key: The key of the state object.
+        default: The value returned if the object does not exist yet.
+
+    Returns:
+        The decoded state, or 'default' if there is none.
+
+    Raises:
+        ClientError
+    """
+    try:
+        response = get_s3_client().get_object(
+            Bucket=bucket_name, Key=state_key)
+    except botocore.exceptions.ClientError as e:
+        if e.response["Error"]["Code"] == "NoSuchKey":
+            return default
+        logger.error(f"Unable to read state {state_key} from {bucket_name}")
+        raise e
+    else:
+        return json.loads(response["Body"].read())
+
+
+def save_state_to_s3(bucket_name, state_key, state):
+    """ Writes a small JSON state object to S3.
+
+    Args:
+        bucket_name: The name of the bucket holding the state.
+        state_key: The key of the state object.
+        state: A JSON serialisable value.
+
+    Raises:
+        ClientError
+    """
+    try:
+        get_s3_client().put_object(Bucket=bucket_name, Key=state_key,
+                                   Body=json.dumps(state, default=str))
+    except botocore.exceptions.ClientError as e:
+        logger.error(f"Unable to write state {state_key} to {bucket_name}")
+        raise e
+
+
+def get_watermark(watermarks, table):
+    """ Looks up the high-water mark saved for a table.
+
+    Args:
+        watermarks: A dictionary of ISO format datetimes keyed by table.
+        table: The name of a table.
+
+    Returns:
+        The watermark as a datetime, or None if there is none yet.
+    """
+    watermark = watermarks.get(table)
+    return datetime.fromisoformat(watermark) if watermark else None
+
+
+def get_latest_in_batch(rows, updated_index, latest=None):
+    """ Finds the latest 'last_updated' value in a batch of row lists.
+
+    Args:
+        rows: A collection of nested lists of row data.
+        updated_index: The position of 'last_updated' in each row, or
+        None if the table has no such column.
+        (OPTIONAL) latest: The latest value seen in earlier batches.
+
+    Returns:
+        The later of 'latest' and the batch's latest datetime.
+    """
+    if updated_index is None:
+        return latest
+    return max((value for value in [latest] + [
+        row[updated_index] for row in rows] if value is not None),
+        default=None)
+
+
+def set_watermark(watermarks, table, latest):
+    """ Moves a table's high-water mark up to the latest 'last_updated'
+    value exported.
+
+    Args:
+        watermarks: A dictionary of ISO format datetimes keyed by table.
+        table: The name of a table.
+        latest: The latest 'last_updated' datetime exported, or None.
+    """
+    current = get_watermark(watermarks, table)
+    if latest is not None and (current is None or latest > current):
+        watermarks[table] = latest.isoformat()
+
+
+def export_table(
+    conn, engine, table_name, column_headers, bucket_name, bucket_key,
+    since=None, overlap=None, batch_size=5000, column_types=None,
+    content_hashes=None, file_format="csv", snapshot=None,
+    column_stats=False
+):
+    """ Exports a table to S3 with the chosen export engine.
+
+    Parquet files are always read through a server-side cursor, as only
+    CSV can be encoded by the other engines.
+
+    Args:
+        conn: An open database Connection.
+        engine: One of 'select', 'stream' or 'copy'.
+        table_name: The name of the table to get data from.
+        column_headers: A list of the table's column headers.
+        bucket_name: The name of the bucket in S3.
+        bucket_key: The name of the file and path the data will
+        be stored in.
+        (OPTIONAL) since: A watermark datetime; only rows updated after
+        it are exported.
+        (OPTIONAL) overlap: An interval subtracted from 'since'.
+        (OPTIONAL) batch_size: Rows fetched per round trip when
+        streaming.
+        (OPTIONAL) column_types: A dictionary of data type names keyed
+        by column, looked up if needed and not given.
+        (OPTIONAL) content_hashes: A dictionary of the hash of each
+        table's last upload. The upload is skipped if the export hashes
+        the same, and the table's entry is updated in place.
+        (OPTIONAL) file_format: Either 'csv' or 'parquet'.
+        (OPTIONAL) snapshot: The id of an exported snapshot to read
+        the table as of, so tables exported on different connections
+        are consistent with each other.
+        (OPTIONAL) column_stats: Whether to write a JSON sidecar of
+        column statistics, which only the 'select' and 'stream' engines
+        do. Parquet files keep their own column statistics.
+
+    Returns:
+        A dictionary of the 'row_count', 'byte_count' (None if the
+        engine does not track it) and latest 'last_updated' value
+        exported, and whether the upload was 'skipped'.
+
+    Raises:
+        ValueError
+    """
+    previous_hash = get_previous_hash(content_hashes, table_name)
+    if file_format == "parquet":
+        if column_types is None:
+            column_types = sql_select_column_types(conn, table_name)
+        summary = parquet_table_to_s3(
+            conn, table_name, column_headers, bucket_name, bucket_key,
+            column_types, since=since, overlap=overlap,
+            batch_size=batch_size, content_hashes=content_hashes,
+            snapshot=snapshot)
+    elif engine == "select":
+        summary = data_to_bucket_csv_file(
+            conn, table_name, column_headers, bucket_name, bucket_key,
+            since=since, overlap=overlap, content_hashes=content_hashes,
+            snapshot=snapshot, column_stats=column_stats)
+    elif engine == "stream":
+        summary = stream_table_to_s3(
+            conn, table_name, column_headers, bucket_name, bucket_key,
+            since=since, overlap=overlap, batch_size=batch_size,
+            content_hashes=content_hashes, snapshot=snapshot,
+            column_stats=column_stats)
+    elif engine == "copy":
+        if column_types is None:
+            column_types = sql_select_column_types(conn, table_name)
+        summary = copy_table_to_s3(
+            conn, table_name, column_headers, bucket_name, bucket_key,
+            since=since, overlap=overlap, column_types=column_types,
+            content_hashes=content_hashes, snapshot=snapshot)
+    else:
+        logger.error(f"Unknown ingestion engine {engine}")
+        raise ValueError(engine)
+    summary["skipped"] = previous_hash is not None and \
+        get_previous_hash(content_hashes, table_name) == previous_hash
+    return summary
+
+
+def get_previous_hash(content_hashes, table):
+    """ Looks up the content hash of a table's last upload.
+
+    Args:
+        content_hashes: A dictionary of hashes keyed by table, or None
+        if uploads are not being compared.
+        table: The name of a table.
+
+    Returns:
+        The hash, or None if there is none.
+    """
+    return content_hashes.get(table) if content_hashes else None
+
+
+def sql_start_read_transaction(conn, snapshot=None, repeatable=False):
+    """ Starts a read only transaction, attached to an exported snapshot
+    if one is given.
+
+    Args:
+        conn: An open database Connection.
+        (OPTIONAL) snapshot: The id of a snapshot from 'exported_snapshot'.
+        (OPTIONAL) repeatable: Whether to use the repeatable read
+        isolation level, which a snapshot always does.
+    """
+    if snapshot is None and not repeatable:
+        conn.run("START TRANSACTION READ ONLY;")
+        return
+    conn.run("START TRANSACTION ISOLATION LEVEL REPEATABLE READ READ ONLY;")
+    if snapshot is not None:
+        conn.run(f"SET TRANSACTION SNAPSHOT {literal(snapshot)};")
+
+
+@contextmanager
+def exported_snapshot(pool):
+    """ Holds a repeatable read transaction open on a pooled connection
+    for the duration of a 'with' block, publishing its snapshot so that
+    other connections can read the database as of the same moment.
+
+    Args:
+        pool: The ConnectionPool to take a connection from.
+
+    Yields:
+        The id of the exported snapshot.
+
+    Raises:
+        DatabaseError
+    """
+    with pool.connection() as conn:
+        try:
+            conn.run("START TRANSACTION ISOLATION LEVEL REPEATABLE READ "
+                     "READ ONLY;")
+            snapshot = conn.run("SELECT pg_export_snapshot();")[0][0]
+        except pge.DatabaseError as e:
+            logger.error("DatabaseError: unable to export a snapshot")
+            raise e
+        logger.info(f"Exporting tables as of snapshot {snapshot}")
+        yield snapshot
+        conn.run("COMMIT;")
+
+
+def sql_stream_query(conn, table, batch_size, since=None, overlap=None,
+                     snapshot=None, columns=None):
+    """ Reads a table in fixed-size batches through a server-side
+    cursor, so only one batch is held in memory at a time.
+
+    Args:
+        conn: An open database Connection.
+        table: The name of the table to get data from.
+        batch_size: The number of rows fetched per round trip.
+        (OPTIONAL) since: A watermark datetime; only rows with a later
+        'last_updated' are selected.
+        (OPTIONAL) overlap: An interval subtracted from 'since'.
+        (OPTIONAL) snapshot: The id of an exported snapshot to read
+        the table as of.
+        (OPTIONAL) columns: The columns to select, all if not given.
+
+    Yields:
+        Lists of row data, each at most 'batch_size' long.
+
+    Raises:
+        DatabaseError
+    """
+    query, params = build_select_query(table, since, overlap,
+                                       build_select_list(columns))
+    try:
+        sql_start_read_transaction(conn, snapshot)
+        conn.run("DECLARE export_cursor NO SCROLL CURSOR FOR "
+                 f"{query.rstrip(';')};", **params)
+        while True:
+            with measure("query"):
+                rows = conn.run(f"FETCH FORWARD {int(batch_size)} "
+                                "FROM export_cursor;")
+            if not rows:
+                break
+            yield rows
+        conn.run("CLOSE export_cursor;")
+        conn.run("COMMIT;")
+    except pge.DatabaseError as e:
+        logger.error(f"DatabaseError: {table} does not exist in database")
+        raise e
+
+
+def format_csv_value(value):
+    """ Formats datetimes with a fixed number of fractional digits, so
+    every value in a column parses with the same format downstream.
+
+    Args:
+        value: A value from a row of data.
+
+    Returns:
+        The value, or its text if it is a datetime.
+    """
+    if isinstance(value, datetime):
+        return value.isoformat(sep=" ", timespec="microseconds")
+    return value
+
+
+def encode_csv_rows(rows, column_headers=None):
+    """ Encodes rows as CSV in the same layout pandas writes.
+
+    Args:
+        rows: A collection of nested lists of row data.
+        (OPTIONAL) column_headers: Written as a header line first.
+
+    Returns:
+        The encoded rows as UTF-8 bytes.
+    """
+    buffer = StringIO()
+    writer = csv.writer(buffer, lineterminator="\n")
+    if column_headers is not None:
+        writer.writerow(column_headers)
+    writer.writerows([format_csv_value(value) for value in row]
+                     for row in rows)
+    return buffer.getvalue().encode("utf-8")
+
+
+class HyperLogLog:
+    """ Estimates the number of distinct values added to it in a fixed
+    amount of memory, within about 3% with the default precision.
+
+    Args:
+        (OPTIONAL) precision: The number of hash bits used to pick a
+        register; there are 2 ** precision registers.
+    """
+
+    def __init__(self, precision=10):
+        self.precision = precision
+        self.registers = bytearray(1 << precision)
+
+    def add(self, value):
+        """ Adds a value by its text.
+
+        Args:
+            value: Any value.
+        """
+        digest = int.from_bytes(hashlib.blake2b(
+            str(value).encode("utf-8"), digest_size=8).digest(), "big")
+        bits = 64 - self.precision
+        index = digest >> bits
+        rank = bits - (digest & ((1 << bits) - 1)).bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def count(self):
+        """ Estimates the number of distinct values added.
+
+        Returns:
+            The estimate as an integer.
+        """
+        size = len(self.registers)
+        estimate = 0.7213 / (1 + 1.079 / size) * size * size / sum(
+            2.0 ** -register for register in self.registers)
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * size and zeros:
+            estimate = size * math.log(size / zeros)
+        return round(estimate)
+
+
+class ColumnStats:
+    """ Gathers each column's minimum, maximum, null count, approximate
+    distinct count and longest text value as rows are encoded.
+
+    Args:
+        column_headers: A list of the table's column headers.
+    """
+
+    def __init__(self, column_headers):
+        self.column_headers = column_headers
+        self.row_count = 0
+        self.columns = [{"min": None, "max": None, "null_count": 0,
+                         "max_length": None} for _ in column_headers]
+        self.sketches = [HyperLogLog() for _ in column_headers]
+
+    def add(self, row):
+        """ Adds a row to the statistics.
+
+        Args:
+            row: A list of the row's values.
+        """
+        for stats, sketch, value in zip(self.columns, self.sketches, row):
+            if value is None:
+                stats["null_count"] += 1
+                continue
+            sketch.add(value)
+            if stats["min"] is None or value < stats["min"]:
+                stats["min"] = value
+            if stats["max"] is None or value > stats["max"]:
+                stats["max"] = value
+            if isinstance(value, str):
+                stats["max_length"] = max(stats["max_length"] or 0,
+                                          len(value))
+        self.row_count += 1
+
+    def update(self, rows):
+        """ Adds a batch of rows to the statistics.
+
+        Args:
+            rows: A collection of nested lists of row data.
+        """
+        for row in rows:
+            self.add(row)
+
+    def to_dict(self):
+        """ Returns the statistics keyed by column, ready to be written
+        as JSON. """
+        return {"row_count": self.row_count, "columns": {
+            column: dict(stats, distinct_count=sketch.count())
+            for column, stats, sketch in zip(
+                self.column_headers, self.columns, self.sketches)}}
+
+
+def get_stats_key(bucket_key):
+    """ Builds the key of the column statistics sidecar of an export.
+
+    Args:
+        bucket_key: The key the export is written to.
+
+    Returns:
+        The key with '.stats.json' in place of its extension.
+    """
+    return f"{os.path.splitext(bucket_key)[0]}.stats.json"
+
+
+class S3MultipartWriter:
+    """ A binary file-like object that uploads what is written to it to
+    S3 as a multipart upload, holding at most one part in memory.
+
+    Objects smaller than a single part are sent with one 'put_object'
+    call instead. Used as a context manager the upload is completed on
+    exit, or aborted if the block raises.
+
+    A SHA-256 hash of the content is kept as it is written. If it ends
+    up matching 'previous_hash' the upload is aborted instead of
+    completed, so the existing object is left untouched.
+
+    Args:
+        bucket_name: The name of the bucket in S3.
+        bucket_key: The name of the file and path the data will
+        be stored in.
+        part_size: The size in bytes of each uploaded part.
+        previous_hash: The content hash of the last upload, if known.
+    """
+
+    def __init__(self, bucket_name, bucket_key,
+                 part_size=MULTIPART_PART_SIZE, previous_hash=None):
+        self.bucket_name = bucket_name
+        self.bucket_key = bucket_key
+        self.part_size = part_size
+        self.previous_hash = previous_hash
+        self.skipped = False
+        self.closed = False
+        self.bytes_written = 0
+        self._hash = hashlib.sha256()
+        self._buffer = bytearray()
+        self._upload_id = None
+        self._parts = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def write(self, data):
+        """ Buffers data, uploading a part whenever a full one is ready.
+
+        Args:
+            data: Bytes to append to the object.
+
+        Returns:
+            The number of bytes written.
+        """
+        self._buffer += data
+        self._hash.update(data)
+        self.bytes_written += len(data)
+        if len(self._buffer) >= self.part_size:
+            self._upload_part()
+        return len(data)
+
+    def tell(self):
+        return self.bytes_written
+
+    def flush(self):
+        pass
+
+    @property
+    def content_hash(self):
+        """ The hex SHA-256 hash of everything written so far. """
+        return self._hash.hexdigest()
+
+    def _upload_part(self):
+        with measure("upload"):
+            if self._upload_id is None:
+                self._upload_id = get_s3_client().create_multipart_upload(
+                    Bucket=self.bucket_name,
+                    Key=self.bucket_key)["UploadId"]
+            part_number = len(self._parts) + 1
+            response = get_s3_client().upload_part(
+                Bucket=self.bucket_name, Key=self.bucket_key,
+                UploadId=self._upload_id, PartNumber=part_number,
+                Body=bytes(self._buffer))
+        self._parts.append(
+            {"ETag": response["ETag"], "PartNumber": part_number})
+        self._buffer = bytearray()
+
+    def close(self):
+        """ Uploads anything still buffered and completes the object. """
+        if self.content_hash == self.previous_hash:
+            logger.info(f"{self.bucket_key} is unchanged, skipping upload")
+            self.abort()
+            self.skipped = True
+            return
+        if self._upload_id is None:
+            with measure("upload"):
+                get_s3_client().put_object(Bucket=self.bucket_name,
+                                           Key=self.bucket_key,
+                                           Body=bytes(self._buffer))
+        else:
+            if self._buffer:
+                self._upload_part()
+            with measure("upload"):
+                get_s3_client().complete_multipart_upload(
+                    Bucket=self.bucket_name, Key=self.bucket_key,
+                    UploadId=self._upload_id,
+                    MultipartUpload={"Parts": self._parts})
+        self._buffer = bytearray()
+        self.closed = True
+
+    def abort(self):
+        """ Discards the upload so no partial object is left behind. """
+        if self._upload_id is not None:
+            get_s3_client().abort_multipart_upload(
+                Bucket=self.bucket_name, Key=self.bucket_key,
+                UploadId=self._upload_id)
+            self._upload_id = None
+        self._buffer = bytearray()
+        self.closed = True
+
+
+def stream_table_to_s3(
+    conn, table_name, column_headers, bucket_name, bucket_key,
+    since=None, overlap=None, batch_size=5000, content_hashes=None,
+    snapshot=None, column_stats=False
+):
+    """ Streams a table from a server-side cursor to S3 as a csv file
+    without holding the whole table in memory.
+
+    Args:
+        conn: An open database Connection.
+        table_name: The name of the table to get data from.
+        column_headers: A list of the table's column headers.
+        bucket_name: The name of the bucket in S3.
+        bucket_key: The name of the file and path the data will
+        be stored in.
+        (OPTIONAL) since: A watermark datetime; only rows updated after
+        it are exported.
+        (OPTIONAL) overlap: An interval subtracted from 'since'.
+        (OPTIONAL) batch_size: The number of rows fetched per round
+        trip.
+        (OPTIONAL) content_hashes: A dictionary of the hash of each
+        table's last upload; the upload is skipped if it is unchanged.
+        (OPTIONAL) snapshot: The id of an exported snapshot to read
+        the table as of.
+        (OPTIONAL) column_stats: Whether to write statistics of each
+        column to a JSON sidecar next to the file.
+
+    Returns:
+        A dictionary of the 'row_count', 'byte_count' and latest
+        'last_updated' value exported.
+
+    Raises:
+        NoSuchBucket
+        ParamValidationError
+    """
+    updated_index = column_headers.index("last_updated") \
+        if "last_updated" in column_headers else None
+    row_count = 0
+    latest = None
+    stats = ColumnStats(column_headers) if column_stats else None
+    try:
+        with S3MultipartWriter(
+                bucket_name, bucket_key, previous_hash=get_previous_hash(
+                    content_hashes, table_name)) as writer:
+            writer.write(encode_csv_rows([], column_headers))
+            for rows in sql_stream_query(conn, table_name, batch_size,
+                                         since, overlap, snapshot,
+                                         column_headers):
+                with measure("encode"):
+                    data = encode_csv_rows(rows)
+                    if stats is not None:
+                        stats.update(rows)
+                writer.write(data)
+                row_count += len(rows)
+                latest = get_latest_in_batch(rows, updated_index, latest)
+        if stats is not None and not writer.skipped:
+            save_state_to_s3(bucket_name, get_stats_key(bucket_key),
+                             stats.to_dict())
+    except botocore.exceptions.ClientError as e:
+        if e.response["Error"]["Code"] == "NoSuchBucket":
+            logger.error(f"{bucket_name} does not exist in your S3")
+        raise e
+    except botocore.exceptions.ParamValidationError as e:
+        logger.error("The request has invalid params")
+        raise e
+    else:
+        if content_hashes is not None:
+            content_hashes[table_name] = writer.content_hash
+        return {"row_count": row_count,
+                "byte_count": writer.bytes_written,
+                "last_updated": latest}
+
+
+def get_parquet_types():
+    """ Maps PostgreSQL data types to Arrow types.
+
+    pyarrow is slow to import and only needed for Parquet output, so it
+    is imported here rather than with the module.
+
+    Returns:
+        A dictionary of pyarrow DataTypes keyed by data type name.
+    """
+    import pyarrow as pa
+    return {
+        "smallint": pa.int16(),
+        "integer": pa.int32(),
+        "bigint": pa.int64(),
+        "numeric": pa.decimal128(38, 10),
+        "real": pa.float32(),
+        "double precision": pa.float64(),
+        "boolean": pa.bool_(),
+        "date": pa.date32(),
+        "time without time zone": pa.time64("us"),
+        "timestamp without time zone": pa.timestamp("us"),
+        "timestamp with time zone": pa.timestamp("us", tz="UTC"),
+    }
+
+
+def build_parquet_schema(column_headers, column_types):
+    """ Builds the Arrow schema of a table's Parquet file from its
+    PostgreSQL column types, so nothing is left to type inference.
+
+    Args:
+        column_headers: A list of the table's column headers.
+        column_types: A dictionary of data type names keyed by column.
+        Types without an Arrow equivalent are stored as strings.
+
+    Returns:
+        A pyarrow Schema.
+    """
+    import pyarrow as pa
+    parquet_types = get_parquet_types()
+    return pa.schema([
+        (column, parquet_types.get(column_types.get(column), pa.string()))
+        for column in column_headers])
+
+
+def encode_parquet_batch(rows, schema):
+    """ Converts rows to an Arrow record batch of the given schema.
+
+    Args:
+        rows: A collection of nested lists of row data.
+        schema: A pyarrow Schema from 'build_parquet_schema'.
+
+    Returns:
+        A pyarrow RecordBatch.
+    """
+    import pyarrow as pa
+    arrays = []
+    for index, field in enumerate(schema):
+        values = [row[index] for row in rows]
+        if field.type == pa.string():
+            values = [value if value is None or isinstance(value, str)
+                      else str(value) for value in values]
+        arrays.append(pa.array(values, type=field.type))
+    return pa.record_batch(arrays, schema=schema)
+
+
+def parquet_table_to_s3(
+    conn, table_name, column_headers, bucket_name, bucket_key,
+    column_types, since=None, overlap=None, batch_size=5000,
+    content_hashes=None, snapshot=None
+):
+    """ Streams a table from a server-side cursor to S3 as a zstd
+    compressed Parquet file, one row group per batch.
+
+    Args:
+        conn: An open database Connection.
+        table_name: The name of the table to get data from.
+        column_headers: A list of the table's column headers.
+        bucket_name: The name of the bucket in S3.
+        bucket_key: The name of the file and path the data will
+        be stored in.
+        column_types: A dictionary of data type names keyed by column.
+        (OPTIONAL) since: A watermark datetime; only rows updated after
+        it are exported.
+        (OPTIONAL) overlap: An interval subtracted from 'since'.
+        (OPTIONAL) batch_size: The number of rows fetched per round
+        trip.
+        (OPTIONAL) content_hashes: A dictionary of the hash of each
+        table's last upload; the upload is skipped if it is unchanged.
+        (OPTIONAL) snapshot: The id of an exported snapshot to read
+        the table as of.
+
+    Returns:
+        A dictionary of the 'row_count', 'byte_count' and latest
+        'last_updated' value exported.
+
+    Raises:
+        NoSuchBucket
+        ParamValidationError
+    """
+    import pyarrow.parquet as pq
+    schema = build_parquet_schema(column_headers, column_types)
+    updated_index = column_headers.index("last_updated") \
+        if "last_updated" in column_headers else None
+    row_count = 0
+    latest = None
+    try:
+        with S3MultipartWriter(
+                bucket_name, bucket_key, previous_hash=get_previous_hash(
+                    content_hashes, table_name)) as writer:
+            with pq.ParquetWriter(writer, schema,
+                                  compression="zstd") as parquet_writer:
+                for rows in sql_stream_query(conn, table_name, batch_size,
+                                             since, overlap, snapshot,
+                                             column_headers):
+                    with measure("encode"):
+                        batch = encode_parquet_batch(rows, schema)
+                    parquet_writer.write_batch(batch)
+                    row_count += len(rows)
+                    latest = get_latest_in_batch(rows, updated_index, latest)
+    except botocore.exceptions.ClientError as e:
+        if e.response["Error"]["Code"] == "NoSuchBucket":
+            logger.error(f"{bucket_name} does not exist in your S3")
+        raise e
+    except botocore.exceptions.ParamValidationError as e:
+        logger.error("The request has invalid params")
+        raise e
+    else:
+        if content_hashes is not None:
+            content_hashes[table_name] = writer.content_hash
+        return {"row_count": row_count,
+                "byte_count": writer.bytes_written,
+                "last_updated": latest}
+
+
+def sql_select_primary_key(conn, table):
+    """ Queries database for a table's primary key column.
+
+    Args:
+        conn: An open database Connection.
+        table: The name of the table.
+
+    Returns:
+        The name of the key column, or None if the table does not have
+        a single-column primary key.
+    """
+    query = (
+        "SELECT a.attname FROM pg_index i JOIN pg_attribute a "
+        "ON a.attrelid = i.indrelid AND a.attnum = ANY(i.indkey) "
+        "WHERE i.indrelid = CAST(:table AS regclass) AND i.indisprimary;"
+    )
+    rows = conn.run(query, table=table)
+    return rows[0][0] if len(rows) == 1 else None
+
+
+def sql_key_ranges(conn, table, key_column, range_rows, since=None,
+                   overlap=None):
+    """ Splits a table into ranges of its primary key holding about
+    'range_rows' rows each, reading only the key index unless only
+    rows past a watermark are counted.
+
+    Args:
+        conn: An open database Connection.
+        table: The name of the table.
+        key_column: The table's primary key column.
+        range_rows: The number of rows wanted in each range.
+        (OPTIONAL) since: A watermark datetime; only rows with a later
+        'last_updated' are counted.
+        (OPTIONAL) overlap: An interval subtracted from 'since'.
+
+    Returns:
+        A list of (lower, upper) key tuples, where lower is exclusive,
+        upper is inclusive and None leaves that end open.
+    """
+    params = {"range_rows": range_rows}
+    where = ""
+    if since is not None:
+        where = (" WHERE last_updated > CAST(:since AS timestamp) - "
+                 "CAST(:overlap AS interval)")
+        params.update(since=since, overlap=overlap or "0 seconds")
+    query = (
+        f"SELECT {key_column} FROM (SELECT {key_column}, "
+        f"row_number() OVER (ORDER BY {key_column}) AS n, "
+        f"count(*) OVER () AS total FROM {table}{where}) AS keys "
+        f"WHERE n % :range_rows = 0 AND n < total ORDER BY {key_column};"
+    )
+    bounds = [row[0] for row in conn.run(query, **params)]
+    return list(zip([None] + bounds, bounds + [None]))
+
+
+def build_keyset_query(table, key_column, after=None, upper=None,
+                       since=None, overlap=None, columns=None):
+    """ Builds the query for the next page of a key range, seeking past
+    the last key already read rather than using OFFSET.
+
+    Args:
+        table: The name of the table.
+        key_column: The table's primary key column.
+        (OPTIONAL) after: The last key already read.
+        (OPTIONAL) upper: The inclusive upper key of the range.
+        (OPTIONAL) since: A watermark datetime; only rows with a later
+        'last_updated' are selected.
+        (OPTIONAL) overlap: An interval subtracted from 'since'.
+        (OPTIONAL) columns: The columns to select, all if not given.
+
+    Returns:
+        A tuple of the query string and a dictionary of its parameters,
+        without the ':batch_size' limit.
+    """
+    conditions = []
+    params = {}
+    if after is not None:
+        conditions.append(f"{key_column} > :after")
+        params["after"] = after
+    if upper is not None:
+        conditions.append(f"{key_column} <= :upper")
+        params["upper"] = upper
+    if since is not None:
+        conditions.append("last_updated > CAST(:since AS timestamp) - "
+                          "CAST(:overlap AS interval)")
+        params.update(since=since, overlap=overlap or "0 seconds")
+    where = f" WHERE {' AND '.join(conditions)}" if conditions else ""
+    return (f"SELECT {build_select_list(columns)} FROM {table}{where} "
+            f"ORDER BY {key_column} LIMIT :batch_size;", params)
+
+
+def sql_keyset_pages(conn, table, key_column, key_index, key_range,
+                     batch_size, since=None, overlap=None, snapshot=None,
+                     columns=None):
+    """ Reads one key range of a table a page at a time.
+
+    Args:
+        conn: An open database Connection.
+        table: The name of the table.
+        key_column: The table's primary key column.
+        key_index: The position of the key column in each row.
+        key_range: A (lower, upper) tuple from 'sql_key_ranges'.
+        batch_size: The number of rows fetched per page.
+        (OPTIONAL) since: A watermark datetime.
+        (OPTIONAL) overlap: An interval subtracted from 'since'.
+        (OPTIONAL) snapshot: The id of an exported snapshot to read
+        the table as of.
+        (OPTIONAL) columns: The columns to select, all if not given.
+
+    Yields:
+        Lists of row data, in key order.
+    """
+    after, upper = key_range
+    if snapshot is not None:
+        sql_start_read_transaction(conn, snapshot)
+    while True:
+        query, params = build_keyset_query(
+            table, key_column, after, upper, since, overlap, columns)
+        with measure("query"):
+            rows = conn.run(query, batch_size=batch_size, **params)
+        if rows:
+            yield rows
+        if len(rows) < batch_size:
+            break
+        after = rows[-1][key_index]
+    if snapshot is not None:
+        conn.run("COMMIT;")
+
+
+def get_part_key(bucket_key, number):
+    """ Builds the key of one part of a range-scanned export.
+
+    Args:
+        bucket_key: The key the whole table would be written to.
+        number: The number of the part.
+
+    Returns:
+        The key with '-part-NNNNN' added before its extension.
+    """
+    stem, extension = os.path.splitext(bucket_key)
+    return f"{stem}-part-{number:05d}{extension}"
+
+
+def range_scan_table(pool, table, column_headers, bucket_name, bucket_key,
+                     settings, since=None, snapshot=None, column_types=None,
+                     content_hashes=None):
+    """ Exports a large table as separate part files, one per primary
+    key range, with the ranges read concurrently on pooled connections.
+
+    Memory use is bounded by 'batch_size' rows per range. Ranges only
+    count the rows past 'since', and tables without a single-column
+    primary key, or with too few rows to split, are exported in one
+    file.
+
+    Args:
+        pool: The ConnectionPool to take connections from.
+        table: The name of the table.
+        column_headers: A list of the table's column headers.
+        bucket_name: The name of the bucket in S3.
+        bucket_key: The key the whole table would be written to.
+        settings: Dictionary returned by 'get_ingestion_settings'.
+        (OPTIONAL) since: The table's watermark datetime, if it has one.
+        (OPTIONAL) snapshot: The id of an exported snapshot every range
+        is read as of.
+        (OPTIONAL) column_types: A dictionary of data type names keyed
+        by column, used if the table is exported in one file.
+        (OPTIONAL) content_hashes: A dictionary of the hash of each
+        table's last upload, used if the table is exported in one file.
+
+    Returns:
+        A dictionary of the 'row_count', 'byte_count' and latest
+        'last_updated' value exported, and a list of 'parts' each with
+        its 'key', 'row_count' and 'byte_count'.
+
+    Raises:
+        The first error raised while exporting a range.
+    """
+    with pool.connection() as conn:
+        key_column = sql_select_primary_key(conn, table)
+        if key_column is None:
+            logger.info(f"{table} has no single primary key to range scan")
+        key_ranges = sql_key_ranges(
+            conn, table, key_column, settings["range_rows"], since,
+            settings["overlap"]) if key_column is not None else []
+        if len(key_ranges) < 2:
+            return export_table(
+                conn, settings["engine"], table, column_headers,
+                bucket_name, bucket_key, since=since,
+                overlap=settings["overlap"],
+                batch_size=settings["batch_size"],
+                column_types=column_types, content_hashes=content_hashes,
+                snapshot=snapshot, column_stats=settings["column_stats"])
+
+    key_index = column_headers.index(key_column)
+    updated_index = column_headers.index("last_updated") \
+        if "last_updated" in column_headers else None
+
+    metrics = get_current_metrics()
+
+    def scan(part):
+        number, key_range = part
+        part_key = get_part_key(bucket_key, number)
+        row_count = 0
+        latest = None
+        with collect_metrics(metrics), pool.connection() as conn:
+            with S3MultipartWriter(bucket_name, part_key) as writer:
+                writer.write(encode_csv_rows([], column_headers))
+                for rows in sql_keyset_pages(
+                        conn, table, key_column, key_index, key_range,
+                        settings["batch_size"], since, settings["overlap"],
+                        snapshot, column_headers):
+                    with measure("encode"):
+                        data = encode_csv_rows(rows)
+                    writer.write(data)
+                    row_count += len(rows)
+                    latest = get_latest_in_batch(rows, updated_index, latest)
+        return {"key": part_key, "row_count": row_count,
+                "byte_count": writer.bytes_written, "last_updated": latest}
+
+    parts = list(enumerate(key_ranges))
+    outcomes = run_tasks(scan, parts, settings["workers"])
+    for part in parts:
+        if isinstance(outcomes[part], Exception):
+            raise outcomes[part]
+    summaries = [outcomes[part] for part in parts]
+    latest = None
+    for summary in summaries:
+        latest = get_latest_in_batch([[summary["last_updated"]]], 0, latest)
+    return {"row_count": sum(part["row_count"] for part in summaries),
+            "byte_count": sum(part["byte_count"] for part in summaries),
+            "last_updated": latest,
+            "parts": [{key: part[key] for key in
+                       ("key", "row_count", "byte_count")}
+                      for part in summaries]}
+
+
+def sql_select_column_types(conn, table):
+    """ Queries database for the data types of a table's columns.
+
+    Args:
+        conn: An open database Connection.
+        table: The name of a table.
+
+    Returns:
+        A dictionary of data type names keyed by column name.
+    """
+    rows = conn.run(
+        "SELECT column_name, data_type FROM information_schema.columns "
+        "WHERE table_schema = current_schema() AND table_name = :table;",
+        table=table)
+    return {column: data_type for column, data_type in rows}
+
+
+def build_copy_select_list(column_headers, column_types):
+    """ Builds a select list whose csv text matches the other export
+    engines.
+
+    PostgreSQL writes booleans as 't' and 'f' and trims trailing zeros
+    from fractional seconds, so booleans are cast to the 'True' and
+    'False' text pandas writes and timestamps always carry microseconds.
+
+    Args:
+        column_headers: A list of the table's column headers.
+        column_types: A dictionary of data type names keyed by column.
+
+    Returns:
+        The select list as a string.
+    """
+    select_list = []
+    for column in column_headers:
+        data_type = column_types.get(column)
+        if data_type == "boolean":
+            select_list.append(
+                f"CASE WHEN {column} THEN 'True' WHEN NOT {column} "
+                f"THEN 'False' END AS {column}")
+        elif data_type == "timestamp without time zone":
+            select_list.append(
+                f"to_char({column}, 'YYYY-MM-DD HH24:MI:SS.US') "
+                f"AS {column}")
+        else:
+            select_list.append(column)
+    return ", ".join(select_list)
+
+
+def build_copy_query(table, column_headers, column_types=None,
+                     since=None, overlap=None):
+    """ Builds a COPY TO STDOUT statement that writes a table as csv in
+    the same layout as the other export engines.
+
+    COPY does not accept bind parameters, so the watermark is inlined
+    as a literal.
+
+    Args:
+        table: The name of the table to get data from.
+        column_headers: A list of the table's column headers.
+        (OPTIONAL) column_types: A dictionary of data type names keyed
+        by column.
+        (OPTIONAL) since: A watermark datetime; only rows with a later
+        'last_updated' are selected.
+        (OPTIONAL) overlap: An interval subtracted from 'since'.
+
+    Returns:
+        The COPY statement as a string.
+    """
+    select_list = build_copy_select_list(column_headers, column_types or {})
+    query = f"SELECT {select_list} FROM {table}"
+    if since is not None:
+        query += (f" WHERE last_updated > CAST({literal(since)} AS "
+                  f"timestamp) - CAST({literal(overlap or '0 seconds')} "
+                  "AS interval)")
+    return f"COPY ({query}) TO STDOUT WITH (FORMAT csv, HEADER);"
+
+
+def copy_table_to_s3(
+    conn, table_name, column_headers, bucket_name, bucket_key,
+    since=None, overlap=None, column_types=None, content_hashes=None,
+    snapshot=None
+):
+    """ Streams a table to S3 as a csv file encoded by the database's
+    COPY TO STDOUT, without building any rows in Python.
+
+    The export and the lookup of its latest 'last_updated' value run in
+    one repeatable read transaction so both see the same rows.
+
+    Args:
+        conn: An open database Connection.
+        table_name: The name of the table to get data from.
+        column_headers: A list of the table's column headers.
+        bucket_name: The name of the bucket in S3.
+        bucket_key: The name of the file and path the data will
+        be stored in.
+        (OPTIONAL) since: A watermark datetime; only rows updated after
+        it are exported.
+        (OPTIONAL) overlap: An interval subtracted from 'since'.
+        (OPTIONAL) column_types: A dictionary of data type names keyed
+        by column.
+        (OPTIONAL) content_hashes: A dictionary of the hash of each
+        table's last upload; the upload is skipped if it is unchanged.
+        (OPTIONAL) snapshot: The id of an exported snapshot to read
+        the table as of.
+
+    Returns:
+        A dictionary of the 'row_count', 'byte_count' and latest
+        'last_updated' value exported.
+
+    Raises:
+        DatabaseError
+        NoSuchBucket
+        ParamValidationError
+    """
+    query = build_copy_query(table_name, column_headers, column_types,
+                             since, overlap)
+    latest = None
+    try:
+        with S3MultipartWriter(
+                bucket_name, bucket_key, previous_hash=get_previous_hash(
+                    content_hashes, table_name)) as writer:
+            sql_start_read_transaction(conn, snapshot, repeatable=True)
+            with measure("query"):
+                conn.run(query, stream=writer)
+            row_count = conn.row_count
+            if "last_updated" in column_headers:
+                max_query, params = build_select_query(
+                    table_name, since, overlap, "max(last_updated)")
+                latest = conn.run(max_query, **params)[0][0]
+            conn.run("COMMIT;")
+    except pge.DatabaseError as e:
+        logger.error(f"DatabaseError: {table_name} does not exist in "
+                     "database")
+        raise e
+    except botocore.exceptions.ClientError as e:
+        if e.response["Error"]["Code"] == "NoSuchBucket":
+            logger.error(f"{bucket_name} does not exist in your S3")
+        raise e
+    except botocore.exceptions.ParamValidationError as e:
+        logger.error("The request has invalid params")
+        raise e
+    else:
+        if content_hashes is not None:
+            content_hashes[table_name] = writer.content_hash
+        return {"row_count": row_count,
+                "byte_count": writer.bytes_written,
+                "last_updated": latest}
+
+
+def sql_schema_fingerprint(conn, tables):
+    """ Queries database for a cheap hash of the tables' column names
+    and types.
+
+    Args:
+        conn: An open database Connection.
+        tables: A list of table names.
+
+    Returns:
+        The fingerprint as a hex string.
+    """
+    rows = conn.run(
+        "SELECT md5(string_agg(table_name || '.' || column_name || ':' "
+        "|| data_type, ',' ORDER BY table_name, ordinal_position)) "
+        "FROM information_schema.columns WHERE table_schema = "
+        "current_schema() AND table_name = ANY(:tables);", tables=tables)
+    return rows[0][0]
+
+
+def sql_select_schema(conn, tables):
+    """ Queries database for the columns of every table at once.
+
+    Args:
+        conn: An open database Connection.
+        tables: A list of table names.
+
+    Returns:
+        Dictionary keyed by table name of lists of column dictionaries,
+        each with a 'name' and 'data_type', in column order.
+    """
+    rows = conn.run(
+        "SELECT table_name, column_name, data_type "
+        "FROM information_schema.columns WHERE table_schema = "
+        "current_schema() AND table_name = ANY(:tables) "
+        "ORDER BY table_name, ordinal_position;", tables=tables)
+    schema = {table: [] for table in tables}
+    for table, column, data_type in rows:
+        schema[table].append({"name": column, "data_type": data_type})
+    return schema
+
+
+def get_schema_catalog(conn, tables, bucket_name):
+    """ Returns the column catalog for the tables, rebuilding it only
+    when the schema fingerprint has changed.
+
+    The catalog is cached in memory for warm invocations and in the
+    bucket for cold starts.
+
+    Args:
+        conn: An open database Connection.
+        tables: A list of table names.
+        bucket_name: The name of the bucket holding the catalog.
+
+    Returns:
+        Dictionary holding the schema 'fingerprint' and the 'tables'
+        dictionary returned by 'sql_select_schema'.
+    """
+    global _schema_catalog
+    fingerprint = sql_schema_fingerprint(conn, tables)
+    catalog = _schema_catalog
+    if catalog is None or catalog["fingerprint"] != fingerprint:
+        catalog = load_state_from_s3(
+            bucket_name, SCHEMA_CATALOG_KEY) or catalog
+    if catalog is None or catalog["fingerprint"] != fingerprint:
+        previous = catalog
+        catalog = {"fingerprint": fingerprint,
+                   "tables": sql_select_schema(conn, tables)}
+        if previous is not None:
+            drifted = [table for table in tables
+                       if previous["tables"].get(table)
+                       != catalog["tables"][table]]
+            logger.warning(f"Schema drift detected in tables: {drifted}")
+        save_state_to_s3(bucket_name, SCHEMA_CATALOG_KEY, catalog)
+    _schema_catalog = catalog
+    return catalog
+
+
+def get_catalog_columns(catalog, table):
+    """ Lists a table's column headers from the schema catalog.
+
+    Args:
+        catalog: Dictionary returned by 'get_schema_catalog'.
+        table: The name of a table.
+
+    Returns:
+        A list of column headers for that table.
+    """
+    return [column["name"] for column in catalog["tables"].get(table, [])]
+
+
+def get_catalog_types(catalog, table):
+    """ Maps a table's columns to their data types from the schema
+    catalog.
+
+    Args:
+        catalog: Dictionary returned by 'get_schema_catalog'.
+        table: The name of a table.
+
+    Returns:
+        A dictionary of data type names keyed by column name.
+    """
+    return {column["name"]: column["data_type"]
+            for column in catalog["tables"].get(table, [])}
+
+
+def build_key_range_filter(key_column, key_range):
+    """ Builds the condition limiting a query to a range of keys.
+
+    Args:
+        key_column: The table's primary key column.
+        key_range: A (lower, upper) tuple of the first key in the range
+        and the first key after it, either None for no limit.
+
+    Returns:
+        A tuple of a WHERE clause, empty if the range is unlimited, and
+        a dictionary of its parameters.
+    """
+    lower, upper = key_range
+    conditions = []
+    params = {}
+    if lower is not None:
+        conditions.append(f"{key_column} >= :lower")
+        params["lower"] = lower
+    if upper is not None:
+        conditions.append(f"{key_column} < :upper")
+        params["upper"] = upper
+    if not conditions:
+        return "", params
+    return f" WHERE {' AND '.join(conditions)}", params
+
+
+def sql_key_range_hashes(conn, table, key_column, width,
+                         key_range=(None, None)):
+    """ Queries database for the count and hash of the keys in each
+    bucket of 'width' consecutive keys.
+
+    The hash of a bucket is the sum of the hashes of its keys, so the
+    hash of a wider bucket is the sum of the hashes of those within it.
+
+    Args:
+        conn: An open database Connection.
+        table: The name of the table.
+        key_column: The table's integer primary key column.
+        width: The number of consecutive keys in each bucket.
+        (OPTIONAL) key_range: A (lower, upper) tuple limiting the keys.
+
+    Returns:
+        Dictionary keyed by bucket number, the key divided by 'width'
+        rounded down, of (count, hash) tuples for non-empty buckets.
+
+    Raises:
+        DatabaseError
+    """
+    where, params = build_key_range_filter(key_column, key_range)
+    try:
+        rows = conn.run(
+            f"SELECT CAST(floor(CAST({key_column} AS numeric) / :width) "
+            f"AS bigint), count(*), sum(hashtext(CAST({key_column} AS text)))"
+            f" FROM {table}{where} GROUP BY 1;", width=width, **params)
+    except pge.DatabaseError as e:
+        logger.error(f"DatabaseError: unable to hash keys of {table}")
+        raise e
+    return {bucket: (count, total) for bucket, count, total in rows}
+
+
+def sql_select_keys(conn, table, key_column, key_range=(None, None)):
+    """ Queries database for the keys of a table within a range.
+
+    Args:
+        conn: An open database Connection.
+        table: The name of the table.
+        key_column: The table's primary key column.
+        (OPTIONAL) key_range: A (lower, upper) tuple limiting the keys.
+
+    Returns:
+        A sorted list of keys.
+    """
+    where, params = build_key_range_filter(key_column, key_range)
+    rows = conn.run(f"SELECT {key_column} FROM {table}{where} "
+                    f"ORDER BY {key_column};", **params)
+    return [row[0] for row in rows]
+
+
+def compress_key_runs(keys):
+    """ Stores sorted integer keys as runs of consecutive keys, which
+    keeps the mostly sequential keys of a table small.
+
+    Args:
+        keys: A sorted list of integer keys.
+
+    Returns:
+        A list of [first, last] pairs.
+    """
+    runs = []
+    for key in keys:
+        if runs and runs[-1][1] == key - 1:
+            runs[-1][1] = key
+        else:
+            runs.append([key, key])
+    return runs
+
+
+def expand_key_runs(runs):
+    """ Lists the keys stored by 'compress_key_runs'.
+
+    Args:
+        runs: A list of [first, last] pairs.
+
+    Returns:
+        A list of keys.
+    """
+    return [key for first, last in runs for key in range(first, last + 1)]
+
+
+def sum_leaf_hashes(leaves, leaf_width, width, key_ranges):
+    """ Works out the saved count and hash of each bucket of a wider
+    level from the saved leaf buckets.
+
+    Args:
+        leaves: Dictionary keyed by leaf number of (count, hash) tuples.
+        leaf_width: The number of keys in each leaf.
+        width: The number of keys in each bucket of the level, a
+        multiple of 'leaf_width'.
+        key_ranges: The (lower, upper) tuples of the level's buckets to
+        include.
+
+    Returns:
+        Dictionary keyed by bucket number of (count, hash) tuples.
+    """
+    hashes = {}
+    for leaf, (count, total) in leaves.items():
+        lower = leaf * leaf_width
+        if any((first is None or first <= lower) and
+               (after is None or lower < after)
+               for first, after in key_ranges):
+            bucket = lower // width
+            bucket_count, bucket_total = hashes.get(bucket, (0, 0))
+            hashes[bucket] = (bucket_count + count, bucket_total + total)
+    return hashes
+
+
+def find_changed_leaves(conn, table, key_column, leaves, leaf_width):
+    """ Finds the leaf buckets whose keys differ from those saved by
+    comparing bucket hashes level by level, from a top level of at most
+    'KEY_HASH_FANOUT' buckets down to the leaves, only descending into
+    buckets that differ.
+
+    Args:
+        conn: An open database Connection.
+        table: The name of the table.
+        key_column: The table's integer primary key column.
+        leaves: Dictionary keyed by leaf number of saved (count, hash)
+        tuples.
+        leaf_width: The number of keys in each leaf.
+
+    Returns:
+        Dictionary keyed by leaf number of the current (count, hash)
+        tuple of each leaf that differs, (0, 0) if it is now empty.
+    """
+    highest = conn.run(f"SELECT max({key_column}) FROM {table};")[0][0]
+    highest = max([highest or 0] + [
+        (leaf + 1) * leaf_width - 1 for leaf in leaves])
+    width = leaf_width
+    while highest // width >= KEY_HASH_FANOUT:
+        width *= KEY_HASH_FANOUT
+
+    key_ranges = [(None, None)]
+    while True:
+        current = {}
+        for key_range in key_ranges:
+            current.update(sql_key_range_hashes(
+                conn, table, key_column, width, key_range))
+        previous = sum_leaf_hashes(leaves, leaf_width, width, key_ranges)
+        changed = {bucket: current.get(bucket, (0, 0))
+                   for bucket in set(current) | set(previous)
+                   if current.get(bucket, (0, 0))
+                   != previous.get(bucket, (0, 0))}
+        if width == leaf_width or not changed:
+            return changed
+        key_ranges = [(bucket * width, (bucket + 1) * width)
+                      for bucket in sorted(changed)]
+        width //= KEY_HASH_FANOUT
+
+
+def detect_deleted_keys(conn, table, key_column, state, leaf_width):
+    """ Finds the keys deleted from a table since its key hashes were
+    saved, reading only the keys of leaf buckets whose hashes differ.
+
+    The first run, or a change of 'leaf_width', saves hashes for the
+    whole table and reports no deletes.
+
+    Args:
+        conn: An open database Connection.
+        table: The name of the table.
+        key_column: The table's integer primary key column.
+        state: The table's saved key hashes, or None.
+        leaf_width: The number of keys in each leaf bucket.
+
+    Returns:
+        A tuple of the sorted list of deleted keys and the table's new
+        key hash state, which holds each leaf's count, hash and runs of
+        keys.
+    """
+    if not state or state.get("leaf_width") != leaf_width:
+        hashes = sql_key_range_hashes(conn, table, key_column, leaf_width)
+        keys = sql_select_keys(conn, table, key_column)
+        grouped = {}
+        for key in keys:
+            grouped.setdefault(key // leaf_width, []).append(key)
+        return [], {"leaf_width": leaf_width, "leaves": {
+            str(leaf): [*hashes[leaf], compress_key_runs(grouped[leaf])]
+            for leaf in grouped if leaf in hashes}}
+
+    leaves = dict(state["leaves"])
+    changed = find_changed_leaves(
+        conn, table, key_column,
+        {int(leaf): tuple(saved[:2]) for leaf, saved in leaves.items()},
+        leaf_width)
+    deleted = []
+    for leaf, (count, total) in sorted(changed.items()):
+        lower = leaf * leaf_width
+        keys = sql_select_keys(conn, table, key_column,
+                               (lower, lower + leaf_width)) if count else []
+        previous = leaves.pop(str(leaf), [0, 0, []])
+        deleted.extend(sorted(
+            set(expand_key_runs(previous[2])) - set(keys)))
+        if count:
+            leaves[str(leaf)] = [count, total, compress_key_runs(keys)]
+    return deleted, {"leaf_width": leaf_width, "leaves": leaves}
+
+
+def get_tombstone_key(bucket_key):
+    """ Builds the key of the tombstones written alongside an export.
+
+    Args:
+        bucket_key: The key the table's export is written to.
+
+    Returns:
+        The key with '-tombstones.csv' in place of its extension.
+    """
+    return f"{os.path.splitext(bucket_key)[0]}-tombstones.csv"
+
+
+def ingest_tombstones(pool, tables, bucket_name, bucket_keys, catalog,
+                      settings, deadline=None):
+    """ Writes a tombstone file for each table with rows deleted since
+    the last run, listing the primary key of each deleted row.
+
+    Tables without a single integer primary key are not checked. The
+    key hashes are kept in the bucket, and a table's are only moved on
+    once its tombstones are written.
+
+    Args:
+        pool: The ConnectionPool to take connections from.
+        tables: A list of table names to check.
+        bucket_name: The name of the bucket in S3.
+        bucket_keys: Dictionary of the key each table's export is
+        written to, keyed by table.
+        catalog: Dictionary returned by 'get_schema_catalog'.
+        settings: Dictionary returned by 'get_ingestion_settings'.
+        (OPTIONAL) deadline: The 'time.monotonic' time after which no
+        more tables are checked, leaving them to the next run.
+
+    Returns:
+        Dictionary keyed by table of a dictionary of the tombstones'
+        'key' and 'row_count', {'deferred': True} if it was not checked
+        in time, None if nothing was deleted, or the exception raised
+        while checking it.
+    """
+    key_hashes = load_state_from_s3(bucket_name, KEY_HASHES_KEY, {})
+
+    def detect(table):
+        if not fits_deadline(deadline):
+            return {"deferred": True}
+        with pool.connection() as conn:
+            key_column = sql_select_primary_key(conn, table)
+            if get_catalog_types(catalog, table).get(key_column) not in \
+                    INTEGER_TYPES:
+                logger.info(f"{table} has no integer key to detect deletes")
+                return None
+            deleted, state = detect_deleted_keys(
+                conn, table, key_column, key_hashes.get(table),
+                settings["delete_leaf_keys"])
+        if not deleted:
+            key_hashes[table] = state
+            return None
+        tombstone_key = get_tombstone_key(bucket_keys[table])
+        summary = changes_to_bucket_csv_file(
+            bucket_name, tombstone_key, [key_column],
+            [("delete", None, {key_column: key}) for key in deleted])
+        logger.info(f"{len(deleted)} rows deleted from {table}")
+        key_hashes[table] = state
+        return {"key": tombstone_key, "row_count": summary["row_count"]}
+
+    outcomes = run_tasks(detect, tables, settings["workers"])
+    save_state_to_s3(bucket_name, KEY_HASHES_KEY, key_hashes)
+    return outcomes
+
+
+def sql_create_replication_slot(conn, slot):
+    """ Creates a logical replication slot using the 'test_decoding'
+    output plugin, unless it already exists.
+
+    Args:
+        conn: An open database Connection.
+        slot: The name of the replication slot.
+
+    Returns:
+        A boolean for whether the slot was created.
+
+    Raises:
+        DatabaseError
+    """
+    try:
+        existing = conn.run(
+            "SELECT count(*) FROM pg_replication_slots "
+            "WHERE slot_name = :slot;", slot=slot)
+        if existing[0][0]:
+            return False
+        conn.run("SELECT lsn FROM pg_create_logical_replication_slot("
+                 ":slot, 'test_decoding');", slot=slot)
+    except pge.DatabaseError as e:
+        logger.error(f"DatabaseError: unable to create slot {slot}")
+        raise e
+    logger.info(f"Created replication slot {slot}")
+    return True
+
+
+def sql_peek_changes(conn, slot, max_changes):
+    """ Reads the changes waiting in a replication slot without
+    consuming them.
+
+    Args:
+        conn: An open database Connection.
+        slot: The name of the replication slot.
+        max_changes: The number of changes after which decoding stops
+        at the end of the current transaction.
+
+    Returns:
+        A collection of nested lists of each change's LSN, transaction
+        id and decoded text.
+
+    Raises:
+        DatabaseError
+    """
+    try:
+        return conn.run(
+            "SELECT CAST(lsn AS text), CAST(xid AS text), data "
+            "FROM pg_logical_slot_peek_changes(:slot, NULL, :max_changes);",
+            slot=slot, max_changes=max_changes)
+    except pge.DatabaseError as e:
+        logger.error(f"DatabaseError: unable to read changes from {slot}")
+        raise e
+
+
+def sql_confirm_changes(conn, slot, lsn):
+    """ Moves a replication slot past the changes up to an LSN, so the
+    database can recycle the WAL holding them.
+
+    Args:
+        conn: An open database Connection.
+        slot: The name of the replication slot.
+        lsn: The LSN, as text, of the last change written.
+
+    Raises:
+        DatabaseError
+    """
+    try:
+        conn.run("SELECT pg_replication_slot_advance("
+                 ":slot, CAST(:lsn AS pg_lsn));", slot=slot, lsn=lsn)
+    except pge.DatabaseError as e:
+        logger.error(f"DatabaseError: unable to advance {slot} to {lsn}")
+        raise e
+
+
+def parse_lsn(lsn):
+    """ Converts an LSN in the 'X/Y' text form to an integer so LSNs
+    can be compared.
+
+    Args:
+        lsn: An LSN as text, or None.
+
+    Returns:
+        The LSN as an integer, or -1 if it is None.
+    """
+    if lsn is None:
+        return -1
+    high, low = lsn.split("/")
+    return (int(high, 16) << 32) + int(low, 16)
+
+
+def parse_decoded_value(text):
+    """ Converts a value printed by 'test_decoding' back to text.
+
+    Args:
+        text: The value as printed, quoted if it is a string type.
+
+    Returns:
+        The value as a string, or None for nulls and unchanged TOAST
+        values, which are not included in the change.
+    """
+    if text.startswith("'"):
+        return text[1:-1].replace("''", "'")
+    if text in ("null", "unchanged-toast-datum"):
+        return None
+    return text
+
+
+def parse_decoded_change(data):
+    """ Parses a row change printed by the 'test_decoding' plugin, such
+    as "table public.staff: UPDATE: staff_id[integer]:1 ...".
+
+    Args:
+        data: The decoded text of a change.
+
+    Returns:
+        A tuple of the table name, the change type ('insert', 'update',
+        'delete' or 'truncate') and a dictionary of the row's values
+        keyed by column, or None if the text is not a row change. An
+        update that changes the key holds the new row, and a delete
+        holds only the replica identity columns.
+    """
+    match = DECODED_CHANGE.match(data)
+    if match is None:
+        return None
+    table = match.group(1).rsplit(".", 1)[-1].strip('"')
+    values = {}
+    target = values
+    for column in DECODED_COLUMN.finditer(match.group(3)):
+        marker, name, data_type, text = column.groups()
+        if marker is not None:
+            target = {} if marker == "old-key:" else values
+            continue
+        if name.startswith('"'):
+            name = name[1:-1].replace('""', '"')
+        target[name] = parse_decoded_value(text)
+    return table, match.group(2).lower(), values
+
+
+def group_decoded_changes(rows, after=None):
+    """ Groups the changes read from a replication slot by table,
+    keeping only committed transactions not already written.
+
+    Args:
+        rows: Rows returned by 'sql_peek_changes'.
+        (OPTIONAL) after: The LSN, as text, of the last commit written
+        by an earlier run; transactions committed up to it are dropped.
+
+    Returns:
+        A tuple of a dictionary keyed by table of lists of
+        (change type, commit LSN, values) tuples in commit order, and
+        the LSN of the last commit read, or None if there were none.
+    """
+    changes = {}
+    pending = []
+    last_lsn = None
+    for lsn, xid, data in rows:
+        if data.startswith("BEGIN"):
+            pending = []
+        elif data.startswith("COMMIT"):
+            last_lsn = lsn
+            if parse_lsn(lsn) > parse_lsn(after):
+                for table, change_type, values in pending:
+                    changes.setdefault(table, []).append(
+                        (change_type, lsn, values))
+            pending = []
+        else:
+            change = parse_decoded_change(data)
+            if change is not None:
+                pending.append(change)
+    return changes, last_lsn
+
+
+def changes_to_bucket_csv_file(bucket_name, bucket_key, column_headers,
+                               changes):
+    """ Uploads a table's changes to S3 as a csv file, with the change
+    type and commit LSN of each row in extra columns.
+
+    Args:
+        bucket_name: The name of the bucket in S3.
+        bucket_key: The name of the file and path the data will
+        be stored in.
+        column_headers: A list of the table's column headers.
+        changes: The table's list from 'group_decoded_changes'.
+
+    Returns:
+        A dictionary of the 'row_count', 'byte_count' and
+        'last_updated' value (always None) of the upload.
+
+    Raises:
+        ClientError
+    """
+    with measure("encode"):
+        body = encode_csv_rows(
+            ([values.get(column) for column in column_headers]
+             + [change_type, lsn] for change_type, lsn, values in changes),
+            column_headers + CHANGE_COLUMNS)
+    try:
+        with measure("upload"):
+            get_s3_client().put_object(Bucket=bucket_name, Key=bucket_key,
+                                       Body=body)
+    except botocore.exceptions.ClientError as e:
+        if e.response["Error"]["Code"] == "NoSuchBucket":
+            logger.error(f"{bucket_name} does not exist in your S3")
+        raise e
+    return {"row_count": len(changes), "byte_count": len(body),
+            "last_updated": None}
+
+
+def ingest_changes(pool, tables, bucket_name, settings, run_at, run_id,
+                   deadline=None, work_plan=None):
+    """ Writes the row changes a logical replication slot has recorded
+    since the last run, as a delta file for each table that changed.
+
+    The slot is created on the first run. Tables with nothing in the
+    bucket yet are exported in full instead, which happens after the
+    slot exists so no change is missed. The slot is only advanced, and
+    the last commit LSN saved, once every file has been written, so a
+    run that fails or runs out of time part way reads the same changes
+    again.
+
+    Change files are always CSV with the values as decoded text, even
+    when the full exports are Parquet.
+
+    Args:
+        pool: The ConnectionPool to take connections from.
+        tables: A list of table names.
+        bucket_name: The name of the bucket in S3.
+        settings: Dictionary returned by 'get_ingestion_settings'.
+        run_at: The datetime the run started.
+        run_id: A string identifying the run.
+        (OPTIONAL) deadline: The 'time.monotonic' time after which no
+        more tables are started.
+        (OPTIONAL) work_plan: Dictionary of each table's estimated
+        seconds under 'costs' and the tables left over by the last run
+        under 'deferred', updated in place.
+
+    Returns:
+        Dictionary with keys of table names whose values are 'updated',
+        'unchanged', 'failed' or 'deferred'.
+    """
+    slot = settings["cdc_slot"]
+    work_plan = work_plan if work_plan is not None else \
+        {"costs": {}, "deferred": []}
+    key_states = list_key_states(bucket_name,
+                                 [f"{table}/" for table in tables])
+    cdc_state = load_state_from_s3(bucket_name, CDC_STATE_KEY, {})
+    with pool.connection() as conn:
+        catalog = get_schema_catalog(conn, tables, bucket_name)
+        sql_create_replication_slot(conn, slot)
+        check_start = time.perf_counter()
+        rows = sql_peek_changes(conn, slot, settings["cdc_max_changes"])
+        check_seconds = time.perf_counter() - check_start
+    changes, lsn = group_decoded_changes(rows, cdc_state.get("lsn"))
+
+    projection = COLUMN_PROJECTION if settings["project_columns"] else None
+    table_metrics = {table: TableMetrics() for table in tables}
+    durations = {}
+
+    def ingest(table):
+        if not fits_deadline(deadline, work_plan["costs"].get(table)):
+            return {"deferred": True}
+        columns = get_projected_columns(
+            table, get_catalog_columns(catalog, table), projection)
+        start = time.monotonic()
+        with collect_metrics(table_metrics[table]):
+            if not key_states[f"{table}/"]["exists"]:
+                key = get_delta_key(table, run_at, run_id,
+                                    settings["format"])
+                summary = ingest_table(
+                    pool, table, columns, bucket_name, key, settings,
+                    column_types=get_catalog_types(catalog, table))
+            else:
+                key = get_delta_key(table, run_at, run_id)
+                summary = changes_to_bucket_csv_file(
+                    bucket_name, key, columns, changes[table])
+        durations[table] = time.monotonic() - start
+        summary["key"] = key
+        return summary
+
+    exports = order_work(
+        [table for table in tables
+         if not key_states[f"{table}/"]["exists"] or table in changes],
+        work_plan["costs"], work_plan["deferred"])
+    outcomes = run_tasks(ingest, exports, settings["workers"])
+
+    results = {table: "unchanged" for table in tables}
+    files = []
+    for table in exports:
+        if isinstance(outcomes[table], Exception):
+            logger.error(f"Ingestion of {table} failed: {outcomes[table]}")
+            results[table] = "failed"
+        elif outcomes[table].get("deferred"):
+            results[table] = "deferred"
+        else:
+            results[table] = "updated"
+            table_metrics[table].add_outcome(outcomes[table])
+            files.append({"table": table, "key": outcomes[table]["key"],
+                          "row_count": outcomes[table]["row_count"],
+                          "watermark_from": cdc_state.get("lsn"),
+                          "watermark_to": lsn})
+    update_work_plan(work_plan, results, durations)
+    if settings["metrics_namespace"]:
+        emit_table_metrics(settings["metrics_namespace"], results,
+                           table_metrics, check_seconds)
+
+    if files:
+        write_manifest(bucket_name, run_at, run_id, files)
+    if lsn is not None and not any(
+            result in ("failed", "deferred") for result in results.values()):
+        save_state_to_s3(bucket_name, CDC_STATE_KEY,
+                         {"slot": slot, "lsn": lsn})
+        with pool.connection() as conn:
+            sql_confirm_changes(conn, slot, lsn)
+    return results
@@ -16,16 +16,37 @@ import psycopg2
 import psycopg2.extras
 import numpy as np
 import os
+import time
+from decimal import Decimal
 
 
 logger = logging.getLogger("population")
 logger.setLevel(logging.INFO)
 
+# Kept at module level so warm invocations reuse the client and any
+# secrets fetched within their time to live.
+_secrets_client = None
+_secret_cache = {}
+_s3_client = None
+
+WORK_PLAN_KEY = "_state/population_plan.json"
+COST_SMOOTHING = 0.5
+
 
 def lambda_handler(event, context):
     """ Retrieves and reads parquet files from S3, and inserts the
         data into the Data Warehouse.
 
+        When the Lambda context reports the time remaining, dimension
+        tables are loaded before fact tables, each group with the tables
+        left over by the last run first and then from the longest
+        estimated first. A table is only started if its estimate fits
+        before 'TF_DEADLINE_MARGIN' seconds short of the timeout, and
+        fact tables wait while any dimension table is left for the next
+        run. A dimension table that fails does not hold them back, as
+        it may fail again on every run. A run that leaves tables over
+        starts the next run itself.
+
     Args:
         event: An AWS event object.
         context: A valid AWS lambda Python context object.
@@ -42,10 +63,27 @@ def lambda_handler(event, context):
                   "dim_payment_type", "dim_currency", "fact_sales_order",
                   "fact_purchase_order", "fact_payment"]
 
+    DEADLINE_MARGIN = float(os.environ.get('TF_DEADLINE_MARGIN', 10))
+
+    deadline = get_deadline(context, DEADLINE_MARGIN)
+    work_plan = load_work_plan(BUCKET) \
+        if deadline is not None else {"costs": {}, "deferred": []}
+    dim_tables = [table for table in TABLE_LIST if table.startswith('dim_')]
+    fact_tables = [table for table in TABLE_LIST if table not in dim_tables]
     results_dict = {}
+    deferred = []
 
-    for table in TABLE_LIST:
+    for table in order_work(dim_tables, work_plan["costs"],
+                            work_plan["deferred"]) + \
+            order_work(fact_tables, work_plan["costs"],
+                       work_plan["deferred"]):
         results_dict[f'{table}'] = False
+        if not fits_deadline(deadline, work_plan["costs"].get(table)) or \
+                (table in fact_tables and
+                 any(dim in deferred for dim in dim_tables)):
+            deferred.append(table)
+            continue
+        start = time.monotonic()
         try:
             key = f'{table}.parquet'
             df = load_parquet_from_s3(BUCKET, key)
@@ -54,17 +92,33 @@ def lambda_handler(event, context):
             logger.error(err)
         else:
             results_dict[f'{table}'] = True
-
+            update_cost_estimate(
+                work_plan["costs"], table, time.monotonic() - start)
+
+    if deadline is not None:
+        work_plan["deferred"] = deferred
+        save_work_plan(BUCKET, work_plan)
+    if deferred:
+        logger.warning(f'Out of time, deferring {deferred} to the next run')
+        # Nothing else triggers another run, so start one, unless none of
+        # the tables fitted and it would only defer them again.
+        if len(deferred) < len(results_dict):
+            invoke_again(context)
     logger.info(results_dict)
     return results_dict
 
 
-def get_secret_value(secret_name):
+def get_secret_value(secret_name, force_refresh=False):
     """Finds data for a specified secret on SecretsManager.
 
+    Secrets are cached for 'TF_SECRET_CACHE_TTL' seconds so the lookup
+    for each table does not call SecretsManager again.
+
     Args:
         secret_id: The Secret Name that holds the username and password
         for your data base.
+        force_refresh: Fetch the secret even if it is cached, for
+        example after the cached credentials were rejected.
 
     Returns:
         Dictionary containing data on secret.
@@ -75,17 +129,51 @@ def get_secret_value(secret_name):
         UnrecognizedClientException
         RuntimeError
     """
-    secrets = boto3.client("secretsmanager")
+    global _secrets_client
+    ttl = float(os.environ.get('TF_SECRET_CACHE_TTL', 300))
+    cached = _secret_cache.get(secret_name)
+    if cached is not None and not force_refresh and \
+            time.monotonic() - cached[0] < ttl:
+        return cached[1]
     try:
-        secret_value = secrets.get_secret_value(SecretId=secret_name)
+        if _secrets_client is None:
+            _secrets_client = boto3.client("secretsmanager")
+        secret_value = _secrets_client.get_secret_value(SecretId=secret_name)
     except Exception as e:
         logger.error(e)
         raise RuntimeError
     else:
         secrets_dict = json.loads(secret_value["SecretString"])
+        _secret_cache[secret_name] = (time.monotonic(), secrets_dict)
         return secrets_dict
 
 
+def get_s3_client():
+    """ Return the S3 client, creating it on first use.
+
+    Returns:
+        A boto3 S3 client, reused by warm invocations.
+    """
+    global _s3_client
+    if _s3_client is None:
+        _s3_client = boto3.client('s3')
+    return _s3_client
+
+
+def invoke_again(context):
+    """ Start another run of this Lambda for the tables left over.
+
+    Args:
+        context: The Lambda context object of the current run.
+    """
+    try:
+        boto3.client('lambda').invoke(
+            FunctionName=context.invoked_function_arn,
+            InvocationType='Event', Payload=json.dumps({"deferred": True}))
+    except Exception as err:
+        logger.error(f'Unable to start another run: {err}')
+
+
 def load_parquet_from_s3(bucket, key):
     """ Retrieve a Parquet file from an S3 bucket.
 
@@ -96,7 +184,7 @@ def load_parquet_from_s3(bucket, key):
     Returns:
         DataFrame containing the contents of the Parquet file.
     """
-    s3 = boto3.client('s3')
+    s3 = get_s3_client()
     try:
         s3_response_object = s3.get_object(
             Bucket=bucket, Key=key)
@@ -108,6 +196,64 @@ def load_parquet_from_s3(bucket, key):
         raise RuntimeError
 
 
+def load_work_plan(bucket):
+    """ Retrieve the cost estimates and deferred tables of past runs.
+
+    Args:
+        bucket: Name of the S3 bucket the plan is stored in.
+
+    Returns:
+        Dictionary of each table's estimated seconds under 'costs' and
+        the tables the last run ran out of time for under 'deferred'.
+    """
+    s3 = get_s3_client()
+    try:
+        s3_response_object = s3.get_object(Bucket=bucket, Key=WORK_PLAN_KEY)
+    except s3.exceptions.NoSuchKey:
+        return {"costs": {}, "deferred": []}
+    return json.loads(s3_response_object['Body'].read())
+
+
+def save_work_plan(bucket, work_plan):
+    """ Store the cost estimates and deferred tables for the next run.
+
+    Args:
+        bucket: Name of the S3 bucket to store the plan in.
+        work_plan: Dictionary returned by 'load_work_plan'.
+    """
+    get_s3_client().put_object(Bucket=bucket, Key=WORK_PLAN_KEY,
+                               Body=json.dumps(work_plan))
+
+
+# The deadline helpers below are copies of those in ingestion.py, as each
+# Lambda is deployed as a single file. tests/test_work_plan.py checks
+# they stay the same.
+def get_deadline(context, margin):
+    """ Work out when a run should stop starting new work. """
+    remaining = getattr(context, "get_remaining_time_in_millis", None)
+    if remaining is None:
+        return None
+    return time.monotonic() + remaining() / 1000 - margin
+
+
+def order_work(items, costs, deferred=()):
+    """ Order work with the items left over by the last run first. """
+    return sorted(items, key=lambda item: (
+        item not in deferred, -costs.get(item, 0)))
+
+
+def fits_deadline(deadline, estimate=None):
+    """ Check whether there is time left to start an item of work. """
+    return deadline is None or time.monotonic() + (estimate or 0) < deadline
+
+
+def update_cost_estimate(costs, item, seconds):
+    """ Fold the time an item took into its cost estimate. """
+    previous = costs.get(item)
+    costs[item] = round(seconds if previous is None else COST_SMOOTHING *
+                        seconds + (1 - COST_SMOOTHING) * previous, 3)
+
+
 def get_warehouse_connection(credentials):
     """ Establish connection to the Data Warehouse DB.
 
@@ -145,6 +291,10 @@ def insert_data_into_db(data_df, table):
 
         credentials = get_secret_value('warehouse_credentials')
         conn = get_warehouse_connection(credentials)
+        if conn is None:
+            credentials = get_secret_value('warehouse_credentials',
+                                           force_refresh=True)
+            conn = get_warehouse_connection(credentials)
         cursor = conn.cursor()
     except Exception as err:
         logger.error(err)
@@ -198,6 +348,13 @@ def insert_data_into_db(data_df, table):
                 else:
                     dw_df = dw_df.astype(TROUBLE_TABLES[table])
 
+            # Exact numerics from Parquet landing files arrive as
+            # Decimals, but DEC2FLOAT reads the warehouse's as floats.
+            decimals = [column for column in data_df.columns
+                        if data_df[column].map(
+                            lambda value: isinstance(value, Decimal)).any()]
+            data_df = data_df.astype(dict.fromkeys(decimals, 'float64'))
+
             df_all = data_df.merge(
                 dw_df, on=dw_table_titles, how='left', indicator=True)
             df_all = df_all.drop(df_all[df_all['_merge'] == 'both'].index)
@@ -9,22 +9,37 @@ The script is intended to run on AWS Lambda.
 
 import boto3
 import pandas as pd
+import pyarrow.parquet as pq
 import logging
 from io import BytesIO
+import json
 import os
+import time
 
 logger = logging.getLogger("processing")
 logger.setLevel(logging.INFO)
 
 s3 = boto3.client('s3')
 
+WORK_PLAN_KEY = "_state/transformation_plan.json"
+COST_SMOOTHING = 0.5
+
 
 def transform_data(event, context):
-    """ Loads csv files from s3 ingestion bucket.
+    """ Loads csv files from s3 ingestion bucket, or parquet files if
+        'TF_INGESTION_FORMAT' is 'parquet'.
         Invokes formatting functions on the resulting dataframes.
         Converts dataframe to parquet format.
         Uploads to s3 processing bucket.
 
+        Each file is loaded, formatted and uploaded in turn, so a file
+        that fails does not stop the others. When the Lambda context
+        reports the time remaining, files left over by the last run go
+        first, then the rest from the longest estimated first, and a
+        file is only started if its estimate fits before
+        'TF_DEADLINE_MARGIN' seconds short of the timeout. The others
+        are left for the next run, which this run starts itself.
+
     Args:
         event: An AWS event object.
         context: A valid AWS lambda Python context object.
@@ -35,62 +50,83 @@ def transform_data(event, context):
     """
     INGEST_BUCKET = os.environ.get('TF_ING_BUCKET')
     PROCESSED_BUCKET = os.environ.get('TF_PRO_BUCKET')
-
-    files_list = ["staff.csv", "department.csv", "address.csv",
-                  "design.csv", "counterparty.csv", "transaction.csv",
-                  "payment_type.csv", "currency.csv"]
-    try:
-        df_list = [load_csv_from_s3(
-            INGEST_BUCKET, file, parse_dates=["created_at", "last_updated"])
-            for file in files_list]
-        sales_order_df = load_csv_from_s3(INGEST_BUCKET, "sales_order.csv",
-                                          parse_dates=["created_at",
-                                                       "last_updated",
-                                                       "agreed_delivery_date",
-                                                       "agreed_payment_date"])
-        purchase_order_df = load_csv_from_s3(
-            INGEST_BUCKET, "purchase_order.csv",
-            parse_dates=["created_at", "last_updated",
-                         "agreed_delivery_date", "agreed_payment_date"])
-        payment_df = load_csv_from_s3(
-            INGEST_BUCKET, "payment.csv", parse_dates=["created_at",
-                                                       "last_updated",
-                                                       "payment_date"])
-        (staff_df, dept_df, address_df, design_df, counterparty_df,
-         transaction_df, payment_type_df, currency_df) = df_list
-    except Exception as error:
-        logger.error(f'Error when retrieving files: {error}')
-
-    try:
-        files_dict = {}
-        files_dict["dim_staff.parquet"] = format_dim_staff(staff_df, dept_df)
-        files_dict["dim_location.parquet"] = format_dim_location(address_df)
-        files_dict["dim_design.parquet"] = format_dim_design(design_df)
-        files_dict["dim_date.parquet"] = format_dim_date(
-            start='2020-01-01', end='2024-12-31')
-        files_dict["dim_currency.parquet"] = format_dim_currency(currency_df)
-        files_dict["dim_counterparty.parquet"] = format_dim_counterparty(
-            counterparty_df, address_df)
-        files_dict["dim_transaction.parquet"] = format_dim_transaction(
-            transaction_df)
-        files_dict["dim_payment_type.parquet"] = format_dim_payment_type(
-            payment_type_df)
-        files_dict["fact_sales_order.parquet"] = format_fact_sales_order(
-            sales_order_df)
-        files_dict["fact_purchase_order.parquet"] = format_fact_purchase_order(
-            purchase_order_df)
-        files_dict["fact_payment.parquet"] = format_fact_payment(
-            payment_df)
-    except Exception as error:
-        logger.error(f'Error when formatting files: {error}')
-
-    try:
-        upload_results = {item: export_parquet_to_s3(
-            files_dict[item], PROCESSED_BUCKET, item) for item in files_dict}
+    INGEST_FORMAT = os.environ.get('TF_INGESTION_FORMAT', 'csv')
+    DEADLINE_MARGIN = float(os.environ.get('TF_DEADLINE_MARGIN', 10))
+
+    dates = ["created_at", "last_updated"]
+    order_dates = dates + ["agreed_delivery_date", "agreed_payment_date"]
+    parse_dates = {"sales_order": order_dates,
+                   "purchase_order": order_dates,
+                   "payment": dates + ["payment_date"]}
+    files = {
+        "dim_staff.parquet": (format_dim_staff, ["staff", "department"]),
+        "dim_location.parquet": (format_dim_location, ["address"]),
+        "dim_design.parquet": (format_dim_design, ["design"]),
+        "dim_date.parquet": (lambda: format_dim_date(
+            start='2020-01-01', end='2024-12-31'), []),
+        "dim_currency.parquet": (format_dim_currency, ["currency"]),
+        "dim_counterparty.parquet": (format_dim_counterparty,
+                                     ["counterparty", "address"]),
+        "dim_transaction.parquet": (format_dim_transaction,
+                                    ["transaction"]),
+        "dim_payment_type.parquet": (format_dim_payment_type,
+                                     ["payment_type"]),
+        "fact_sales_order.parquet": (format_fact_sales_order,
+                                     ["sales_order"]),
+        "fact_purchase_order.parquet": (format_fact_purchase_order,
+                                        ["purchase_order"]),
+        "fact_payment.parquet": (format_fact_payment, ["payment"])}
+
+    deadline = get_deadline(context, DEADLINE_MARGIN)
+    work_plan = load_work_plan(PROCESSED_BUCKET) \
+        if deadline is not None else {"costs": {}, "deferred": []}
+    dataframes = {}
+    upload_results = {}
+    deferred = []
+    for item in order_work(files, work_plan["costs"], work_plan["deferred"]):
+        upload_results[item] = None
+        if not fits_deadline(deadline, work_plan["costs"].get(item)):
+            deferred.append(item)
+            continue
+        start = time.monotonic()
+        formatter, tables = files[item]
+        try:
+            for table in tables:
+                if table not in dataframes:
+                    dataframes[table] = load_table_from_s3(
+                        INGEST_BUCKET, table, INGEST_FORMAT,
+                        parse_dates=parse_dates.get(table, dates))
+        except Exception as error:
+            logger.error(f'Error when retrieving files: {error}')
+            continue
+
+        try:
+            data = formatter(*[dataframes[table] for table in tables])
+        except Exception as error:
+            logger.error(f'Error when formatting files: {error}')
+            continue
+
+        try:
+            upload_results[item] = export_parquet_to_s3(
+                data, PROCESSED_BUCKET, item)
+        except Exception as error:
+            logger.error(f'Error when uploading files: {error}')
+            continue
+        update_cost_estimate(
+            work_plan["costs"], item, time.monotonic() - start)
+
+    if deadline is not None:
+        work_plan["deferred"] = deferred
+        save_work_plan(PROCESSED_BUCKET, work_plan)
+    if deferred:
+        logger.warning(f'Out of time, deferring {deferred} to the next run')
+        # Nothing else triggers another run, so start one, unless none of
+        # the files fitted and it would only defer them again.
+        if len(deferred) < len(upload_results):
+            invoke_again(context)
+    if any(upload_results.values()):
         logger.info('SUCCESSFULLY PROCESSED')
-        return upload_results
-    except Exception as error:
-        logger.error(f'Error when uploading files: {error}')
+    return upload_results
 
 
 def format_dim_staff(staff_df, dept_df):
@@ -394,6 +430,63 @@ def load_csv_from_s3(bucket, key, parse_dates=[]):
         raise RuntimeError
 
 
+def load_parquet_from_s3(bucket, key):
+    """ Retrieve a Parquet file written by ingestion from an S3 bucket.
+
+    Column types are taken from the file rather than inferred, so
+    exact numeric columns are read as Decimals without losing precision.
+
+    Args:
+        bucket: Name of the S3 bucket from which to retrieve the file.
+        key: Key that the file is stored under in the named S3 bucket.
+
+    Returns:
+        DataFrame containing the contents of the Parquet file.
+
+    Raises:
+        NoSuchBucket
+        NoSuchKey
+        RuntimeError
+    """
+    try:
+        s3_response_object = s3.get_object(
+            Bucket=bucket, Key=key)
+        table = pq.read_table(BytesIO(s3_response_object['Body'].read()))
+        return table.to_pandas()
+    except s3.exceptions.NoSuchBucket:
+        logger.error('Bucket does not exist')
+        raise s3.exceptions.NoSuchBucket({}, '')
+    except s3.exceptions.NoSuchKey:
+        logger.error("Key not found in bucket")
+        raise s3.exceptions.NoSuchKey({}, '')
+    except Exception as e:
+        logger.error(e)
+        raise RuntimeError
+
+
+def load_table_from_s3(bucket, table, file_format="csv", parse_dates=[]):
+    """ Retrieve an ingested table from an S3 bucket in either format.
+
+    Args:
+        bucket: Name of the S3 bucket from which to retrieve the file.
+        table: Name of the table, stored as '{table}.{file_format}'.
+        file_format: Either 'csv' or 'parquet'.
+        parse_dates: A list of column names which contain dates to be
+        converted to datetime objects. Parquet files keep timestamp
+        columns typed, but dates stored as text are still converted.
+
+    Returns:
+        DataFrame containing the contents of the file.
+    """
+    if file_format == "parquet":
+        df = load_parquet_from_s3(bucket, f"{table}.parquet")
+        for column in parse_dates:
+            if column in df.columns:
+                df[column] = pd.to_datetime(df[column])
+        return df
+    return load_csv_from_s3(bucket, f"{table}.csv", parse_dates=parse_dates)
+
+
 def export_parquet_to_s3(data, bucket, key):
     """ Convert DataFrame to parquet file and store in an S3 bucket
 
@@ -429,3 +522,74 @@ def export_parquet_to_s3(data, bucket, key):
     except Exception as e:
         logger.error(e)
         raise RuntimeError
+
+
+def invoke_again(context):
+    """ Start another run of this Lambda for the files left over.
+
+    Args:
+        context: The Lambda context object of the current run.
+    """
+    try:
+        boto3.client('lambda').invoke(
+            FunctionName=context.invoked_function_arn,
+            InvocationType='Event', Payload=json.dumps({"deferred": True}))
+    except Exception as error:
+        logger.error(f'Unable to start another run: {error}')
+
+
+def load_work_plan(bucket):
+    """ Retrieve the cost estimates and deferred files of past runs.
+
+    Args:
+        bucket: Name of the S3 bucket the plan is stored in.
+
+    Returns:
+        Dictionary of each file's estimated seconds under 'costs' and
+        the files the last run ran out of time for under 'deferred'.
+    """
+    try:
+        s3_response_object = s3.get_object(Bucket=bucket, Key=WORK_PLAN_KEY)
+    except s3.exceptions.NoSuchKey:
+        return {"costs": {}, "deferred": []}
+    return json.loads(s3_response_object['Body'].read())
+
+
+def save_work_plan(bucket, work_plan):
+    """ Store the cost estimates and deferred files for the next run.
+
+    Args:
+        bucket: Name of the S3 bucket to store the plan in.
+        work_plan: Dictionary returned by 'load_work_plan'.
+    """
+    s3.put_object(Bucket=bucket, Key=WORK_PLAN_KEY,
+                  Body=json.dumps(work_plan))
+
+
+# The deadline helpers below are copies of those in ingestion.py, as each
+# Lambda is deployed as a single file. tests/test_work_plan.py checks
+# they stay the same.
+def get_deadline(context, margin):
+    """ Work out when a run should stop starting new work. """
+    remaining = getattr(context, "get_remaining_time_in_millis", None)
+    if remaining is None:
+        return None
+    return time.monotonic() + remaining() / 1000 - margin
+
+
+def order_work(items, costs, deferred=()):
+    """ Order work with the items left over by the last run first. """
+    return sorted(items, key=lambda item: (
+        item not in deferred, -costs.get(item, 0)))
+
+
+def fits_deadline(deadline, estimate=None):
+    """ Check whether there is time left to start an item of work. """
+    return deadline is None or time.monotonic() + (estimate or 0) < deadline
+
+
+def update_cost_estimate(costs, item, seconds):
+    """ Fold the time an item took into its cost estimate. """
+    previous = costs.get(item)
+    costs[item] = round(seconds if previous is None else COST_SMOOTHING *
+                        seconds + (1 - COST_SMOOTHING) * previous, 3)
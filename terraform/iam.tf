@@ -167,3 +167,39 @@ resource "aws_iam_role_policy_attachment" "populate-lambda-read-only-processed-b
   role       = aws_iam_role.populate-lambda-role.name
   policy_arn = aws_iam_policy.read-write-access-processed-bucket-policy.arn
 }
+
+data "aws_iam_policy_document" "invoke-processing-lambda-document" {
+  statement {
+    effect    = "Allow"
+    actions   = ["lambda:InvokeFunction"]
+    resources = ["arn:aws:lambda:${data.aws_region.current.name}:${data.aws_caller_identity.current.account_id}:function:${var.processing_lambda_name}"]
+  }
+}
+
+data "aws_iam_policy_document" "invoke-population-lambda-document" {
+  statement {
+    effect    = "Allow"
+    actions   = ["lambda:InvokeFunction"]
+    resources = ["arn:aws:lambda:${data.aws_region.current.name}:${data.aws_caller_identity.current.account_id}:function:${var.population_lambda_name}"]
+  }
+}
+
+resource "aws_iam_policy" "invoke-processing-lambda-policy" {
+  name_prefix = "invoke-processing-lambda-policy"
+  policy      = data.aws_iam_policy_document.invoke-processing-lambda-document.json
+}
+
+resource "aws_iam_policy" "invoke-population-lambda-policy" {
+  name_prefix = "invoke-population-lambda-policy"
+  policy      = data.aws_iam_policy_document.invoke-population-lambda-document.json
+}
+
+resource "aws_iam_role_policy_attachment" "processed-lambda-invoke-policy-attachment" {
+  role       = aws_iam_role.processed-lambda-role.name
+  policy_arn = aws_iam_policy.invoke-processing-lambda-policy.arn
+}
+
+resource "aws_iam_role_policy_attachment" "populate-lambda-invoke-policy-attachment" {
+  role       = aws_iam_role.populate-lambda-role.name
+  policy_arn = aws_iam_policy.invoke-population-lambda-policy.arn
+}
@@ -10,7 +10,31 @@ resource "aws_lambda_function" "ingestion_lambda" {
 
   environment {
     variables = {
-      TF_ING_BUCKET = aws_s3_bucket.ingest-bucket.bucket
+      TF_ING_BUCKET          = aws_s3_bucket.ingest-bucket.bucket
+      TF_INCREMENTAL         = "false"
+      TF_WATERMARK_OVERLAP   = "1 minute"
+      TF_INGESTION_ENGINE    = "select"
+      TF_STREAM_BATCH_SIZE   = "5000"
+      TF_INGESTION_WORKERS   = "1"
+      TF_SECRET_CACHE_TTL    = "300"
+      TF_INGESTION_LAYOUT    = "snapshot"
+      TF_RANGE_SCAN_ROWS     = "0"
+      TF_SKIP_UNCHANGED      = "false"
+      TF_INGESTION_FORMAT    = "csv"
+      TF_METRICS_NAMESPACE   = "TotesysIngestion"
+      TF_CHANGE_DETECTION    = "probe"
+      TF_POLL_MAX_SKIP_RUNS  = "0"
+      TF_DELETE_DETECTION    = "false"
+      TF_DELETE_LEAF_KEYS    = "1024"
+      TF_COLUMN_PROJECTION   = "false"
+      TF_COLUMN_STATS        = "false"
+      TF_CONSISTENT_SNAPSHOT = "false"
+      TF_REPLICA_HOSTS       = ""
+      TF_REPLICA_MAX_LAG     = "60"
+      TF_PROBE_TARGET        = "primary"
+      TF_DEADLINE_MARGIN     = "10"
+      TF_CDC_SLOT            = ""
+      TF_CDC_MAX_CHANGES     = "100000"
     }
   }
 }
@@ -46,8 +70,10 @@ resource "aws_lambda_function" "processing_lambda" {
 
   environment {
     variables = {
-      TF_ING_BUCKET = aws_s3_bucket.ingest-bucket.bucket
-      TF_PRO_BUCKET = aws_s3_bucket.processed-bucket.bucket
+      TF_ING_BUCKET       = aws_s3_bucket.ingest-bucket.bucket
+      TF_PRO_BUCKET       = aws_s3_bucket.processed-bucket.bucket
+      TF_INGESTION_FORMAT = "csv"
+      TF_DEADLINE_MARGIN  = "10"
     }
   }
 }
@@ -64,7 +90,9 @@ resource "aws_lambda_function" "population_lambda" {
 
   environment {
     variables = {
-      TF_PRO_BUCKET = aws_s3_bucket.processed-bucket.bucket
+      TF_PRO_BUCKET       = aws_s3_bucket.processed-bucket.bucket
+      TF_SECRET_CACHE_TTL = "300"
+      TF_DEADLINE_MARGIN  = "10"
     }
   }
 }
@@ -1,10 +1,14 @@
 import boto3
 from moto import mock_s3
-from unittest.mock import patch
+from unittest.mock import patch, MagicMock
+from io import BytesIO
 import pytest
 import os
 import botocore.errorfactory
+import pg8000.exceptions as pge
 import logging
+import json
+from datetime import datetime
 
 
 BUCKET_NAME = "test_ingestion_bucket"
@@ -15,6 +19,30 @@ TABLE_COLUMNS = ["column_id", "column_2", "column_3"]
 
 logger = logging.getLogger("TestLogger")
 
+TABLES = ['staff', 'transaction', 'design', 'address', 'sales_order',
+          'counterparty', 'payment', 'payment_type', 'currency',
+          'department', 'purchase_order']
+
+
+CATALOG = {"fingerprint": "test_fingerprint",
+           "tables": {table: [{"name": column, "data_type": "text"}
+                              for column in ["column_id", "column_2",
+                                             "column_3"]]
+                      for table in TABLES}}
+
+
+def probe_result(is_recent, last_updated=None):
+    return {table: {"last_updated": last_updated, "row_count": 1,
+                    "is_recent": is_recent} for table in TABLES}
+
+
+EXPORT_SUMMARY = {"row_count": 0, "byte_count": None, "last_updated": None}
+
+
+def key_states(exists):
+    return {f"{table}.csv": {"exists": exists, "size": None, "etag": None,
+                             "last_modified": None} for table in TABLES}
+
 
 @pytest.fixture(scope="function")
 def aws_credentials():
@@ -43,17 +71,17 @@ def s3_bucket(s3, bucket_name):
 
 
 # Test For Uploading To Bucket
-@patch("src.ingestion.sql_select_query", return_value=MOCK_QUERY_RETURN)
-def test_function_returns_correct_format_for_df(s3, s3_bucket):
+@patch("src.ingestion.sql_select_query", return_value=[
+    [1, datetime(2023, 3, 1)], [2, None], [3, datetime(2023, 2, 15)]])
+def test_function_returns_summary_of_export(s3, s3_bucket):
     import src.ingestion
 
     result = src.ingestion.data_to_bucket_csv_file(
-        "test_creds", TABLE_NAME, TABLE_COLUMNS, BUCKET_NAME, BUCKET_KEY
+        "test_conn", TABLE_NAME, ["column_id", "last_updated"], BUCKET_NAME,
+        BUCKET_KEY
     )
-    assert result == [
-        {"column_id": 1, "column_2": "row_1", "column_3": 1},
-        {"column_id": 2, "column_2": "row_2", "column_3": 2},
-    ]
+    assert result == {"row_count": 3, "byte_count": None,
+                      "last_updated": datetime(2023, 3, 1)}
 
 
 def test_file_will_be_uploaded_to_bucket(s3, s3_bucket):
@@ -63,7 +91,7 @@ def test_file_will_be_uploaded_to_bucket(s3, s3_bucket):
                return_value=MOCK_QUERY_RETURN):
 
         src.ingestion.data_to_bucket_csv_file(
-            "test_creds", TABLE_NAME, TABLE_COLUMNS, BUCKET_NAME, BUCKET_KEY
+            "test_conn", TABLE_NAME, TABLE_COLUMNS, BUCKET_NAME, BUCKET_KEY
         )
 
     obj_list = s3.list_objects_v2(Bucket=BUCKET_NAME)
@@ -78,7 +106,7 @@ def test_file_in_bucket_has_correct_data(s3, s3_bucket):
     with patch("src.ingestion.sql_select_query",
                return_value=MOCK_QUERY_RETURN):
         src.ingestion.data_to_bucket_csv_file(
-            "test_creds", TABLE_NAME, TABLE_COLUMNS, BUCKET_NAME, BUCKET_KEY
+            "test_conn", TABLE_NAME, TABLE_COLUMNS, BUCKET_NAME, BUCKET_KEY
         )
 
     data = s3.get_object(Bucket=BUCKET_NAME, Key="test.csv")["Body"].read()
@@ -92,13 +120,46 @@ def test_function_raises_and_logs_error_if_bucket_does_not_exist(s3, s3_bucket,
 
     with pytest.raises(botocore.errorfactory.ClientError):
         src.ingestion.data_to_bucket_csv_file(
-            "test_creds", TABLE_NAME, TABLE_COLUMNS, "no_bucket", BUCKET_KEY
+            "test_conn", TABLE_NAME, TABLE_COLUMNS, "no_bucket", BUCKET_KEY
         )
 
     assert caplog.records[0].levelno == logging.ERROR
     assert caplog.records[0].msg == "no_bucket does not exist in your S3"
 
 
+@patch("src.ingestion.sql_select_query", return_value=MOCK_QUERY_RETURN)
+def test_function_raises_any_other_s3_error(s3, s3_bucket):
+    import src.ingestion
+
+    error = botocore.errorfactory.ClientError(
+        {"Error": {"Code": "AccessDenied"}}, "PutObject")
+    with patch.object(src.ingestion.get_s3_client(), "put_object",
+                      side_effect=error):
+        with pytest.raises(botocore.errorfactory.ClientError):
+            src.ingestion.data_to_bucket_csv_file(
+                "test_conn", TABLE_NAME, TABLE_COLUMNS, BUCKET_NAME,
+                BUCKET_KEY, column_stats=True)
+
+    assert "Contents" not in s3.list_objects_v2(Bucket=BUCKET_NAME)
+
+
+@patch("src.ingestion.sql_select_query", return_value=MOCK_QUERY_RETURN)
+def test_function_records_content_hash_only_after_upload(s3, s3_bucket):
+    import src.ingestion
+
+    content_hashes = {}
+    with pytest.raises(botocore.errorfactory.ClientError):
+        src.ingestion.data_to_bucket_csv_file(
+            "test_conn", TABLE_NAME, TABLE_COLUMNS, "no_bucket", BUCKET_KEY,
+            content_hashes=content_hashes)
+    assert content_hashes == {}
+
+    src.ingestion.data_to_bucket_csv_file(
+        "test_conn", TABLE_NAME, TABLE_COLUMNS, BUCKET_NAME, BUCKET_KEY,
+        content_hashes=content_hashes)
+    assert TABLE_NAME in content_hashes
+
+
 @patch("src.ingestion.sql_select_query", return_value=MOCK_QUERY_RETURN)
 def test_function_raises_and_logs_error_if_bucket_key_invalid(s3, s3_bucket,
                                                               caplog):
@@ -106,24 +167,27 @@ def test_function_raises_and_logs_error_if_bucket_key_invalid(s3, s3_bucket,
 
     with pytest.raises(botocore.exceptions.ParamValidationError):
         src.ingestion.data_to_bucket_csv_file(
-            "test_creds", TABLE_NAME, TABLE_COLUMNS, BUCKET_NAME, 5
+            "test_conn", TABLE_NAME, TABLE_COLUMNS, BUCKET_NAME, 5
         )
 
     assert caplog.records[0].levelno == logging.ERROR
     assert caplog.records[0].msg == "The request has invalid params"
 
 
+@patch("src.ingestion.get_schema_catalog", return_value=CATALOG)
 @patch("src.ingestion.get_secret_value")
 @patch("src.ingestion.Connection")
 @patch("src.ingestion.data_to_bucket_csv_file")
-@patch("src.ingestion.check_key_exists", return_value=False)
-@patch("src.ingestion.sql_check_updated", return_value=False)
+@patch("src.ingestion.list_key_states", return_value=key_states(False))
+@patch("src.ingestion.sql_probe_tables", return_value=probe_result(False))
 def test_function_uploads_data_for_first_time_on_s3(
     mock_sql, mock_no_key, mock_upload_function, mock_connection,
-    mock_secret, caplog
+    mock_secret, mock_catalog, caplog
 ):
     import src.ingestion
 
+    mock_upload_function.return_value = EXPORT_SUMMARY
+
     test_query = []
     mock_connection().run.return_value = test_query
     test_headers = []
@@ -136,17 +200,20 @@ def test_function_uploads_data_for_first_time_on_s3(
     assert caplog.records[0].msg == "SUCCESSFUL INGESTION"
 
 
+@patch("src.ingestion.get_schema_catalog", return_value=CATALOG)
 @patch("src.ingestion.get_secret_value")
 @patch("src.ingestion.Connection")
 @patch("src.ingestion.data_to_bucket_csv_file")
-@patch("src.ingestion.check_key_exists", return_value=True)
-@patch("src.ingestion.sql_check_updated", return_value=True)
+@patch("src.ingestion.list_key_states", return_value=key_states(True))
+@patch("src.ingestion.sql_probe_tables", return_value=probe_result(True))
 def test_function_uploads_data_if_updated_is_true(
     mock_sql, mock_key, mock_upload_function, mock_connection,
-    mock_secret, caplog
+    mock_secret, mock_catalog, caplog
 ):
     import src.ingestion
 
+    mock_upload_function.return_value = EXPORT_SUMMARY
+
     test_query = []
     mock_connection().run.return_value = test_query
     test_headers = []
@@ -159,17 +226,20 @@ def test_function_uploads_data_if_updated_is_true(
     assert caplog.records[0].msg == "SUCCESSFUL INGESTION"
 
 
+@patch("src.ingestion.get_schema_catalog", return_value=CATALOG)
 @patch("src.ingestion.get_secret_value")
 @patch("src.ingestion.Connection")
 @patch("src.ingestion.data_to_bucket_csv_file")
-@patch("src.ingestion.check_key_exists", return_value=True)
-@patch("src.ingestion.sql_check_updated", return_value=False)
+@patch("src.ingestion.list_key_states", return_value=key_states(True))
+@patch("src.ingestion.sql_probe_tables", return_value=probe_result(False))
 def test_function_does_not_upload_data_if_updated_is_false(
     mock_sql, mock_key, mock_upload_function, mock_connection,
-    mock_secret, caplog
+    mock_secret, mock_catalog, caplog
 ):
     import src.ingestion
 
+    mock_upload_function.return_value = EXPORT_SUMMARY
+
     test_query = []
     mock_connection().run.return_value = test_query
     test_headers = []
@@ -182,12 +252,1119 @@ def test_function_does_not_upload_data_if_updated_is_false(
     assert caplog.records[0].msg == "NO FILES TO UPDATE"
 
 
+@patch("src.ingestion._secrets_client", None)
 @patch("src.ingestion.boto3")
 def test_get_secret_value_error(mock_boto):
     from src.ingestion import get_secret_value
     err = botocore.errorfactory.ClientError(
         {'Error': {"Code": "UnrecognizedClientException"}}, '')
     err.response["Error"]["Code"] == "UnrecognizedClientException"
+    mock_boto.client.return_value.exceptions = boto3.client(
+        "secretsmanager", region_name="us-east-1").exceptions
     mock_boto.client.return_value.get_secret_value.side_effect = err
     with pytest.raises(botocore.errorfactory.ClientError):
         get_secret_value('test')
+
+
+@patch("src.ingestion.get_schema_catalog", return_value=CATALOG)
+@patch("src.ingestion.get_secret_value")
+@patch("src.ingestion.Connection")
+@patch("src.ingestion.data_to_bucket_csv_file")
+@patch("src.ingestion.list_key_states", return_value=key_states(False))
+def test_function_opens_one_connection_per_run(
+    mock_key, mock_upload_function, mock_connection, mock_secret,
+    mock_catalog
+):
+    import src.ingestion
+
+    mock_upload_function.return_value = EXPORT_SUMMARY
+
+    mock_connection.return_value.run.return_value = []
+    mock_connection.return_value.columns = []
+
+    src.ingestion.lambda_handler({}, {})
+    assert mock_connection.call_count == 1
+    used_connections = {
+        call.args[0] for call in mock_upload_function.call_args_list}
+    assert used_connections == {mock_connection.return_value}
+
+
+@patch.dict(os.environ, {"TF_INCREMENTAL": "true",
+                         "TF_INGESTION_LAYOUT": "delta",
+                         "TF_ING_BUCKET": BUCKET_NAME})
+@patch("src.ingestion.get_secret_value")
+@patch("src.ingestion.Connection")
+@patch("src.ingestion.get_schema_catalog", return_value=CATALOG)
+@patch("src.ingestion.sql_probe_tables")
+@patch("src.ingestion.data_to_bucket_csv_file")
+def test_function_exports_rows_past_saved_watermarks(
+    mock_upload_function, mock_sql, mock_catalog, mock_connection,
+    mock_secret, s3, s3_bucket
+):
+    import src.ingestion
+
+    s3.put_object(Bucket=BUCKET_NAME,
+                  Key="staff/date=2023-02-01/093000-run.csv", Body=b"")
+    s3.put_object(Bucket=BUCKET_NAME, Key="_state/watermarks.json",
+                  Body=b'{"staff": "2023-02-01T09:30:00"}')
+    mock_sql.return_value = probe_result(
+        False, last_updated=datetime(2023, 2, 1, 10, 0))
+    mock_upload_function.return_value = {
+        "row_count": 1, "byte_count": None,
+        "last_updated": datetime(2023, 2, 1, 10, 0)}
+
+    src.ingestion.lambda_handler({}, {})
+
+    staff_call = mock_upload_function.call_args_list[0]
+    assert staff_call.args[1] == "staff"
+    assert staff_call.kwargs["since"] == datetime(2023, 2, 1, 9, 30)
+    # tables without a watermark are exported in full to establish one
+    assert mock_upload_function.call_count == 11
+    assert all(call.kwargs["since"] is None
+               for call in mock_upload_function.call_args_list[1:])
+
+    state = s3.get_object(Bucket=BUCKET_NAME, Key="_state/watermarks.json")
+    watermarks = json.loads(state["Body"].read())
+    assert watermarks["staff"] == "2023-02-01T10:00:00"
+
+
+@patch.dict(os.environ, {"TF_INCREMENTAL": "true"})
+def test_incremental_is_ignored_outside_the_delta_layout(caplog):
+    from src.ingestion import get_ingestion_settings
+
+    assert not get_ingestion_settings()["incremental"]
+    assert "TF_INCREMENTAL needs TF_INGESTION_LAYOUT=delta" in caplog.text
+
+    with patch.dict(os.environ, {"TF_INGESTION_LAYOUT": "delta"}):
+        assert get_ingestion_settings()["incremental"]
+
+
+# Test Streaming Upload
+def test_encode_csv_rows_matches_the_select_engine_output():
+    from src.ingestion import encode_csv_rows
+
+    assert encode_csv_rows(MOCK_QUERY_RETURN, TABLE_COLUMNS) == (
+        b"column_id,column_2,column_3\n1,row_1,1\n2,row_2,2\n")
+    assert encode_csv_rows([[None, "a,b", True]]) == b',"a,b",True\n'
+
+
+def test_multipart_writer_puts_small_objects_in_one_request(s3, s3_bucket):
+    from src.ingestion import S3MultipartWriter
+
+    with S3MultipartWriter(BUCKET_NAME, BUCKET_KEY) as writer:
+        writer.write(b"some,data\n")
+
+    data = s3.get_object(Bucket=BUCKET_NAME, Key=BUCKET_KEY)["Body"].read()
+    assert data == b"some,data\n"
+    assert writer._upload_id is None
+
+
+def test_multipart_writer_uploads_large_objects_in_parts(s3, s3_bucket):
+    from src.ingestion import S3MultipartWriter
+
+    part_size = 5 * 1024 * 1024
+    with S3MultipartWriter(BUCKET_NAME, BUCKET_KEY, part_size) as writer:
+        writer.write(b"a" * part_size)
+        writer.write(b"b" * 10)
+
+    data = s3.get_object(Bucket=BUCKET_NAME, Key=BUCKET_KEY)["Body"].read()
+    assert data == b"a" * part_size + b"b" * 10
+    assert len(writer._parts) == 2
+
+
+def test_multipart_writer_aborts_upload_if_block_raises(s3, s3_bucket):
+    from src.ingestion import S3MultipartWriter
+
+    part_size = 5 * 1024 * 1024
+    with pytest.raises(RuntimeError):
+        with S3MultipartWriter(BUCKET_NAME, BUCKET_KEY, part_size) as writer:
+            writer.write(b"a" * part_size)
+            raise RuntimeError
+
+    assert "Contents" not in s3.list_objects_v2(Bucket=BUCKET_NAME)
+    uploads = s3.list_multipart_uploads(Bucket=BUCKET_NAME)
+    assert "Uploads" not in uploads
+
+
+def test_stream_table_to_s3_uploads_batches_as_one_csv_file(s3, s3_bucket):
+    import src.ingestion
+
+    columns = ["column_id", "last_updated"]
+    batches = [[[1, datetime(2023, 1, 1)], [2, datetime(2023, 3, 1)]],
+               [[3, datetime(2023, 2, 1)]]]
+    with patch("src.ingestion.sql_stream_query", return_value=batches):
+        summary = src.ingestion.stream_table_to_s3(
+            "test_conn", TABLE_NAME, columns, BUCKET_NAME, BUCKET_KEY)
+
+    data = s3.get_object(Bucket=BUCKET_NAME, Key=BUCKET_KEY)["Body"].read()
+    assert data == (b"column_id,last_updated\n"
+                    b"1,2023-01-01 00:00:00.000000\n"
+                    b"2,2023-03-01 00:00:00.000000\n"
+                    b"3,2023-02-01 00:00:00.000000\n")
+    assert summary == {"row_count": 3, "byte_count": len(data),
+                       "last_updated": datetime(2023, 3, 1)}
+
+
+@patch("src.ingestion.sql_stream_query", return_value=[])
+def test_stream_table_to_s3_logs_error_if_bucket_does_not_exist(
+        mock_query, s3, s3_bucket, caplog):
+    import src.ingestion
+
+    with pytest.raises(botocore.errorfactory.ClientError):
+        src.ingestion.stream_table_to_s3(
+            "test_conn", TABLE_NAME, TABLE_COLUMNS, "no_bucket", BUCKET_KEY)
+
+    assert caplog.records[0].msg == "no_bucket does not exist in your S3"
+
+
+def test_export_table_raises_for_unknown_engine():
+    import src.ingestion
+
+    with pytest.raises(ValueError):
+        src.ingestion.export_table(
+            "test_conn", "unknown", TABLE_NAME, TABLE_COLUMNS, BUCKET_NAME,
+            BUCKET_KEY)
+
+
+# Test COPY Export
+def test_build_copy_query_formats_booleans_and_timestamps_as_python_does():
+    from src.ingestion import build_copy_query
+
+    query = build_copy_query(
+        "payment", ["payment_id", "paid", "last_updated"],
+        {"payment_id": "integer", "paid": "boolean",
+         "last_updated": "timestamp without time zone"})
+    assert query == (
+        "COPY (SELECT payment_id, CASE WHEN paid THEN 'True' WHEN NOT paid "
+        "THEN 'False' END AS paid, to_char(last_updated, "
+        "'YYYY-MM-DD HH24:MI:SS.US') AS last_updated FROM payment) "
+        "TO STDOUT WITH (FORMAT csv, HEADER);")
+
+
+def test_build_copy_query_inlines_watermark_as_literals():
+    from src.ingestion import build_copy_query
+
+    query = build_copy_query("staff", ["staff_id"],
+                             since=datetime(2023, 2, 1), overlap="1 minute")
+    assert ("WHERE last_updated > CAST('2023-02-01T00:00:00' AS timestamp) "
+            "- CAST('1 minute' AS interval)") in query
+
+
+COPY_OUTPUT = (b"column_id,paid,last_updated\n"
+               b"1,True,2023-02-01 10:00:00.500000\n"
+               b"2,,2023-02-01 11:00:00.000000\n")
+
+
+def test_copy_table_to_s3_streams_copy_output_to_bucket(s3, s3_bucket):
+    import src.ingestion
+
+    def run(sql, stream=None, **params):
+        if stream is not None:
+            stream.write(COPY_OUTPUT)
+        if sql.startswith("SELECT max"):
+            return [[datetime(2023, 2, 1, 11)]]
+
+    conn = MagicMock()
+    conn.run.side_effect = run
+    conn.row_count = 2
+    summary = src.ingestion.copy_table_to_s3(
+        conn, TABLE_NAME, ["column_id", "paid", "last_updated"],
+        BUCKET_NAME, BUCKET_KEY)
+
+    data = s3.get_object(Bucket=BUCKET_NAME, Key=BUCKET_KEY)["Body"].read()
+    assert data == COPY_OUTPUT
+    assert summary == {"row_count": 2, "byte_count": len(COPY_OUTPUT),
+                       "last_updated": datetime(2023, 2, 1, 11)}
+    assert conn.run.call_args_list[-1].args[0] == "COMMIT;"
+
+
+def test_copy_output_loads_the_same_as_select_engine_output(aws_credentials):
+    from src.ingestion import encode_csv_rows
+    import src.transformation
+
+    rows = [[1, True, datetime(2023, 2, 1, 10, 0, 0, 500000)],
+            [2, None, datetime(2023, 2, 1, 11)]]
+    select_output = encode_csv_rows(rows, ["column_id", "paid",
+                                           "last_updated"])
+    frames = []
+    for body in (select_output, COPY_OUTPUT):
+        with patch("src.transformation.s3.get_object") as mock:
+            mock.return_value = {"Body": BytesIO(body)}
+            frames.append(src.transformation.load_csv_from_s3(
+                "", "", parse_dates=["last_updated"]))
+    assert select_output == COPY_OUTPUT
+    assert frames[0].equals(frames[1])
+
+
+# Test Parallel Ingestion
+@pytest.mark.parametrize("workers", [1, 4])
+def test_run_tasks_collects_results_and_errors(workers):
+    from src.ingestion import run_tasks
+
+    def task(item):
+        if item == 2:
+            raise ValueError("bad item")
+        return item * 10
+
+    outcomes = run_tasks(task, [1, 2, 3], workers)
+    assert outcomes[1] == 10 and outcomes[3] == 30
+    assert isinstance(outcomes[2], ValueError)
+
+
+@patch.dict(os.environ, {"TF_INGESTION_WORKERS": "4"})
+@patch("src.ingestion.get_secret_value")
+@patch("src.ingestion.Connection")
+@patch("src.ingestion.get_schema_catalog", return_value=CATALOG)
+@patch("src.ingestion.list_key_states", return_value=key_states(True))
+@patch("src.ingestion.sql_probe_tables", return_value=probe_result(True))
+@patch("src.ingestion.export_table")
+def test_function_reports_failed_table_without_stopping_others(
+    mock_export, mock_sql, mock_key, mock_catalog, mock_connection,
+    mock_secret, caplog
+):
+    import src.ingestion
+
+    def export(conn, engine, table, *args, **kwargs):
+        if table == "payment":
+            raise pge.DatabaseError("payment does not exist")
+        return {"row_count": 1, "byte_count": None, "last_updated": None}
+
+    mock_export.side_effect = export
+    results = src.ingestion.lambda_handler({}, {})
+
+    assert mock_export.call_count == 11
+    assert results["payment"] == "failed"
+    assert list(results.values()).count("updated") == 10
+    assert "Ingestion of payment failed: payment does not exist" in [
+        record.msg for record in caplog.records]
+    assert caplog.records[-1].msg == "SUCCESSFUL INGESTION"
+
+
+@patch("src.ingestion.get_secret_value")
+@patch("src.ingestion.Connection")
+@patch("src.ingestion.get_schema_catalog", return_value=CATALOG)
+@patch("src.ingestion.list_key_states", return_value=key_states(True))
+@patch("src.ingestion.export_table")
+def test_function_checks_every_table_for_changes_in_one_query(
+    mock_export, mock_key, mock_catalog, mock_connection, mock_secret
+):
+    import src.ingestion
+
+    conn = mock_connection.return_value
+    conn.run.return_value = [
+        [table, None, 0, table in ("sales_order", "payment")]
+        for table in TABLES]
+
+    results = src.ingestion.lambda_handler({}, {})
+
+    probes = [call for call in conn.run.call_args_list
+              if "UNION ALL" in call.args[0]]
+    assert len(probes) == 1
+    assert sorted(call.args[2] for call in mock_export.call_args_list) == [
+        "payment", "sales_order"]
+    assert results["staff"] == "unchanged"
+
+
+def test_get_delta_key_partitions_by_run_date():
+    from src.ingestion import get_delta_key
+
+    key = get_delta_key("staff", datetime(2023, 2, 1, 9, 5, 7), "run1")
+    assert key == "staff/date=2023-02-01/090507-run1.csv"
+
+
+@patch.dict(os.environ, {"TF_INGESTION_LAYOUT": "delta",
+                         "TF_ING_BUCKET": BUCKET_NAME})
+@patch("src.ingestion.get_secret_value")
+@patch("src.ingestion.Connection")
+@patch("src.ingestion.get_schema_catalog", return_value=CATALOG)
+@patch("src.ingestion.sql_probe_tables", return_value=probe_result(False))
+@patch("src.ingestion.export_table")
+def test_function_writes_delta_files_and_manifest(
+    mock_export, mock_sql, mock_catalog, mock_connection, mock_secret,
+    s3, s3_bucket
+):
+    import src.ingestion
+
+    def export(conn, engine, table, headers, bucket, key, **kwargs):
+        s3.put_object(Bucket=bucket, Key=key, Body=b"data")
+        return {"row_count": 2, "byte_count": 4,
+                "last_updated": datetime(2023, 2, 1, 11)}
+
+    mock_export.side_effect = export
+    context = MagicMock(aws_request_id="run1")
+    context.get_remaining_time_in_millis.return_value = 60000
+    src.ingestion.lambda_handler({}, context)
+
+    keys = [call.args[5] for call in mock_export.call_args_list]
+    assert len(keys) == 11
+    assert all(key.startswith(f"{table}/date=") and
+               key.endswith("-run1.csv")
+               for table, key in zip(TABLES, keys))
+    manifest = json.loads(s3.get_object(
+        Bucket=BUCKET_NAME, Key="_manifests/latest.json")["Body"].read())
+    assert manifest["run_id"] == "run1"
+    assert [file["key"] for file in manifest["files"]] == keys
+    assert manifest["files"][0]["row_count"] == 2
+    assert manifest["files"][0]["watermark_to"] == "2023-02-01 11:00:00"
+
+    mock_export.reset_mock()
+    src.ingestion.lambda_handler({}, context)
+    assert mock_export.call_count == 0
+
+
+def test_range_scan_table_writes_one_part_per_key_range(s3, s3_bucket):
+    import src.ingestion
+
+    rows = [[key, datetime(2023, 2, 1, key)] for key in range(1, 6)]
+
+    def run(sql, **params):
+        if "pg_index" in sql:
+            return [["staff_id"]]
+        if "row_number()" in sql:
+            return [[2], [4]]
+        if "batch_size" not in params:
+            return [[1]]
+        lower = params.get("after", 0)
+        upper = params.get("upper", 99)
+        return [row for row in rows if lower < row[0] <= upper][
+            :params["batch_size"]]
+
+    conn = MagicMock()
+    conn.run.side_effect = run
+    pool = src.ingestion.ConnectionPool({}, max_size=2)
+    settings = {"range_rows": 2, "batch_size": 1, "workers": 2,
+                "overlap": "0 seconds", "engine": "select"}
+    with patch("src.ingestion.get_connection", return_value=conn):
+        summary = src.ingestion.range_scan_table(
+            pool, "staff", ["staff_id", "last_updated"], BUCKET_NAME,
+            "staff/run.csv", settings)
+
+    assert [part["key"] for part in summary["parts"]] == [
+        "staff/run-part-00000.csv", "staff/run-part-00001.csv",
+        "staff/run-part-00002.csv"]
+    assert [part["row_count"] for part in summary["parts"]] == [2, 2, 1]
+    assert summary["row_count"] == 5
+    assert summary["last_updated"] == datetime(2023, 2, 1, 5)
+    data = s3.get_object(Bucket=BUCKET_NAME,
+                         Key="staff/run-part-00001.csv")["Body"].read()
+    assert data == (b"staff_id,last_updated\n"
+                    b"3,2023-02-01 03:00:00.000000\n"
+                    b"4,2023-02-01 04:00:00.000000\n")
+
+
+@patch("src.ingestion.export_table")
+def test_range_scan_table_exports_keyless_table_with_same_options(
+        mock_export):
+    import src.ingestion
+
+    conn = MagicMock()
+    conn.run.return_value = []
+    pool = src.ingestion.ConnectionPool({})
+    settings = {"range_rows": 2, "batch_size": 1, "overlap": "0 seconds",
+                "engine": "copy", "column_stats": True}
+    content_hashes = {"staff": "abc"}
+    with patch("src.ingestion.get_connection", return_value=conn):
+        src.ingestion.range_scan_table(
+            pool, "staff", ["staff_id"], BUCKET_NAME, "staff/run.csv",
+            settings, column_types={"staff_id": "integer"},
+            content_hashes=content_hashes)
+
+    kwargs = mock_export.call_args.kwargs
+    assert kwargs["column_types"] == {"staff_id": "integer"}
+    assert kwargs["content_hashes"] is content_hashes
+    assert kwargs["column_stats"] is True
+
+
+@patch("src.ingestion.export_table")
+def test_range_scan_table_writes_small_delta_as_one_file(mock_export):
+    import src.ingestion
+
+    def run(sql, **params):
+        if "pg_index" in sql:
+            return [["staff_id"]]
+        return []
+
+    conn = MagicMock()
+    conn.run.side_effect = run
+    pool = src.ingestion.ConnectionPool({})
+    settings = {"range_rows": 2, "batch_size": 1, "overlap": "0 seconds",
+                "engine": "select", "column_stats": False}
+    with patch("src.ingestion.get_connection", return_value=conn):
+        src.ingestion.range_scan_table(
+            pool, "staff", ["staff_id", "last_updated"], BUCKET_NAME,
+            "staff/run.csv", settings, since=datetime(2023, 2, 1))
+
+    assert mock_export.call_args.args[5] == "staff/run.csv"
+    assert mock_export.call_args.kwargs["since"] == datetime(2023, 2, 1)
+
+
+def test_multipart_writer_skips_upload_matching_previous_hash(
+        s3, s3_bucket):
+    import src.ingestion
+
+    s3.put_object(Bucket=BUCKET_NAME, Key=BUCKET_KEY, Body=b"old")
+    with src.ingestion.S3MultipartWriter(BUCKET_NAME, BUCKET_KEY,
+                                         part_size=5) as writer:
+        writer.write(b"0123456789")
+    first_hash = writer.content_hash
+
+    with src.ingestion.S3MultipartWriter(
+            BUCKET_NAME, BUCKET_KEY, part_size=5,
+            previous_hash=first_hash) as writer:
+        writer.write(b"0123456789")
+
+    assert writer.skipped
+    assert writer.content_hash == first_hash
+    assert s3.list_multipart_uploads(Bucket=BUCKET_NAME).get(
+        "Uploads", []) == []
+
+
+@patch.dict(os.environ, {"TF_SKIP_UNCHANGED": "true",
+                         "TF_ING_BUCKET": BUCKET_NAME})
+@patch("src.ingestion.get_secret_value")
+@patch("src.ingestion.Connection")
+@patch("src.ingestion.get_schema_catalog", return_value=CATALOG)
+@patch("src.ingestion.sql_probe_tables", return_value=probe_result(True))
+@patch("src.ingestion.sql_select_query", return_value=MOCK_QUERY_RETURN)
+def test_function_skips_uploads_whose_content_is_unchanged(
+    mock_query, mock_sql, mock_catalog, mock_connection, mock_secret,
+    s3, s3_bucket, caplog
+):
+    import src.ingestion
+
+    src.ingestion.lambda_handler({}, {})
+    assert caplog.records[-1].msg == "SUCCESSFUL INGESTION"
+
+    s3_client = src.ingestion.get_s3_client()
+    with patch.object(s3_client, "put_object",
+                      wraps=s3_client.put_object) as mock_put:
+        results = src.ingestion.lambda_handler({}, {})
+
+    assert mock_put.call_count == 0
+    assert set(results.values()) == {"unchanged"}
+    assert caplog.records[-1].msg == "NO FILES TO UPDATE"
+
+
+@patch.dict(os.environ, {"TF_SKIP_UNCHANGED": "true",
+                         "TF_ING_BUCKET": BUCKET_NAME})
+@patch("src.ingestion.get_secret_value")
+@patch("src.ingestion.Connection")
+@patch("src.ingestion.get_schema_catalog", return_value=CATALOG)
+@patch("src.ingestion.sql_probe_tables", return_value=probe_result(False))
+@patch("src.ingestion.sql_select_query", return_value=MOCK_QUERY_RETURN)
+def test_function_reuploads_deleted_file_whose_content_is_unchanged(
+    mock_query, mock_sql, mock_catalog, mock_connection, mock_secret,
+    s3, s3_bucket
+):
+    import src.ingestion
+
+    src.ingestion.lambda_handler({}, {})
+    s3.delete_object(Bucket=BUCKET_NAME, Key="staff.csv")
+
+    results = src.ingestion.lambda_handler({}, {})
+
+    assert results["staff"] == "updated"
+    assert results["design"] == "unchanged"
+    s3.head_object(Bucket=BUCKET_NAME, Key="staff.csv")
+
+
+# Test Parquet Landing Format
+PARQUET_TYPES = {"column_id": "integer", "price": "numeric",
+                 "note": "text", "last_updated": "timestamp without time zone"}
+
+
+def test_build_parquet_schema_maps_postgres_types():
+    import pyarrow as pa
+    from src.ingestion import build_parquet_schema
+
+    schema = build_parquet_schema(
+        ["column_id", "price", "note", "last_updated", "extra"],
+        dict(PARQUET_TYPES, extra="interval"))
+
+    assert schema.field("column_id").type == pa.int32()
+    assert pa.types.is_decimal(schema.field("price").type)
+    assert schema.field("note").type == pa.string()
+    assert schema.field("last_updated").type == pa.timestamp("us")
+    assert schema.field("extra").type == pa.string()
+
+
+@patch("src.ingestion.sql_stream_query")
+def test_parquet_table_to_s3_writes_typed_zstd_parquet(
+        mock_stream, s3, s3_bucket):
+    import pyarrow.parquet as pq
+    from decimal import Decimal
+    import src.ingestion
+    import src.transformation
+
+    mock_stream.return_value = [
+        [[1, Decimal("3.94"), "a", datetime(2023, 2, 1, 10)],
+         [2, None, None, datetime(2023, 2, 1, 11)]],
+        [[3, Decimal("10.00"), "c", None]]]
+    summary = src.ingestion.parquet_table_to_s3(
+        "conn", TABLE_NAME, list(PARQUET_TYPES), BUCKET_NAME,
+        "test.parquet", PARQUET_TYPES, batch_size=2)
+
+    body = s3.get_object(Bucket=BUCKET_NAME, Key="test.parquet")["Body"]
+    parquet_file = pq.ParquetFile(BytesIO(body.read()))
+    assert parquet_file.metadata.row_group(0).column(0).compression == "ZSTD"
+    assert parquet_file.metadata.num_rows == 3
+    assert summary["row_count"] == 3
+    assert summary["last_updated"] == datetime(2023, 2, 1, 11)
+
+    with patch.object(src.transformation, "s3", s3):
+        df = src.transformation.load_table_from_s3(
+            BUCKET_NAME, "test", "parquet")
+    assert df["column_id"].tolist() == [1, 2, 3]
+    assert df["price"].tolist() == [Decimal("3.94"), None, Decimal("10.00")]
+    assert str(df["last_updated"].dtype).startswith("datetime64")
+    assert df["note"].isna().tolist() == [False, True, False]
+
+
+# Test Embedded Metric Format Records
+def test_measure_records_stage_time_into_current_metrics():
+    from src.ingestion import TableMetrics, collect_metrics, measure
+
+    metrics = TableMetrics()
+    with measure("query"):
+        pass
+    with collect_metrics(metrics):
+        with measure("query"):
+            pass
+        with measure("query"):
+            pass
+    assert list(metrics.values) == ["query"]
+    assert metrics.values["query"] >= 0
+
+
+def test_emit_metrics_prints_embedded_metric_format(capsys):
+    from src.ingestion import emit_metrics
+
+    emit_metrics("Namespace", {"Table": "staff"},
+                 {"Rows": (3, "Count")}, {"Result": "updated"})
+
+    record = json.loads(capsys.readouterr().out)
+    directive = record["_aws"]["CloudWatchMetrics"][0]
+    assert directive == {"Namespace": "Namespace", "Dimensions": [["Table"]],
+                         "Metrics": [{"Name": "Rows", "Unit": "Count"}]}
+    assert record["Table"] == "staff"
+    assert record["Rows"] == 3
+    assert record["Result"] == "updated"
+
+
+@patch("src.ingestion.get_secret_value")
+@patch("src.ingestion.Connection")
+@patch("src.ingestion.get_schema_catalog", return_value=CATALOG)
+@patch("src.ingestion.list_key_states", return_value=key_states(True))
+@patch("src.ingestion.export_table")
+def test_function_emits_a_metrics_record_per_table(
+    mock_export, mock_key, mock_catalog, mock_connection, mock_secret,
+    capsys
+):
+    import src.ingestion
+
+    conn = mock_connection.return_value
+    conn.run.return_value = [
+        [table, None, 0, table == "payment"] for table in TABLES]
+    mock_export.return_value = {"row_count": 5, "byte_count": 100,
+                                "last_updated": None}
+
+    src.ingestion.lambda_handler({}, {})
+
+    records = {record["Table"]: record for record in map(
+        json.loads, capsys.readouterr().out.splitlines())}
+    assert sorted(records) == sorted(TABLES)
+    assert records["payment"]["Rows"] == 5
+    assert records["payment"]["Bytes"] == 100
+    assert records["payment"]["Skipped"] == 0
+    assert records["staff"]["Skipped"] == 1
+    assert records["staff"]["Result"] == "unchanged"
+    assert {"ConnectTime", "CheckTime", "QueryTime", "EncodeTime",
+            "UploadTime"} <= set(records["staff"])
+
+
+# Test Cold Start
+def test_import_creates_no_clients_and_skips_heavy_modules(aws_credentials):
+    import subprocess
+    import sys
+
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c",
+         "import src.ingestion as ingestion; "
+         "assert ingestion._s3_client is None; "
+         "assert ingestion._secrets_client is None"],
+        capture_output=True, text=True,
+        cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+    assert result.returncode == 0, result.stderr
+    timings = {line.split("|")[2].strip(): int(line.split("|")[1])
+               for line in result.stderr.splitlines()
+               if line.startswith("import time:") and "|" in line
+               and line.split("|")[1].strip().isdigit()}
+    logger.info(f"src.ingestion import: {timings['src.ingestion']}us")
+    assert not {"pandas", "pyarrow", "numpy"} & set(timings)
+
+
+@patch.dict(os.environ, {"TF_CONSISTENT_SNAPSHOT": "true",
+                         "TF_INGESTION_WORKERS": "4"})
+@patch("src.ingestion.get_secret_value")
+@patch("src.ingestion.Connection")
+@patch("src.ingestion.get_schema_catalog", return_value=CATALOG)
+@patch("src.ingestion.list_key_states", return_value=key_states(True))
+@patch("src.ingestion.sql_probe_tables", return_value=probe_result(True))
+@patch("src.ingestion.export_table")
+def test_function_exports_every_table_from_one_snapshot(
+    mock_export, mock_sql, mock_key, mock_catalog, mock_connection,
+    mock_secret
+):
+    import src.ingestion
+
+    conn = mock_connection.return_value
+    conn.run.return_value = [["00000003-0000001B-1"]]
+    mock_export.return_value = {"row_count": 1, "byte_count": None,
+                                "last_updated": None}
+
+    src.ingestion.lambda_handler({}, {})
+
+    assert mock_export.call_count == 11
+    assert {call.kwargs["snapshot"] for call in
+            mock_export.call_args_list} == {"00000003-0000001B-1"}
+    statements = [call.args[0] for call in conn.run.call_args_list]
+    assert "SELECT pg_export_snapshot();" in statements
+    assert statements[-1] == "COMMIT;"
+
+
+@patch.dict(os.environ, {"TF_POLL_MAX_SKIP_RUNS": "7",
+                         "TF_ING_BUCKET": BUCKET_NAME})
+@patch("src.ingestion.get_secret_value")
+@patch("src.ingestion.Connection")
+@patch("src.ingestion.get_schema_catalog", return_value=CATALOG)
+@patch("src.ingestion.list_key_states", return_value=key_states(True))
+@patch("src.ingestion.sql_probe_tables")
+@patch("src.ingestion.export_table")
+def test_function_polls_quiet_tables_less_often(
+    mock_export, mock_sql, mock_key, mock_catalog, mock_connection,
+    mock_secret, s3, s3_bucket
+):
+    import src.ingestion
+
+    s3.put_object(Bucket=BUCKET_NAME, Key="_state/poll_schedule.json",
+                  Body=json.dumps({
+                      "currency": {"quiet": 3, "skip": 2},
+                      "payment": {"quiet": 0, "skip": 0,
+                                  "last_updated": "2023-02-01T10:00:00"}}))
+    mock_sql.side_effect = lambda conn, tables, interval: {
+        table: {"last_updated": datetime(2023, 2, 1, 11), "row_count": 1,
+                "is_recent": False} for table in tables}
+    mock_export.return_value = {"row_count": 1, "byte_count": None,
+                                "last_updated": None}
+
+    result = src.ingestion.lambda_handler({}, {})
+
+    assert "currency" not in mock_sql.call_args.args[1]
+    assert result["currency"] == "unchanged"
+    assert result["payment"] == "updated"
+    assert result["staff"] == "unchanged"
+    schedule = json.loads(s3.get_object(
+        Bucket=BUCKET_NAME, Key="_state/poll_schedule.json")["Body"].read())
+    assert schedule["currency"] == {"quiet": 3, "skip": 1}
+    assert schedule["payment"]["skip"] == 0
+    assert schedule["staff"]["skip"] == 1
+    assert schedule["staff"]["last_updated"] == "2023-02-01T11:00:00"
+
+
+@patch.dict(os.environ, {"TF_CHANGE_DETECTION": "stats",
+                         "TF_ING_BUCKET": BUCKET_NAME})
+@patch("src.ingestion.get_secret_value")
+@patch("src.ingestion.Connection")
+@patch("src.ingestion.get_schema_catalog", return_value=CATALOG)
+@patch("src.ingestion.list_key_states", return_value=key_states(True))
+@patch("src.ingestion.sql_table_stats")
+@patch("src.ingestion.sql_probe_tables")
+@patch("src.ingestion.export_table")
+def test_function_exports_tables_whose_statistics_moved(
+    mock_export, mock_probe, mock_stats, mock_key, mock_catalog,
+    mock_connection, mock_secret, s3, s3_bucket
+):
+    import src.ingestion
+
+    saved = {table: [10, 0, 0] for table in TABLES}
+    s3.put_object(Bucket=BUCKET_NAME, Key="_state/table_stats.json",
+                  Body=json.dumps(saved))
+    mock_stats.return_value = dict(saved, payment=[10, 0, 1],
+                                   staff=[11, 0, 0])
+    mock_probe.side_effect = lambda conn, tables, interval: {
+        table: {"last_updated": None, "row_count": 1, "is_recent": False}
+        for table in tables}
+    mock_export.side_effect = [
+        {"row_count": 1, "byte_count": None, "last_updated": None},
+        RuntimeError("boom")]
+
+    result = src.ingestion.lambda_handler({}, {})
+
+    assert mock_probe.call_args.args[1] == ["staff", "payment"]
+    assert result["staff"] == "updated"
+    assert result["payment"] == "failed"
+    assert result["currency"] == "unchanged"
+    stats = json.loads(s3.get_object(
+        Bucket=BUCKET_NAME, Key="_state/table_stats.json")["Body"].read())
+    assert stats["staff"] == [11, 0, 0]
+    assert stats["payment"] == [10, 0, 0]
+
+
+@patch.dict(os.environ, {"TF_REPLICA_HOSTS": "replica-1, replica-2",
+                         "TF_REPLICA_MAX_LAG": "30"})
+@patch("src.ingestion.get_secret_value")
+@patch("src.ingestion.Connection")
+@patch("src.ingestion.get_schema_catalog", return_value=CATALOG)
+@patch("src.ingestion.list_key_states", return_value=key_states(True))
+@patch("src.ingestion.sql_probe_tables", return_value=probe_result(True))
+@patch("src.ingestion.get_replica_pools")
+@patch("src.ingestion.sql_replica_lag")
+@patch("src.ingestion.export_table")
+def test_function_extracts_from_replica_and_probes_primary(
+    mock_export, mock_lag, mock_pools, mock_sql, mock_key, mock_catalog,
+    mock_connection, mock_secret
+):
+    import src.ingestion
+
+    pools = {"replica-1": MagicMock(), "replica-2": MagicMock()}
+    mock_pools.return_value = pools
+    mock_lag.side_effect = [45.0, 2.0]
+    mock_export.return_value = {"row_count": 1, "byte_count": None,
+                                "last_updated": None}
+
+    src.ingestion.lambda_handler({}, {})
+
+    assert mock_pools.call_args.args[1] == ["replica-1", "replica-2"]
+    replica_conn = pools["replica-2"].connection.return_value \
+        .__enter__.return_value
+    assert {call.args[0] for call in mock_export.call_args_list} == \
+        {replica_conn}
+    assert mock_sql.call_args.args[0] is mock_connection.return_value
+
+
+@patch.dict(os.environ, {"TF_REPLICA_HOSTS": "replica-1",
+                         "TF_POLL_MAX_SKIP_RUNS": "7",
+                         "TF_ING_BUCKET": BUCKET_NAME})
+@patch("src.ingestion.get_secret_value")
+@patch("src.ingestion.Connection")
+@patch("src.ingestion.get_schema_catalog", return_value=CATALOG)
+@patch("src.ingestion.list_key_states", return_value=key_states(True))
+@patch("src.ingestion.sql_probe_tables",
+       return_value=probe_result(True, datetime(2023, 2, 1, 11)))
+@patch("src.ingestion.get_replica_pools")
+@patch("src.ingestion.sql_replica_lag", return_value=20.0)
+@patch("src.ingestion.export_table")
+def test_function_keeps_the_last_updated_a_lagging_replica_exported(
+    mock_export, mock_lag, mock_pools, mock_sql, mock_key, mock_catalog,
+    mock_connection, mock_secret, s3, s3_bucket
+):
+    import src.ingestion
+
+    s3.put_object(Bucket=BUCKET_NAME, Key="_state/poll_schedule.json",
+                  Body=json.dumps({table: {
+                      "quiet": 0, "skip": 0,
+                      "last_updated": "2023-02-01T10:00:00"}
+                      for table in TABLES}))
+    mock_pools.return_value = {"replica-1": MagicMock()}
+    mock_export.return_value = {"row_count": 1, "byte_count": None,
+                                "last_updated": datetime(2023, 2, 1, 10, 30)}
+
+    src.ingestion.lambda_handler({}, {})
+
+    schedule = json.loads(s3.get_object(
+        Bucket=BUCKET_NAME, Key="_state/poll_schedule.json")["Body"].read())
+    assert schedule["staff"]["last_updated"] == "2023-02-01T10:30:00"
+
+
+@patch.dict(os.environ, {"TF_REPLICA_HOSTS": "replica-1",
+                         "TF_CHANGE_DETECTION": "stats",
+                         "TF_ING_BUCKET": BUCKET_NAME})
+@patch("src.ingestion.get_secret_value")
+@patch("src.ingestion.Connection")
+@patch("src.ingestion.get_schema_catalog", return_value=CATALOG)
+@patch("src.ingestion.list_key_states", return_value=key_states(True))
+@patch("src.ingestion.sql_table_stats")
+@patch("src.ingestion.sql_probe_tables", return_value=probe_result(True))
+@patch("src.ingestion.get_replica_pools")
+@patch("src.ingestion.export_table", return_value=EXPORT_SUMMARY)
+def test_function_extracts_from_primary_with_statistics(
+    mock_export, mock_pools, mock_probe, mock_stats, mock_key,
+    mock_catalog, mock_connection, mock_secret, s3, s3_bucket
+):
+    import src.ingestion
+
+    mock_stats.return_value = {"staff": [11, 0, 0]}
+
+    src.ingestion.lambda_handler({}, {})
+
+    mock_pools.assert_not_called()
+    assert {call.args[0] for call in mock_export.call_args_list} == \
+        {mock_connection.return_value}
+
+
+@patch.dict(os.environ, {"TF_DEADLINE_MARGIN": "10",
+                         "TF_ING_BUCKET": BUCKET_NAME})
+@patch("src.ingestion.get_secret_value")
+@patch("src.ingestion.Connection")
+@patch("src.ingestion.get_schema_catalog", return_value=CATALOG)
+@patch("src.ingestion.list_key_states", return_value=key_states(True))
+@patch("src.ingestion.sql_probe_tables", return_value=probe_result(True))
+@patch("src.ingestion.export_table")
+def test_function_defers_tables_that_do_not_fit_before_deadline(
+    mock_export, mock_sql, mock_key, mock_catalog, mock_connection,
+    mock_secret, s3, s3_bucket
+):
+    import src.ingestion
+
+    s3.put_object(Bucket=BUCKET_NAME, Key="_state/work_plan.json",
+                  Body=json.dumps({"costs": {"staff": 5.0, "payment": 1.0},
+                                   "deferred": ["currency"]}))
+    mock_export.return_value = {"row_count": 1, "byte_count": None,
+                                "last_updated": None}
+    context = MagicMock()
+    context.get_remaining_time_in_millis.return_value = 12000
+
+    result = src.ingestion.lambda_handler({}, context)
+
+    tables = [call.args[2] for call in mock_export.call_args_list]
+    assert tables[:2] == ["currency", "payment"]
+    assert "staff" not in tables and len(tables) == 10
+    assert result["staff"] == "deferred"
+    plan = json.loads(s3.get_object(
+        Bucket=BUCKET_NAME, Key="_state/work_plan.json")["Body"].read())
+    assert plan["deferred"] == ["staff"]
+    assert plan["costs"]["staff"] == 5.0
+    assert set(plan["costs"]) == set(TABLES)
+
+    mock_export.reset_mock()
+    context.get_remaining_time_in_millis.return_value = 60000
+    result = src.ingestion.lambda_handler({}, context)
+    assert mock_export.call_args_list[0].args[2] == "staff"
+    assert "deferred" not in result.values()
+
+
+@patch.dict(os.environ, {"TF_DEADLINE_MARGIN": "10",
+                         "TF_DELETE_DETECTION": "true",
+                         "TF_ING_BUCKET": BUCKET_NAME})
+@patch("src.ingestion.get_secret_value")
+@patch("src.ingestion.Connection")
+@patch("src.ingestion.get_schema_catalog", return_value=CATALOG)
+@patch("src.ingestion.list_key_states", return_value=key_states(True))
+@patch("src.ingestion.sql_probe_tables", return_value=probe_result(False))
+@patch("src.ingestion.ingest_tombstones")
+def test_function_leaves_delete_detection_past_deadline_to_next_run(
+    mock_tombstones, mock_sql, mock_key, mock_catalog, mock_connection,
+    mock_secret, s3, s3_bucket, caplog
+):
+    import src.ingestion
+
+    mock_tombstones.return_value = dict(
+        {table: None for table in TABLES}, staff={"deferred": True})
+    context = MagicMock()
+    context.get_remaining_time_in_millis.return_value = 60000
+
+    result = src.ingestion.lambda_handler({}, context)
+
+    assert mock_tombstones.call_args.args[6] is not None
+    assert result["staff"] == "unchanged"
+    assert "delete detection on ['staff']" in caplog.text
+
+
+# Test Column Statistics
+def test_hyperloglog_estimates_distinct_values_closely():
+    from src.ingestion import HyperLogLog
+
+    sketch = HyperLogLog()
+    for value in range(20000):
+        sketch.add(value % 10000)
+    assert abs(sketch.count() - 10000) < 500
+
+    small = HyperLogLog()
+    for value in ["a", "b", "c", "a"]:
+        small.add(value)
+    assert small.count() == 3
+
+
+def test_column_stats_summarise_each_column():
+    from src.ingestion import ColumnStats
+
+    stats = ColumnStats(["id", "name", "last_updated"])
+    stats.update([[1, "Sam", datetime(2023, 2, 1)],
+                  [2, None, datetime(2023, 2, 3)]])
+    stats.update([[3, "Maxine", None]])
+
+    summary = stats.to_dict()
+    assert summary["row_count"] == 3
+    assert summary["columns"]["id"] == {
+        "min": 1, "max": 3, "null_count": 0, "max_length": None,
+        "distinct_count": 3}
+    assert summary["columns"]["name"]["null_count"] == 1
+    assert summary["columns"]["name"]["max_length"] == 6
+    assert summary["columns"]["last_updated"]["max"] == datetime(2023, 2, 3)
+
+
+@patch("src.ingestion.sql_select_query", return_value=MOCK_QUERY_RETURN)
+def test_data_to_bucket_csv_file_writes_column_stats_sidecar(
+        mock_sql, s3, s3_bucket):
+    import src.ingestion
+
+    src.ingestion.data_to_bucket_csv_file(
+        "test_conn", TABLE_NAME, TABLE_COLUMNS, BUCKET_NAME, BUCKET_KEY,
+        column_stats=True)
+
+    sidecar = json.loads(s3.get_object(
+        Bucket=BUCKET_NAME, Key="test.stats.json")["Body"].read())
+    assert sidecar["row_count"] == 2
+    assert sidecar["columns"]["column_2"] == {
+        "min": "row_1", "max": "row_2", "null_count": 0, "max_length": 5,
+        "distinct_count": 2}
+
+
+# Test Change Data Capture
+DECODED_ROWS = [
+    ["0/16B2D80", "740", "BEGIN 740"],
+    ["0/16B2D80", "740", "table public.staff: INSERT: column_id[integer]:1 "
+     "column_2[character varying]:'O''Neil' column_3[text]:null"],
+    ["0/16B2E40", "740", "table public.staff: UPDATE: old-key: "
+     "column_id[integer]:1 new-tuple: column_id[integer]:2 "
+     "column_2[character varying]:'two words' column_3[text]:'x'"],
+    ["0/16B2F00", "740", "table public.design: DELETE: column_id[integer]:7"],
+    ["0/16B2F80", "740", "COMMIT 740"],
+    ["0/16B3000", "741", "BEGIN 741"],
+    ["0/16B3000", "741", "table public.staff: DELETE: column_id[integer]:2"],
+    ["0/16B3100", "741", "COMMIT 741"],
+]
+
+
+def test_parse_decoded_change_reads_test_decoding_output():
+    from src.ingestion import parse_decoded_change
+
+    assert parse_decoded_change(DECODED_ROWS[1][2]) == (
+        "staff", "insert",
+        {"column_id": "1", "column_2": "O'Neil", "column_3": None})
+    assert parse_decoded_change(DECODED_ROWS[2][2]) == (
+        "staff", "update",
+        {"column_id": "2", "column_2": "two words", "column_3": "x"})
+    assert parse_decoded_change(
+        'table public."Odd": DELETE: (no-tuple-data)') == (
+        "Odd", "delete", {})
+    assert parse_decoded_change("BEGIN 740") is None
+
+
+def test_group_decoded_changes_skips_transactions_already_written():
+    from src.ingestion import group_decoded_changes
+
+    changes, lsn = group_decoded_changes(DECODED_ROWS)
+    assert lsn == "0/16B3100"
+    assert [change[:2] for change in changes["staff"]] == [
+        ("insert", "0/16B2F80"), ("update", "0/16B2F80"),
+        ("delete", "0/16B3100")]
+    assert changes["design"][0][2] == {"column_id": "7"}
+
+    changes, lsn = group_decoded_changes(DECODED_ROWS, after="0/16B2F80")
+    assert list(changes) == ["staff"]
+    assert changes["staff"][0][0] == "delete"
+
+
+@patch.dict(os.environ, {"TF_CDC_SLOT": "totesys_ingestion",
+                         "TF_ING_BUCKET": BUCKET_NAME})
+@patch("src.ingestion.get_secret_value")
+@patch("src.ingestion.Connection")
+@patch("src.ingestion.get_schema_catalog", return_value=CATALOG)
+@patch("src.ingestion.export_table")
+def test_function_writes_slot_changes_as_delta_files(
+    mock_export, mock_catalog, mock_connection, mock_secret, s3, s3_bucket
+):
+    import src.ingestion
+
+    for table in TABLES:
+        if table != "currency":
+            s3.put_object(Bucket=BUCKET_NAME,
+                          Key=f"{table}/date=2023-02-01/000000-old.csv",
+                          Body=b"data")
+
+    def run(query, **params):
+        if "pg_replication_slots" in query:
+            return [[1]]
+        if "peek_changes" in query:
+            return DECODED_ROWS
+        return [[1]]
+
+    conn = mock_connection.return_value
+    conn.run.side_effect = run
+    mock_export.return_value = {"row_count": 3, "byte_count": 10,
+                                "last_updated": None}
+    context = MagicMock(aws_request_id="run1")
+    context.get_remaining_time_in_millis.return_value = 60000
+
+    result = src.ingestion.lambda_handler({}, context)
+
+    assert result["staff"] == "updated"
+    assert result["design"] == "updated"
+    assert result["currency"] == "updated"
+    assert result["payment"] == "unchanged"
+    assert mock_export.call_args.args[2] == "currency"
+    manifest = json.loads(s3.get_object(
+        Bucket=BUCKET_NAME, Key="_manifests/latest.json")["Body"].read())
+    files = {file["table"]: file for file in manifest["files"]}
+    assert files["staff"]["row_count"] == 3
+    assert files["staff"]["watermark_to"] == "0/16B3100"
+    body = s3.get_object(Bucket=BUCKET_NAME,
+                         Key=files["staff"]["key"])["Body"].read()
+    assert body.decode().splitlines() == [
+        "column_id,column_2,column_3,change_type,commit_lsn",
+        "1,O'Neil,,insert,0/16B2F80",
+        "2,two words,x,update,0/16B2F80",
+        "2,,,delete,0/16B3100"]
+    state = json.loads(s3.get_object(
+        Bucket=BUCKET_NAME, Key="_state/cdc.json")["Body"].read())
+    assert state == {"slot": "totesys_ingestion", "lsn": "0/16B3100"}
+    advance = [call for call in conn.run.call_args_list
+               if "pg_replication_slot_advance" in call.args[0]]
+    assert advance[0].kwargs == {"slot": "totesys_ingestion",
+                                 "lsn": "0/16B3100"}
+
+
+@patch.dict(os.environ, {"TF_CDC_SLOT": "totesys_ingestion",
+                         "TF_ING_BUCKET": BUCKET_NAME})
+@patch("src.ingestion.get_secret_value")
+@patch("src.ingestion.Connection")
+@patch("src.ingestion.get_schema_catalog", return_value=CATALOG)
+def test_function_defers_slot_changes_past_deadline_and_emits_metrics(
+    mock_catalog, mock_connection, mock_secret, s3, s3_bucket, capsys
+):
+    import src.ingestion
+
+    for table in TABLES:
+        s3.put_object(Bucket=BUCKET_NAME,
+                      Key=f"{table}/date=2023-02-01/000000-old.csv",
+                      Body=b"data")
+    s3.put_object(Bucket=BUCKET_NAME, Key="_state/work_plan.json",
+                  Body=json.dumps({"costs": {"staff": 100.0},
+                                   "deferred": []}))
+
+    def run(query, **params):
+        if "peek_changes" in query:
+            return DECODED_ROWS
+        return [[1]]
+
+    conn = mock_connection.return_value
+    conn.run.side_effect = run
+    context = MagicMock(aws_request_id="run1")
+    context.get_remaining_time_in_millis.return_value = 60000
+
+    result = src.ingestion.lambda_handler({}, context)
+
+    assert result["staff"] == "deferred"
+    assert result["design"] == "updated"
+    assert not any("pg_replication_slot_advance" in call.args[0]
+                   for call in conn.run.call_args_list)
+    plan = json.loads(s3.get_object(
+        Bucket=BUCKET_NAME, Key="_state/work_plan.json")["Body"].read())
+    assert plan["deferred"] == ["staff"]
+    assert "design" in plan["costs"]
+    records = [json.loads(line) for line in
+               capsys.readouterr().out.splitlines() if line.startswith("{")]
+    assert {record["Table"]: record["Result"] for record in records} == \
+        result
@@ -1,12 +1,15 @@
 import boto3
 from moto import mock_secretsmanager, mock_s3
-from unittest.mock import patch
+from unittest.mock import patch, MagicMock
 import pytest
 import os
 import botocore.errorfactory
 import botocore.exceptions as be
 import pg8000.exceptions as pge
 import logging
+import threading
+import time
+from datetime import datetime
 
 logger = logging.getLogger("TestLogger")
 
@@ -23,7 +26,17 @@ def aws_credentials():
 
 # Test SecretsManager
 @pytest.fixture
-def secretsmanager(aws_credentials):
+def empty_secret_cache():
+    import src.ingestion
+    src.ingestion._secret_cache.clear()
+    src.ingestion._secrets_client = None
+    yield
+    src.ingestion._secret_cache.clear()
+    src.ingestion._secrets_client = None
+
+
+@pytest.fixture
+def secretsmanager(aws_credentials, empty_secret_cache):
     with mock_secretsmanager():
         yield boto3.client("secretsmanager", region_name="us-east-1")
 
@@ -69,10 +82,50 @@ def test_will_throw_and_log_error_if_secret_name_incorrect_type(
     assert caplog.records[0].msg == "The request has invalid params"
 
 
-def test_logging_all_other_errors(caplog):
+def test_secret_is_served_from_cache_within_ttl(
+    secretsmanager, create_secret
+):
+    import src.ingestion
+
+    first = src.ingestion.get_secret_value("MySecret")
+    secrets = src.ingestion.get_secrets_client()
+    with patch.object(secrets, "get_secret_value") as mock:
+        assert src.ingestion.get_secret_value("MySecret") is first
+        mock.assert_not_called()
+
+
+@patch.dict(os.environ, {"TF_SECRET_CACHE_TTL": "0"})
+def test_secret_is_fetched_again_once_ttl_expires(
+    secretsmanager, create_secret
+):
+    import src.ingestion
+
+    src.ingestion.get_secret_value("MySecret")
+    secrets = src.ingestion.get_secrets_client()
+    with patch.object(secrets, "get_secret_value") as mock:
+        mock.return_value = {"SecretString": '{"password": "new"}'}
+        assert src.ingestion.get_secret_value("MySecret") == {
+            "password": "new"}
+
+
+def test_secret_is_fetched_again_when_refresh_forced(
+    secretsmanager, create_secret
+):
+    import src.ingestion
+
+    src.ingestion.get_secret_value("MySecret")
+    secrets = src.ingestion.get_secrets_client()
+    with patch.object(secrets, "get_secret_value") as mock:
+        mock.return_value = {"SecretString": '{"password": "new"}'}
+        assert src.ingestion.get_secret_value(
+            "MySecret", force_refresh=True) == {"password": "new"}
+
+
+def test_logging_all_other_errors(empty_secret_cache, caplog):
     import src.ingestion
 
-    with patch("src.ingestion.secrets.get_secret_value") as mock:
+    secrets = src.ingestion.get_secrets_client()
+    with patch.object(secrets, "get_secret_value") as mock:
         response_error = Exception
         mock.side_effect = response_error
 
@@ -110,50 +163,138 @@ def test_get_connection_raises_error_if_details_are_incorrect(caplog):
     assert caplog.records[0].levelno == logging.ERROR
 
 
-# Test SQL Helpers
-def test_get_keys_from_table_names_applies_correct_suffix():
-    from src.ingestion import get_keys_from_table_names
+# Test Connection Pool
+@patch("src.ingestion.Connection")
+def test_connection_pool_reuses_a_released_connection(mock_connection):
+    from src.ingestion import ConnectionPool
 
-    result = get_keys_from_table_names(["table_1", "table_2", "table_3"])
-    assert result == ["table_1.csv", "table_2.csv", "table_3.csv"]
+    pool = ConnectionPool(MOCK_CREDS)
+    with pool.connection() as first:
+        pass
+    with pool.connection() as second:
+        pass
 
+    assert first is second
+    assert mock_connection.call_count == 1
 
-columns123 = ["col_1", "col_2", "col_3"]
+
+@patch("src.ingestion.Connection")
+def test_connection_pool_replaces_a_stale_connection(mock_connection):
+    from src.ingestion import ConnectionPool
+
+    stale = MagicMock()
+    stale.run.side_effect = pge.InterfaceError
+    pool = ConnectionPool(MOCK_CREDS)
+    pool.release(stale)
+
+    assert pool.acquire() is mock_connection.return_value
+    stale.close.assert_called_once()
 
 
 @patch("src.ingestion.Connection")
-def test_sql_select_column_headers_returns_column_headers(mock_connection):
+def test_connection_pool_waits_for_a_connection_at_its_limit(
+        mock_connection):
+    from src.ingestion import ConnectionPool
 
-    from src.ingestion import sql_select_column_headers
+    pool = ConnectionPool(MOCK_CREDS, max_open=1)
+    first = pool.acquire()
+    taken = []
+    waiter = threading.Thread(target=lambda: taken.append(pool.acquire()))
+    waiter.start()
+    waiter.join(0.2)
+    assert taken == []
 
-    test_result = [{"name": "col_1"}, {"name": "col_2"}, {"name": "col_3"}]
-    mock_connection().columns = test_result
-    assert sql_select_column_headers(MOCK_CREDS, "table") == columns123
+    pool.release(first)
+    waiter.join(5)
+    assert taken == [first]
+    assert mock_connection.call_count == 1
 
 
 @patch("src.ingestion.Connection")
-def test_select_column_headers_logs_error_if_table_does_not_exist(
-    mock_connection, caplog
+def test_connection_pool_closes_connection_if_block_raises(mock_connection):
+    from src.ingestion import ConnectionPool
+
+    pool = ConnectionPool(MOCK_CREDS)
+    with pytest.raises(pge.DatabaseError):
+        with pool.connection():
+            raise pge.DatabaseError
+
+    mock_connection.return_value.close.assert_called_once()
+    assert pool._idle == []
+
+
+@patch("src.ingestion.Connection")
+def test_connection_pool_refreshes_credentials_when_rejected(
+    mock_connection
 ):
-    from src.ingestion import sql_select_column_headers
+    from src.ingestion import ConnectionPool
 
-    mock_connection().run.side_effect = pge.DatabaseError
+    rejected = pge.DatabaseError({"C": "28P01", "M": "password failed"})
+    mock_connection.side_effect = [rejected, MagicMock()]
+    new_creds = {**MOCK_CREDS, "password": "rotated"}
+    pool = ConnectionPool(MOCK_CREDS,
+                          refresh_credentials=lambda: new_creds)
+
+    pool.acquire()
+    assert pool.credentials == new_creds
+    assert mock_connection.call_args.kwargs["password"] == "rotated"
+
+
+@patch("src.ingestion.Connection")
+def test_connection_pool_raises_other_database_errors(mock_connection):
+    from src.ingestion import ConnectionPool
+
+    refresh = MagicMock()
+    mock_connection.side_effect = pge.DatabaseError({"C": "3D000"})
+    pool = ConnectionPool(MOCK_CREDS, refresh_credentials=refresh)
 
     with pytest.raises(pge.DatabaseError):
-        sql_select_column_headers(MOCK_CREDS, "test")
+        pool.acquire()
+    refresh.assert_not_called()
 
-    assert caplog.records[0].levelno == logging.ERROR
-    assert caplog.records[0].msg == (
-        "DatabaseError: test does not exist in database")
 
+def test_get_connection_pool_is_kept_for_the_same_credentials():
+    from src.ingestion import get_connection_pool
+
+    pool = get_connection_pool(MOCK_CREDS)
+    assert get_connection_pool(dict(MOCK_CREDS)) is pool
+    assert get_connection_pool({**MOCK_CREDS, "host": "new"}) is not pool
+
+
+def test_get_replica_credentials_points_primary_credentials_at_replica():
+    from src.ingestion import get_replica_credentials
+
+    assert get_replica_credentials(MOCK_CREDS, "replica-1:5433") == {
+        **MOCK_CREDS, "host": "replica-1", "port": 5433}
+    assert get_replica_credentials(MOCK_CREDS, "replica-2")["port"] == \
+        MOCK_CREDS["port"]
+
+
+def test_choose_replica_picks_least_lagged_replica_within_limit(caplog):
+    from src.ingestion import choose_replica
+
+    pools = {host: MagicMock(name=host) for host in ["a", "b", "c", "d"]}
+    lags = {"a": 12.0, "b": 3.5, "c": 90.0}
 
-@patch(
-    "src.ingestion.sql_select_column_headers", return_value=columns123)
-def test_collect_column_headers_colates_lists_returned_from_sql(mock_sql):
-    from src.ingestion import collect_column_headers
+    def replica_lag(conn):
+        host = next(host for host, pool in pools.items() if conn is
+                    pool.connection.return_value.__enter__.return_value)
+        if host == "d":
+            raise pge.InterfaceError("connection refused")
+        return lags[host]
 
-    result = collect_column_headers(MOCK_CREDS, ["table_1", "table_2"])
-    assert result == [columns123, columns123]
+    with patch("src.ingestion.sql_replica_lag", side_effect=replica_lag):
+        assert choose_replica(pools, 60) is pools["b"]
+        assert choose_replica(pools, 1) is None
+    assert "Replica d is unavailable" in caplog.text
+
+
+# Test SQL Helpers
+def test_get_keys_from_table_names_applies_correct_suffix():
+    from src.ingestion import get_keys_from_table_names
+
+    result = get_keys_from_table_names(["table_1", "table_2", "table_3"])
+    assert result == ["table_1.csv", "table_2.csv", "table_3.csv"]
 
 
 @patch("src.ingestion.Connection")
@@ -162,7 +303,7 @@ def test_select_query_returns_list_of_row_data_from_database(mock_connection):
 
     test_result = [["Alex", 1], ["Rachael", 2], ["Joe", 3]]
     mock_connection().run.return_value = test_result
-    assert sql_select_query(MOCK_CREDS, "table") == test_result
+    assert sql_select_query(mock_connection(), "table") == test_result
 
 
 @patch("src.ingestion.Connection")
@@ -174,81 +315,563 @@ def test_select_query_logs_error_if_table_does_not_exist(
     mock_connection().run.side_effect = pge.DatabaseError
 
     with pytest.raises(pge.DatabaseError):
-        sql_select_query(MOCK_CREDS, "test")
+        sql_select_query(mock_connection(), "test")
 
     assert caplog.records[0].levelno == logging.ERROR
     assert caplog.records[0].msg == (
         "DatabaseError: test does not exist in database")
 
 
-@patch("src.ingestion.Connection")
-def test_check_updated_returns_true_if_database_has_been_updated_at_interval(
-    mock_connection,
-):
-    from src.ingestion import sql_check_updated
+@pytest.fixture(scope="function")
+def s3(aws_credentials):
+    with mock_s3():
+        yield boto3.client("s3", region_name="us-east-1")
 
-    test_result = [["some data", 1]]
-    mock_connection().run.return_value = test_result
-    assert sql_check_updated(MOCK_CREDS, "table", "2 days")
 
+@pytest.fixture
+def bucket_name():
+    return 'test_bucket'
 
-@patch("src.ingestion.Connection")
-def test_check_updated_returns_false_if_database_is_not_updated_at_interval(
-    mock_connection
-):
-    from src.ingestion import sql_check_updated
 
-    test_result = []
-    mock_connection().run.return_value = test_result
-    assert not sql_check_updated(MOCK_CREDS, "table", "1 day")
+@pytest.fixture
+def s3_bucket(s3, bucket_name):
+    s3.create_bucket(Bucket=bucket_name)
 
 
-@patch("src.ingestion.Connection")
-def test_check_updated_logs_error_if_table_does_not_exist(
-        mock_connection, caplog):
-    from src.ingestion import sql_check_updated
+def test_list_key_states_reports_every_key_from_one_listing(s3, s3_bucket):
+    import src.ingestion
 
-    mock_connection().run.side_effect = pge.DatabaseError
+    s3.put_object(Bucket='test_bucket', Key='staff.csv', Body=b'abc')
+    s3.put_object(Bucket='test_bucket', Key='design/date=x/1.csv')
+
+    s3_client = src.ingestion.get_s3_client()
+    with patch.object(s3_client, 'head_object') as mock_head:
+        states = src.ingestion.list_key_states(
+            'test_bucket', ['staff.csv', 'payment.csv', 'design/',
+                            'address/'])
+
+    assert mock_head.call_count == 0
+    assert states['staff.csv']['exists']
+    assert states['staff.csv']['size'] == 3
+    assert states['staff.csv']['etag'] is not None
+    assert states['staff.csv']['last_modified'] is not None
+    assert not states['payment.csv']['exists']
+    assert states['design/']['exists']
+    assert not states['address/']['exists']
+
+
+# Test Watermarks
+def test_build_select_query_filters_rows_past_watermark():
+    from src.ingestion import build_select_query
+    since = datetime(2023, 2, 1, 9, 30)
+
+    assert build_select_query("table") == ("SELECT * FROM table;", {})
+    query, params = build_select_query("table", since, "1 minute")
+    assert "WHERE last_updated > " in query
+    assert params == {"since": since, "overlap": "1 minute"}
+
+
+def test_load_state_from_s3_returns_default_if_no_state(s3, s3_bucket):
+    from src.ingestion import load_state_from_s3
+
+    assert load_state_from_s3("test_bucket", "_state/test.json", {}) == {}
+
+
+def test_state_saved_to_s3_can_be_loaded_again(s3, s3_bucket):
+    from src.ingestion import load_state_from_s3, save_state_to_s3
+
+    save_state_to_s3("test_bucket", "_state/test.json", {"staff": 1})
+    assert load_state_from_s3("test_bucket", "_state/test.json") == {
+        "staff": 1}
+
+
+def test_set_watermark_only_moves_forward():
+    from src.ingestion import set_watermark, get_watermark
+
+    watermarks = {"staff": "2023-02-01T09:30:00"}
+    set_watermark(watermarks, "staff", datetime(2023, 1, 1))
+    assert get_watermark(watermarks, "staff") == datetime(2023, 2, 1, 9, 30)
+
+    set_watermark(watermarks, "staff", None)
+    set_watermark(watermarks, "staff", datetime(2023, 3, 1))
+    assert watermarks == {"staff": "2023-03-01T00:00:00"}
+
+
+# Test Streaming Query
+def test_sql_stream_query_fetches_batches_from_a_server_side_cursor():
+    from src.ingestion import sql_stream_query
+
+    conn = MagicMock()
+    conn.run.side_effect = [None, None, [[1], [2]], [[3]], [], None, None]
+
+    batches = list(sql_stream_query(conn, "table", 2))
+    assert batches == [[[1], [2]], [[3]]]
+    statements = [call.args[0] for call in conn.run.call_args_list]
+    assert statements[1] == (
+        "DECLARE export_cursor NO SCROLL CURSOR FOR SELECT * FROM table;")
+    assert statements[2] == "FETCH FORWARD 2 FROM export_cursor;"
+    assert statements[-1] == "COMMIT;"
+
+
+def test_sql_stream_query_logs_error_if_table_does_not_exist(caplog):
+    from src.ingestion import sql_stream_query
+
+    conn = MagicMock()
+    conn.run.side_effect = [None, pge.DatabaseError]
 
     with pytest.raises(pge.DatabaseError):
-        sql_check_updated(MOCK_CREDS, "test", 1)
+        list(sql_stream_query(conn, "test", 2))
 
-    assert caplog.records[0].levelno == logging.ERROR
     assert caplog.records[0].msg == (
         "DatabaseError: test does not exist in database")
 
 
-@pytest.fixture(scope="function")
-def s3(aws_credentials):
-    with mock_s3():
-        yield boto3.client("s3", region_name="us-east-1")
+# Test Change Probe
+def test_sql_probe_tables_checks_all_tables_in_one_query():
+    from src.ingestion import sql_probe_tables
 
+    conn = MagicMock()
+    conn.run.return_value = [["table_1", datetime(2023, 1, 1), 5, True],
+                             ["table_2", None, -1, None]]
+
+    result = sql_probe_tables(conn, ["table_1", "table_2"], "3 minutes")
+    assert result == {
+        "table_1": {"last_updated": datetime(2023, 1, 1), "row_count": 5,
+                    "is_recent": True},
+        "table_2": {"last_updated": None, "row_count": None,
+                    "is_recent": False}}
+    conn.run.assert_called_once()
+    query = conn.run.call_args.args[0]
+    assert query.count("UNION ALL") == 1
+    assert "FROM table_1" in query and "FROM table_2" in query
+    assert "reltuples" in query and "count(*)" not in query
+
+
+def test_sql_probe_tables_logs_error_if_table_does_not_exist(caplog):
+    from src.ingestion import sql_probe_tables
+
+    conn = MagicMock()
+    conn.run.side_effect = pge.DatabaseError
+
+    with pytest.raises(pge.DatabaseError):
+        sql_probe_tables(conn, ["test"], "3 minutes")
+
+    assert caplog.records[0].levelno == logging.ERROR
+
+
+def test_has_table_changed_uses_watermark_when_there_is_one():
+    from src.ingestion import has_table_changed
+
+    probe = {"last_updated": datetime(2023, 2, 1), "row_count": 1,
+             "is_recent": False}
+    assert not has_table_changed(probe)
+    assert has_table_changed(probe, since=datetime(2023, 1, 1))
+    assert not has_table_changed(probe, since=datetime(2023, 2, 1))
+    assert has_table_changed(None)
 
-@pytest.fixture
-def bucket_name():
-    return 'test_bucket'
+
+# Test Schema Catalog
+SCHEMA_ROWS = [["table_1", "col_1", "integer"],
+               ["table_1", "col_2", "boolean"]]
+
+
+def schema_connection(fingerprint):
+    conn = MagicMock()
+
+    def run(sql, **params):
+        if sql.startswith("SELECT md5"):
+            return [[fingerprint]]
+        return SCHEMA_ROWS
+
+    conn.run.side_effect = run
+    return conn
 
 
 @pytest.fixture
-def s3_bucket(s3, bucket_name):
-    s3.create_bucket(Bucket=bucket_name)
+def empty_catalog_cache():
+    import src.ingestion
+    src.ingestion._schema_catalog = None
+    yield
+    src.ingestion._schema_catalog = None
+
+
+def test_get_schema_catalog_builds_and_persists_catalog(
+        s3, s3_bucket, empty_catalog_cache):
+    from src.ingestion import (get_schema_catalog, get_catalog_columns,
+                               get_catalog_types, load_state_from_s3)
+
+    catalog = get_schema_catalog(schema_connection("abc"), ["table_1"],
+                                 "test_bucket")
 
+    assert catalog == {"fingerprint": "abc", "tables": {"table_1": [
+        {"name": "col_1", "data_type": "integer"},
+        {"name": "col_2", "data_type": "boolean"}]}}
+    assert get_catalog_columns(catalog, "table_1") == ["col_1", "col_2"]
+    assert get_catalog_types(catalog, "table_1") == {
+        "col_1": "integer", "col_2": "boolean"}
+    assert load_state_from_s3(
+        "test_bucket", "_state/schema_catalog.json") == catalog
 
-def test_check_key_exists_returns_true_if_key_in_s3(s3, s3_bucket):
+
+def test_get_schema_catalog_reuses_cache_while_fingerprint_matches(
+        empty_catalog_cache):
+    from src.ingestion import get_schema_catalog
     import src.ingestion
 
-    name = 'test_bucket'
-    key = 'test.csv'
+    cached = {"fingerprint": "abc", "tables": {"table_1": []}}
+    src.ingestion._schema_catalog = cached
+    conn = schema_connection("abc")
+
+    assert get_schema_catalog(conn, ["table_1"], "test_bucket") is cached
+    conn.run.assert_called_once()
+
 
-    s3.put_object(Bucket=name, Key=key)
-    assert src.ingestion.check_key_exists(name, key)
+def test_get_schema_catalog_loads_from_s3_on_cold_start(
+        s3, s3_bucket, empty_catalog_cache):
+    from src.ingestion import get_schema_catalog, save_state_to_s3
 
+    stored = {"fingerprint": "abc", "tables": {"table_1": []}}
+    save_state_to_s3("test_bucket", "_state/schema_catalog.json", stored)
+    conn = schema_connection("abc")
 
-def test_check_key_exists_returns_false_if_no_key_in_s3(s3, s3_bucket):
+    assert get_schema_catalog(conn, ["table_1"], "test_bucket") == stored
+    conn.run.assert_called_once()
+
+
+def test_get_schema_catalog_rebuilds_and_warns_on_schema_drift(
+        s3, s3_bucket, empty_catalog_cache, caplog):
+    from src.ingestion import get_schema_catalog
     import src.ingestion
 
-    with patch('src.ingestion.s3_client.head_object') as mock:
-        mock.side_effect = boto3.client(
-            's3').exceptions.NoSuchKey({}, '')
+    src.ingestion._schema_catalog = {"fingerprint": "old",
+                                     "tables": {"table_1": []}}
+    catalog = get_schema_catalog(schema_connection("new"), ["table_1"],
+                                 "test_bucket")
+
+    assert catalog["fingerprint"] == "new"
+    assert len(catalog["tables"]["table_1"]) == 2
+    assert caplog.records[-1].levelno == logging.WARNING
+    assert caplog.records[-1].msg == (
+        "Schema drift detected in tables: ['table_1']")
+
+
+def test_sql_key_ranges_splits_table_at_every_nth_key():
+    from src.ingestion import sql_key_ranges
+
+    conn = MagicMock()
+    conn.run.return_value = [[100], [200]]
+    ranges = sql_key_ranges(conn, 'sales_order', 'sales_order_id', 100)
+
+    assert ranges == [(None, 100), (100, 200), (200, None)]
+    assert conn.run.call_args.kwargs == {'range_rows': 100}
+
+
+def test_sql_key_ranges_only_counts_rows_past_watermark():
+    from src.ingestion import sql_key_ranges
+
+    conn = MagicMock()
+    conn.run.return_value = []
+    since = datetime(2023, 2, 1)
+    ranges = sql_key_ranges(conn, 'sales_order', 'sales_order_id', 100,
+                            since, '1 minute')
+
+    assert ranges == [(None, None)]
+    assert "WHERE last_updated > " in conn.run.call_args.args[0]
+    assert conn.run.call_args.kwargs == {
+        'range_rows': 100, 'since': since, 'overlap': '1 minute'}
+
+
+def test_build_keyset_query_seeks_past_last_key():
+    from src.ingestion import build_keyset_query
+
+    query, params = build_keyset_query(
+        'sales_order', 'sales_order_id', after=5, upper=10)
+
+    assert query == ('SELECT * FROM sales_order WHERE sales_order_id > '
+                     ':after AND sales_order_id <= :upper ORDER BY '
+                     'sales_order_id LIMIT :batch_size;')
+    assert params == {'after': 5, 'upper': 10}
+    assert 'OFFSET' not in query
+
+
+def test_sql_keyset_pages_reads_range_until_short_page():
+    from src.ingestion import sql_keyset_pages
+
+    conn = MagicMock()
+    conn.run.side_effect = [[[1, 'a'], [2, 'b']], [[3, 'c']]]
+    pages = list(sql_keyset_pages(
+        conn, 'staff', 'staff_id', 0, (None, 3), 2))
+
+    assert pages == [[[1, 'a'], [2, 'b']], [[3, 'c']]]
+    assert conn.run.call_args_list[1].kwargs == {
+        'batch_size': 2, 'after': 2, 'upper': 3}
+
+
+# Test Exported Snapshots
+def test_sql_stream_query_attaches_to_exported_snapshot():
+    from src.ingestion import sql_stream_query
+
+    conn = MagicMock()
+    conn.run.side_effect = [None, None, None, [[1]], [], None, None]
+
+    batches = list(sql_stream_query(conn, "table", 2,
+                                    snapshot="00000003-0000001B-1"))
+    assert batches == [[[1]]]
+    statements = [call.args[0] for call in conn.run.call_args_list]
+    assert statements[0] == ("START TRANSACTION ISOLATION LEVEL "
+                             "REPEATABLE READ READ ONLY;")
+    assert statements[1] == (
+        "SET TRANSACTION SNAPSHOT '00000003-0000001B-1';")
+    assert statements[-1] == "COMMIT;"
+
+
+def test_exported_snapshot_is_held_open_until_block_ends():
+    from src.ingestion import exported_snapshot, ConnectionPool
+
+    with patch("src.ingestion.Connection") as mock_connection:
+        conn = mock_connection.return_value
+        conn.run.side_effect = [None, [["00000003-0000001B-1"]], None]
+        pool = ConnectionPool({"host": "h", "port": 5432, "user": "u",
+                               "password": "p", "database": "d"})
+
+        with exported_snapshot(pool) as snapshot:
+            assert snapshot == "00000003-0000001B-1"
+            assert conn.run.call_count == 2
+        statements = [call.args[0] for call in conn.run.call_args_list]
+
+    assert statements[1] == "SELECT pg_export_snapshot();"
+    assert statements[2] == "COMMIT;"
+
+
+# Test Adaptive Polling
+def test_update_poll_schedule_backs_off_quiet_tables_up_to_ceiling():
+    from src.ingestion import update_poll_schedule, is_poll_due
+
+    schedule = {}
+    skips = []
+    for _ in range(5):
+        update_poll_schedule(schedule, "currency", True, "unchanged",
+                             datetime(2023, 2, 1), 10)
+        skips.append(schedule["currency"]["skip"])
+    assert skips == [1, 3, 7, 10, 10]
+    assert not is_poll_due(schedule, "currency")
+
+    for _ in range(10):
+        update_poll_schedule(schedule, "currency", False, "unchanged",
+                             None, 10)
+    assert is_poll_due(schedule, "currency")
+    assert schedule["currency"]["last_updated"] == "2023-02-01T00:00:00"
+
+    update_poll_schedule(schedule, "currency", True, "updated",
+                         datetime(2023, 2, 2), 10)
+    assert schedule["currency"] == {"quiet": 0, "skip": 0,
+                                    "last_updated": "2023-02-02T00:00:00"}
+
+
+def test_update_poll_schedule_polls_failed_tables_next_run():
+    from src.ingestion import update_poll_schedule
+
+    schedule = {"payment": {"quiet": 2, "skip": 0,
+                            "last_updated": "2023-02-01T00:00:00"}}
+    update_poll_schedule(schedule, "payment", True, "failed",
+                         datetime(2023, 2, 2), 10)
+
+    assert schedule["payment"] == {"quiet": 2, "skip": 0,
+                                   "last_updated": "2023-02-01T00:00:00"}
+
+
+# Test Statistics Change Detection
+def test_order_work_puts_deferred_then_longest_estimates_first():
+    from src.ingestion import order_work
+
+    costs = {"staff": 0.5, "payment": 4.0, "design": 2.0}
+    assert order_work(["staff", "design", "currency", "payment", "address"],
+                      costs, ["address"]) == \
+        ["address", "payment", "design", "staff", "currency"]
+
+
+def test_deadline_leaves_margin_and_estimates_follow_recent_runs():
+    from src.ingestion import (get_deadline, fits_deadline,
+                               update_cost_estimate)
+
+    context = MagicMock()
+    context.get_remaining_time_in_millis.return_value = 15000
+    deadline = get_deadline(context, 10)
+    assert fits_deadline(deadline, 2.0)
+    assert not fits_deadline(deadline, 6.0)
+    assert get_deadline({}, 10) is None and fits_deadline(None, 1e9)
+
+    costs = {}
+    update_cost_estimate(costs, "staff", 4.0)
+    update_cost_estimate(costs, "staff", 2.0)
+    assert costs == {"staff": 3.0}
+
+
+def test_sql_table_stats_reads_counters_for_all_tables_in_one_query():
+    from src.ingestion import sql_table_stats
+
+    conn = MagicMock()
+    conn.run.return_value = [["staff", 20, 3, 0], ["currency", 3, 0, 0]]
+
+    stats = sql_table_stats(conn, ["staff", "currency"])
+
+    assert stats == {"staff": [20, 3, 0], "currency": [3, 0, 0]}
+    assert conn.run.call_count == 1
+    assert conn.run.call_args.kwargs == {"tables": ["staff", "currency"]}
+
+
+def test_has_stats_changed_notices_deletes_and_resets():
+    from src.ingestion import has_stats_changed
+
+    saved = {"staff": [20, 3, 0], "currency": [3, 0, 0]}
+
+    assert not has_stats_changed({"staff": [20, 3, 0]}, saved, "staff")
+    assert has_stats_changed({"staff": [20, 3, 1]}, saved, "staff")
+    assert has_stats_changed({"staff": [0, 0, 0]}, saved, "staff")
+    assert has_stats_changed({}, saved, "currency")
+
+
+# Test Delete Detection
+class FakeKeyTable:
+    """ Answers the key queries of delete detection from a set of keys,
+    standing in for PostgreSQL's hashtext with a fixed integer hash. """
+
+    def __init__(self, keys):
+        self.keys = set(keys)
+        self.queries = []
+
+    def run(self, query, **params):
+        self.queries.append(query)
+        keys = sorted(key for key in self.keys
+                      if params.get("lower", key) <= key
+                      < params.get("upper", key + 1))
+        if query.startswith("SELECT max"):
+            return [[max(keys, default=None)]]
+        if "hashtext" in query:
+            buckets = {}
+            for key in keys:
+                count, total = buckets.get(key // params["width"], (0, 0))
+                buckets[key // params["width"]] = (
+                    count + 1, total + key * 2654435761 % 2 ** 31)
+            return [[bucket, count, total]
+                    for bucket, (count, total) in buckets.items()]
+        return [[key] for key in keys]
+
+
+def test_compress_key_runs_round_trips_keys():
+    from src.ingestion import compress_key_runs, expand_key_runs
+
+    runs = compress_key_runs([1, 2, 3, 7, 9, 10])
+    assert runs == [[1, 3], [7, 7], [9, 10]]
+    assert expand_key_runs(runs) == [1, 2, 3, 7, 9, 10]
+
+
+def test_detect_deleted_keys_finds_deletes_reading_only_changed_leaves():
+    from src.ingestion import detect_deleted_keys
+
+    table = FakeKeyTable(range(1, 20001))
+    deleted, state = detect_deleted_keys(table, "staff", "staff_id", None,
+                                         100)
+    assert deleted == []
+    assert state["leaves"]["0"][2] == [[1, 99]]
+
+    table.keys -= {5, 12345}
+    table.keys.add(20001)
+    table.queries = []
+    deleted, state = detect_deleted_keys(table, "staff", "staff_id", state,
+                                         100)
+
+    assert deleted == [5, 12345]
+    key_reads = [query for query in table.queries
+                 if query.startswith("SELECT staff_id")]
+    assert len(key_reads) == 3
+    assert len(table.queries) < 20
+    assert state["leaves"]["123"][2] == [[12300, 12344], [12346, 12399]]
+
+    table.queries = []
+    deleted, state = detect_deleted_keys(table, "staff", "staff_id", state,
+                                         100)
+    assert deleted == []
+    assert len(table.queries) == 2
+
+
+@patch("src.ingestion.sql_select_primary_key", return_value="staff_id")
+def test_ingest_tombstones_writes_deleted_keys_and_saves_hashes(
+    mock_key, s3, s3_bucket, bucket_name
+):
+    from src.ingestion import ingest_tombstones
+
+    table = FakeKeyTable(range(1, 301))
+    pool = MagicMock()
+    pool.connection.return_value.__enter__.return_value = table
+    catalog = {"tables": {"staff": [{"name": "staff_id",
+                                     "data_type": "integer"}],
+                          "design": [{"name": "staff_id",
+                                      "data_type": "text"}]}}
+    settings = {"workers": 1, "delete_leaf_keys": 100}
+    keys = {"staff": "staff.csv", "design": "design.csv"}
+
+    outcomes = ingest_tombstones(pool, ["staff", "design"], bucket_name,
+                                 keys, catalog, settings)
+    assert outcomes == {"staff": None, "design": None}
+
+    table.keys -= {7, 250}
+    outcomes = ingest_tombstones(pool, ["staff"], bucket_name, keys,
+                                 catalog, settings)
+
+    assert outcomes["staff"] == {"key": "staff-tombstones.csv",
+                                 "row_count": 2}
+    body = s3.get_object(Bucket=bucket_name,
+                         Key="staff-tombstones.csv")["Body"].read()
+    assert body.decode().splitlines() == [
+        "staff_id,change_type,commit_lsn", "7,delete,", "250,delete,"]
+    assert ingest_tombstones(pool, ["staff"], bucket_name, keys, catalog,
+                             settings) == {"staff": None}
+
+
+def test_ingest_tombstones_leaves_tables_once_past_deadline(
+    s3, s3_bucket, bucket_name
+):
+    from src.ingestion import ingest_tombstones
+
+    pool = MagicMock()
+    settings = {"workers": 1, "delete_leaf_keys": 100}
+
+    outcomes = ingest_tombstones(pool, ["staff"], bucket_name,
+                                 {"staff": "staff.csv"}, {}, settings,
+                                 deadline=time.monotonic() - 1)
+
+    assert outcomes == {"staff": {"deferred": True}}
+    pool.connection.assert_not_called()
+
+
+# Test Column Projection
+def test_get_projected_columns_keeps_table_order_and_watermark():
+    from src.ingestion import get_projected_columns
+
+    headers = ["payment_id", "created_at", "last_updated", "paid",
+               "company_ac_number"]
+    projection = {"payment": ["paid", "payment_id"]}
+
+    assert get_projected_columns("payment", headers, projection) == [
+        "payment_id", "last_updated", "paid"]
+    assert get_projected_columns("staff", headers, projection) == headers
+    assert get_projected_columns("payment", headers, None) == headers
+
+
+def test_column_projection_keeps_each_tables_primary_key():
+    from src.ingestion import COLUMN_PROJECTION
+
+    for table, columns in COLUMN_PROJECTION.items():
+        assert f"{table}_id" in columns
+        assert "last_updated" in columns
+
+
+def test_sql_select_query_selects_only_projected_columns():
+    from src.ingestion import sql_select_query
+
+    conn = MagicMock()
+    sql_select_query(conn, "payment", columns=["payment_id", "paid"])
 
-    assert not src.ingestion.check_key_exists('test_bucket', 'test.csv')
+    assert conn.run.call_args.args[0] == (
+        "SELECT payment_id, paid FROM payment;")
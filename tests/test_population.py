@@ -1,7 +1,7 @@
 from src.population import (lambda_handler,
                             get_warehouse_connection,
                             insert_data_into_db)
-from unittest.mock import patch
+from unittest.mock import patch, MagicMock
 import pandas as pd
 import logging
 import psycopg2
@@ -11,6 +11,7 @@ import botocore.errorfactory
 import botocore.exceptions
 from botocore.response import StreamingBody
 import io
+from decimal import Decimal
 
 
 test_datetime = datetime.datetime.fromisoformat("2000-01-01T14:20:51.563000")
@@ -20,6 +21,18 @@ test_time = datetime.time.fromisoformat("14:20:51.563000")
 logger = logging.getLogger("TestLogger")
 
 
+@pytest.fixture(autouse=True)
+def empty_secret_cache():
+    import src.population
+    src.population._secret_cache.clear()
+    src.population._secrets_client = None
+    src.population._s3_client = None
+    yield
+    src.population._secret_cache.clear()
+    src.population._secrets_client = None
+    src.population._s3_client = None
+
+
 @patch('src.population.psycopg2.extensions.connection')
 @patch('src.population.psycopg2.connect')
 def test_get_warehouse_connection_return_value(mock_conn, mock_class):
@@ -162,6 +175,28 @@ def test_insert_data_into_db_fact_sales_order(mock_gsv, mock_extras,
     assert caplog.records[2].msg == 'Connection closed successfully'
 
 
+@patch('src.population.psycopg2.connect')
+@patch('src.population.psycopg2.extras')
+@patch('src.population.get_secret_value')
+def test_insert_data_into_db_compares_decimals_with_warehouse_floats(
+        mock_gsv, mock_extras, mock_connect, caplog):
+    payment_data = {
+        "payment_record_id": [1, 2],
+        "payment_amount": [Decimal("2.45"), Decimal("9.87")],
+        "payment_date": [test_datetime, test_datetime],
+    }
+    mock_gsv.return_value = {'user': 'name'}
+    mock_connect.return_value.cursor.return_value.fetchall.return_value \
+        = [[1, 2.45, test_datetime], [2, 9.87, test_datetime]]
+    mock_connect.return_value.cursor.return_value.description = [
+        ["payment_record_id"],
+        ["payment_amount"],
+        ["payment_date"]]
+    insert_data_into_db(pd.DataFrame(data=payment_data), 'fact_payment')
+    assert caplog.records[0].msg == 'New rows to insert: 0'
+    assert caplog.records[1].msg == 'Existing rows to update: 0'
+
+
 @patch('src.population.psycopg2.connect')
 @patch('src.population.psycopg2.extras')
 @patch('src.population.get_secret_value')
@@ -337,6 +372,61 @@ def test_lambda_handler_returns_a_dictionary(mock_insert, mock_load):
     assert lambda_handler({}, {}) == test_result
 
 
+@patch('src.population.invoke_again')
+@patch('src.population.save_work_plan')
+@patch('src.population.load_work_plan')
+@patch('src.population.load_parquet_from_s3')
+@patch('src.population.insert_data_into_db')
+def test_lambda_handler_defers_facts_until_every_dimension_is_loaded(
+        mock_insert, mock_load, mock_load_plan, mock_save_plan,
+        mock_invoke):
+    mock_load.side_effect = load_df
+    mock_load_plan.return_value = {
+        "costs": {"dim_date": 40.0, "dim_currency": 2.0},
+        "deferred": ["dim_location"]}
+    context = MagicMock()
+    context.get_remaining_time_in_millis.return_value = 25000
+
+    result = lambda_handler({}, context)
+
+    tables = [call.args[1] for call in mock_insert.call_args_list]
+    assert tables[:2] == ["dim_location", "dim_currency"]
+    assert "dim_date" not in tables
+    assert not any(table.startswith("fact_") for table in tables)
+    assert result["dim_staff"] is True and result["fact_payment"] is False
+    plan = mock_save_plan.call_args.args[1]
+    assert plan["deferred"] == ["dim_date", "fact_sales_order",
+                                "fact_purchase_order", "fact_payment"]
+    assert plan["costs"]["dim_date"] == 40.0
+    mock_invoke.assert_called_once_with(context)
+
+
+@patch('src.population.boto3.client')
+def test_invoke_again_starts_an_asynchronous_run(mock_client):
+    from src.population import invoke_again
+    context = MagicMock()
+    context.invoked_function_arn = "arn:aws:lambda:us-east-1:1:function:p"
+
+    invoke_again(context)
+
+    kwargs = mock_client.return_value.invoke.call_args.kwargs
+    assert kwargs["FunctionName"] == "arn:aws:lambda:us-east-1:1:function:p"
+    assert kwargs["InvocationType"] == "Event"
+
+
+@patch('src.population.boto3.client')
+def test_work_plan_reuses_one_s3_client(mock_client):
+    from src.population import load_work_plan, save_work_plan
+    body = StreamingBody(io.BytesIO(b'{"costs": {}, "deferred": []}'), 29)
+    mock_client.return_value.get_object.return_value = {'Body': body}
+
+    plan = load_work_plan('bucket')
+    save_work_plan('bucket', plan)
+
+    assert plan == {"costs": {}, "deferred": []}
+    mock_client.assert_called_once_with('s3')
+
+
 @patch('src.population.load_parquet_from_s3')
 def test_lambda_handler_error(mock_load, caplog):
     mock_load.side_effect = Exception('Error loading file')
@@ -396,6 +486,33 @@ def test_get_secret_value_error(mock_client):
         get_secret_value('test')
 
 
+@patch('src.population.boto3.client')
+def test_get_secret_value_reuses_client_and_cached_secret(mock_client):
+    from src.population import get_secret_value
+    text = {'SecretString': '{"Test":"Test"}'}
+    mock_client.return_value.get_secret_value.return_value = text
+    for _ in range(11):
+        assert get_secret_value('Test') == {"Test": "Test"}
+    assert mock_client.call_count == 1
+    assert mock_client.return_value.get_secret_value.call_count == 1
+
+    get_secret_value('Test', force_refresh=True)
+    assert mock_client.return_value.get_secret_value.call_count == 2
+
+
+@patch('src.population.get_warehouse_connection')
+@patch('src.population.get_secret_value')
+def test_insert_data_into_db_refreshes_credentials_if_rejected(
+        mock_gsv, mock_gwc):
+    mock_gsv.side_effect = [{'user': 'old'}, {'user': 'new'}]
+    mock_gwc.side_effect = [None, Exception('Stop after reconnecting')]
+    df = pd.DataFrame([[1, 2], [3, 4]])
+    with pytest.raises(Exception):
+        insert_data_into_db(df, 'table1')
+    mock_gsv.assert_called_with('warehouse_credentials', force_refresh=True)
+    mock_gwc.assert_called_with({'user': 'new'})
+
+
 @patch('src.population.pd.read_parquet')
 @patch('src.population.boto3.client')
 def test_load_parquet_from_s3(mock_client, mock_parq):
@@ -1,5 +1,5 @@
 import pandas as pd
-from unittest.mock import patch
+from unittest.mock import patch, MagicMock
 from src.transformation import (format_dim_staff,
                                 format_dim_location,
                                 format_dim_design,
@@ -11,7 +11,12 @@ from src.transformation import (format_dim_staff,
                                 format_fact_sales_order,
                                 format_fact_purchase_order,
                                 format_fact_payment,
-                                transform_data)
+                                transform_data,
+                                load_parquet_from_s3)
+from decimal import Decimal
+from moto import mock_s3
+import boto3
+import io
 import datetime
 import logging
 
@@ -420,6 +425,62 @@ def test_transform_data_exporting_errors(mock_load, mock_export, caplog):
         "Object passed to the function is not of type DataFrame."
 
 
+PAYMENT_TYPES = {
+    "payment_id": "integer",
+    "created_at": "timestamp without time zone",
+    "last_updated": "timestamp without time zone",
+    "transaction_id": "integer", "counterparty_id": "integer",
+    "payment_amount": "numeric", "currency_id": "integer",
+    "payment_type_id": "integer", "paid": "boolean",
+    "payment_date": "character varying",
+    "company_ac_number": "integer", "counterparty_ac_number": "integer"}
+
+
+@patch.dict("os.environ", {"TF_INGESTION_FORMAT": "parquet",
+                           "TF_ING_BUCKET": "ingest-bucket",
+                           "AWS_ACCESS_KEY_ID": "testing",
+                           "AWS_SECRET_ACCESS_KEY": "testing",
+                           "AWS_DEFAULT_REGION": "us-east-1"})
+@patch("src.transformation.export_parquet_to_s3", return_value=True)
+@patch("src.ingestion.sql_stream_query")
+def test_transform_data_parses_text_dates_from_parquet_landing_files(
+        mock_stream, mock_export):
+    import src.ingestion
+    import src.transformation
+
+    mock_stream.return_value = [[[
+        1, test_datetime, test_datetime, 2, 3, Decimal("12.50"), 1, 3,
+        False, "2000-01-02", 123, 456]]]
+    with mock_s3():
+        s3 = boto3.client("s3", region_name="us-east-1")
+        s3.create_bucket(Bucket="ingest-bucket")
+        src.ingestion.parquet_table_to_s3(
+            "conn", "payment", list(PAYMENT_TYPES), "ingest-bucket",
+            "payment.parquet", PAYMENT_TYPES)
+        with patch.object(src.transformation, "s3", s3):
+            results = transform_data({}, {})
+
+    assert results["fact_payment.parquet"] is True
+    fact_payment = mock_export.call_args.args[0]
+    assert fact_payment["payment_date"].tolist() == [
+        pd.Timestamp("2000-01-02")]
+    assert fact_payment["payment_amount"].tolist() == [Decimal("12.50")]
+
+
+@patch("src.transformation.s3")
+def test_load_parquet_from_s3_keeps_exact_numerics(mock_s3):
+    buffer = io.BytesIO()
+    pd.DataFrame({"payment_id": [1, 2],
+                  "payment_amount": [Decimal("123456789.01"), None]}
+                 ).to_parquet(buffer)
+    mock_s3.get_object.return_value = {
+        "Body": io.BytesIO(buffer.getvalue())}
+
+    df = load_parquet_from_s3("bucket", "payment.parquet")
+
+    assert df["payment_amount"].tolist() == [Decimal("123456789.01"), None]
+
+
 def load_func(bucket, file, parse_dates=[]):
     if file == "staff.csv":
         staff_data = {
@@ -579,3 +640,85 @@ def load_func_error(bucket, file, parse_dates=[]):
         return True
     elif file == "payment.csv":
         return True
+
+
+@patch("src.transformation.export_parquet_to_s3")
+@patch("src.transformation.load_csv_from_s3")
+def test_transform_data_runs_on_columns_projected_by_ingestion(
+        mock_load, mock_export):
+    from src.ingestion import COLUMN_PROJECTION, get_projected_columns
+
+    def load_projected(bucket, file, parse_dates=[]):
+        df = load_func(bucket, file, parse_dates)
+        columns = get_projected_columns(
+            file.replace(".csv", ""), list(df.columns), COLUMN_PROJECTION)
+        return df[columns]
+
+    mock_load.side_effect = load_projected
+    mock_export.return_value = True
+
+    results = transform_data({}, {})
+    assert len(results) == 11
+    assert all(results.values())
+    projected = load_projected("bucket", "department.csv")
+    assert "manager" not in projected.columns
+
+
+@patch("src.transformation.invoke_again")
+@patch("src.transformation.save_work_plan")
+@patch("src.transformation.load_work_plan")
+@patch("src.transformation.export_parquet_to_s3")
+@patch("src.transformation.load_csv_from_s3")
+def test_transform_data_defers_files_that_do_not_fit_before_deadline(
+        mock_load, mock_export, mock_load_plan, mock_save_plan,
+        mock_invoke):
+    mock_load.side_effect = load_func
+    mock_export.return_value = True
+    mock_load_plan.return_value = {
+        "costs": {"fact_payment.parquet": 30.0, "dim_staff.parquet": 1.0},
+        "deferred": ["dim_date.parquet"]}
+    context = MagicMock()
+    context.get_remaining_time_in_millis.return_value = 25000
+
+    results = transform_data({}, context)
+
+    keys = [call.args[2] for call in mock_export.call_args_list]
+    assert keys[:2] == ["dim_date.parquet", "dim_staff.parquet"]
+    assert len(keys) == 10
+    assert results["fact_payment.parquet"] is None
+    plan = mock_save_plan.call_args.args[1]
+    assert plan["deferred"] == ["fact_payment.parquet"]
+    assert plan["costs"]["fact_payment.parquet"] == 30.0
+    assert "dim_currency.parquet" in plan["costs"]
+    mock_invoke.assert_called_once_with(context)
+
+
+@patch("src.transformation.invoke_again")
+@patch("src.transformation.save_work_plan")
+@patch("src.transformation.load_work_plan")
+@patch("src.transformation.load_csv_from_s3")
+def test_transform_data_does_not_invoke_again_if_nothing_fits(
+        mock_load, mock_load_plan, mock_save_plan, mock_invoke):
+    mock_load_plan.return_value = {"costs": {}, "deferred": []}
+    context = MagicMock()
+    context.get_remaining_time_in_millis.return_value = 5000
+
+    results = transform_data({}, context)
+
+    assert set(results.values()) == {None}
+    mock_load.assert_not_called()
+    mock_invoke.assert_not_called()
+
+
+@patch("src.transformation.boto3.client")
+def test_invoke_again_starts_an_asynchronous_run(mock_client):
+    from src.transformation import invoke_again
+    context = MagicMock()
+    context.invoked_function_arn = "arn:aws:lambda:us-east-1:1:function:t"
+
+    invoke_again(context)
+
+    mock_client.assert_called_once_with('lambda')
+    kwargs = mock_client.return_value.invoke.call_args.kwargs
+    assert kwargs["FunctionName"] == "arn:aws:lambda:us-east-1:1:function:t"
+    assert kwargs["InvocationType"] == "Event"
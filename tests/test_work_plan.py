@@ -0,0 +1,31 @@
+import ast
+import inspect
+
+import pytest
+
+import src.ingestion
+import src.population
+import src.transformation
+
+HELPERS = ["get_deadline", "order_work", "fits_deadline",
+           "update_cost_estimate"]
+
+
+def helper_code(module, name):
+    tree = ast.parse(inspect.getsource(getattr(module, name)))
+    body = tree.body[0].body
+    if isinstance(body[0], ast.Expr) and \
+            isinstance(body[0].value, ast.Constant):
+        del body[0]
+    return ast.dump(tree)
+
+
+@pytest.mark.parametrize("module", [src.transformation, src.population])
+@pytest.mark.parametrize("name", HELPERS)
+def test_deadline_helpers_match_ingestion(module, name):
+    assert helper_code(module, name) == helper_code(src.ingestion, name)
+
+
+@pytest.mark.parametrize("module", [src.transformation, src.population])
+def test_cost_smoothing_matches_ingestion(module):
+    assert module.COST_SMOOTHING == src.ingestion.COST_SMOOTHING